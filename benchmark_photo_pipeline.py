@@ -0,0 +1,414 @@
+"""Benchmarks for the photo pipeline in generate_photo_md.py.
+
+Builds synthetic JPEG, PNG and HEIC fixtures of a few megapixel sizes (with
+and without EXIF/orientation), then times extract_exif, convert_heic_to_jpeg,
+optimize_image and process_image on each of them separately. Every case runs
+in its own child process so its peak memory can be reported too.
+
+    python benchmark_photo_pipeline.py                      # run and compare with the baseline
+    python benchmark_photo_pipeline.py --update-baseline    # record a new baseline
+    python benchmark_photo_pipeline.py --only optimize_image --update-baseline  # re-record one benchmark
+    python benchmark_photo_pipeline.py --megapixels 2,12,24 --repeat 5
+
+Baselines are machine specific, so the default baseline file is git-ignored.
+The run fails (exit code 1) when a case's throughput drops, or its peak memory
+grows, by more than --tolerance compared with the baseline, and whenever a
+case's pipeline call reports a failure.
+
+The 'startup' case times importing generate_photo_md.py and a run with
+nothing to do (what the pre-commit hook pays) in fresh interpreters, and fails
+the run when either exceeds STARTUP_BUDGET_SECONDS.
+
+The 'exif_strip' case times the in-place TIFF rewrite that strips GPS data
+from EXIF against the piexif load/dump round trip it replaced, and fails the
+run if the two produce EXIF that extract_exif reads differently.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from typing import Dict, Any, Optional, List, Tuple
+
+import piexif
+import pillow_heif
+from PIL import Image
+
+import generate_photo_md as photo_md
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASELINE_PATH = os.path.join(photo_md.PROJECT_ROOT, '.photo-benchmark-baseline.json')
+DEFAULT_MEGAPIXELS = [2, 12]
+DEFAULT_TOLERANCE = 0.2
+
+# Fixture kinds: (name, container format, carries EXIF with Orientation=6)
+FIXTURE_KINDS = [
+    ('jpeg', 'JPEG', False),
+    ('jpeg-exif', 'JPEG', True),
+    ('png', 'PNG', False),
+    ('heic', 'HEIF', False),
+    ('heic-exif', 'HEIF', True),
+]
+FIXTURE_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'HEIF': '.heic'}
+
+STARTUP_CASE = 'startup'
+# Wall-clock budgets for a fresh interpreter, including Python's own startup
+STARTUP_BUDGET_SECONDS = {'import': 0.3, 'noop': 0.5}
+
+EXIF_STRIP_CASE = 'exif_strip'
+# Calls per timing of the EXIF strip case, a single call takes microseconds
+EXIF_STRIP_ITERATIONS = 2000
+# Cases measured outside the per-fixture benchmarks
+EXTRA_CASES = [STARTUP_CASE, EXIF_STRIP_CASE]
+
+def synthetic_exif() -> bytes:
+    """Returns camera-like EXIF with GPS data and a rotated orientation."""
+    exif_dict = {
+        '0th': {
+            piexif.ImageIFD.Make: b'Apple',
+            piexif.ImageIFD.Model: b'iPhone XR',
+            piexif.ImageIFD.Orientation: 6,
+            piexif.ImageIFD.DateTime: b'2021:05:15 20:22:28',
+        },
+        'Exif': {
+            piexif.ExifIFD.DateTimeOriginal: b'2021:05:15 20:22:28',
+            piexif.ExifIFD.FNumber: (18, 10),
+            piexif.ExifIFD.ExposureTime: (1, 125),
+            piexif.ExifIFD.ISOSpeedRatings: 200,
+            piexif.ExifIFD.FocalLengthIn35mmFilm: 26,
+            piexif.ExifIFD.LensModel: b'iPhone XR back camera 4.25mm f/1.8',
+            piexif.ExifIFD.OffsetTimeOriginal: b'+05:30',
+        },
+        'GPS': {
+            piexif.GPSIFD.GPSLatitudeRef: b'N',
+            piexif.GPSIFD.GPSLatitude: ((13, 1), (4, 1), (5000, 100)),
+            piexif.GPSIFD.GPSLongitudeRef: b'E',
+            piexif.GPSIFD.GPSLongitude: ((80, 1), (16, 1), (3000, 100)),
+        },
+    }
+    return piexif.dump(exif_dict)
+
+def synthetic_image(megapixels: float, seed: int) -> Image.Image:
+    """Builds a deterministic 4:3 RGB image: smooth gradients with film-grain noise."""
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    rng = random.Random(seed)
+    gradient = Image.merge('RGB', [
+        Image.linear_gradient('L').resize((width, height)),
+        Image.radial_gradient('L').resize((width, height)),
+        Image.linear_gradient('L').rotate(90).resize((width, height)),
+    ])
+    noise = Image.merge('RGB', [
+        Image.frombytes('L', (width, height), rng.randbytes(width * height)) for _ in range(3)
+    ])
+    return Image.blend(gradient, noise, 0.2)
+
+def build_fixtures(directory: str, megapixels: List[float]) -> List[Dict[str, Any]]:
+    """Writes one fixture per kind and size into directory and describes them."""
+    fixtures = []
+    exif_bytes = synthetic_exif()
+    for mp in megapixels:
+        image = synthetic_image(mp, seed=int(mp * 1000))
+        for kind, container, with_exif in FIXTURE_KINDS:
+            filename = f"fixture_{kind}_{mp:g}mp{FIXTURE_EXTENSIONS[container]}"
+            path = os.path.join(directory, filename)
+            options = {'exif': exif_bytes} if with_exif else {}
+            if container == 'HEIF':
+                pillow_heif.from_pillow(image).save(path, quality=80, **options)
+            elif container == 'JPEG':
+                image.save(path, 'JPEG', quality=92, **options)
+            else:
+                image.save(path, 'PNG', compress_level=1)
+            fixtures.append({
+                'name': f"{kind}-{mp:g}mp",
+                'filename': filename,
+                'kind': kind,
+                'megapixels': image.size[0] * image.size[1] / 1_000_000,
+            })
+            logger.info("Built fixture %s (%.1f MB)", filename, os.path.getsize(path) / 1024 / 1024)
+    return fixtures
+
+def configure_pipeline(workdir: str) -> None:
+    """Points generate_photo_md at the benchmark directories instead of the site."""
+    photo_md.PHOTOGRAPHS_DIR = os.path.join(workdir, 'photographs')
+    photo_md.OPTIMIZED_DIR = os.path.join(workdir, 'photographs', 'optimized')
+    photo_md.OUTPUT_DIR = os.path.join(workdir, 'markdown')
+    photo_md.MANIFEST_PATH = os.path.join(workdir, 'manifest.json')
+    os.makedirs(photo_md.OPTIMIZED_DIR, exist_ok=True)
+    os.makedirs(photo_md.OUTPUT_DIR, exist_ok=True)
+
+def reset_pipeline_state() -> None:
+    """Drops cached EXIF and generated files so each run does the full work."""
+    photo_md._EXIF_CACHE.clear()
+    for directory in (photo_md.OPTIMIZED_DIR, photo_md.OUTPUT_DIR):
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+def _bench_extract_exif(fixture: Dict[str, Any]) -> bool:
+    return bool(photo_md.extract_exif(os.path.join(photo_md.PHOTOGRAPHS_DIR, fixture['filename']))) \
+        or 'exif' not in fixture['kind']
+
+def _bench_convert_heic_to_jpeg(fixture: Dict[str, Any]) -> bool:
+    input_path = os.path.join(photo_md.PHOTOGRAPHS_DIR, fixture['filename'])
+    output_path = os.path.join(photo_md.OPTIMIZED_DIR, 'converted.jpg')
+    return photo_md.convert_heic_to_jpeg(input_path, output_path)
+
+def _bench_optimize_image(fixture: Dict[str, Any]) -> bool:
+    input_path = os.path.join(photo_md.PHOTOGRAPHS_DIR, fixture['filename'])
+    stem = os.path.splitext(fixture['filename'])[0]
+    ok = photo_md.optimize_image(input_path, os.path.join(photo_md.OPTIMIZED_DIR, stem + '.jpg'))
+    # The derivatives are written on the output writer's thread, count that work too
+    photo_md.output_writer().flush()
+    return ok
+
+def _bench_process_image(fixture: Dict[str, Any]) -> bool:
+    success, _, _ = photo_md.process_image(fixture['filename'], rebuild=True)
+    return success
+
+# Benchmarked functions: name -> (runner, fixture kinds it applies to or None for all)
+BENCHMARKS = {
+    'extract_exif': (_bench_extract_exif, None),
+    'convert_heic_to_jpeg': (_bench_convert_heic_to_jpeg, ['heic-exif']),
+    'optimize_image': (_bench_optimize_image, None),
+    'process_image': (_bench_process_image, None),
+}
+
+def _run_case(benchmark: str, fixture: Dict[str, Any], workdir: str, repeat: int, results) -> None:
+    """Child-process body: times one benchmark on one fixture."""
+    logging.getLogger().setLevel(logging.ERROR)
+    configure_pipeline(workdir)
+    runner, _ = BENCHMARKS[benchmark]
+    timings = []
+    ok = True
+    for _ in range(repeat):
+        reset_pipeline_state()
+        start = time.perf_counter()
+        ok = runner(fixture) and ok
+        timings.append(time.perf_counter() - start)
+    results.put({'seconds': min(timings), 'ok': ok, 'peakRssMb': photo_md.peak_rss_mb()})
+
+def run_case(benchmark: str, fixture: Dict[str, Any], workdir: str, repeat: int) -> Dict[str, Any]:
+    """Runs one benchmark case in a fresh child process and returns its metrics."""
+    context = multiprocessing.get_context()
+    results = context.Queue()
+    process = context.Process(target=_run_case, args=(benchmark, fixture, workdir, repeat, results))
+    process.start()
+    result = results.get()
+    process.join()
+    seconds = result['seconds']
+    return {
+        'seconds': round(seconds, 4),
+        'imagesPerSecond': round(1 / seconds, 3),
+        'megapixelsPerSecond': round(fixture['megapixels'] / seconds, 3),
+        'peakRssMb': round(result['peakRssMb'], 1),
+        'ok': result['ok'],
+    }
+
+def run_benchmarks(megapixels: List[float], repeat: int, only: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+    """Builds fixtures and runs every benchmark case; returns results keyed by case name."""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='photo-bench-') as workdir:
+        fixtures_dir = os.path.join(workdir, 'photographs')
+        os.makedirs(fixtures_dir)
+        fixtures = build_fixtures(fixtures_dir, megapixels)
+        for benchmark, (_, kinds) in BENCHMARKS.items():
+            if only and benchmark not in only:
+                continue
+            for fixture in fixtures:
+                if kinds is not None and fixture['kind'] not in kinds:
+                    continue
+                case = f"{benchmark}[{fixture['name']}]"
+                results[case] = run_case(benchmark, fixture, workdir, repeat)
+                logger.info(
+                    "%s: %.3fs, %.2f img/s, %.1f MP/s, peak %.0f MB%s",
+                    case, results[case]['seconds'], results[case]['imagesPerSecond'],
+                    results[case]['megapixelsPerSecond'], results[case]['peakRssMb'],
+                    "" if results[case]['ok'] else " (FAILED)"
+                )
+        shutil.rmtree(fixtures_dir, ignore_errors=True)
+    return results
+
+def measure_startup(repeat: int) -> Dict[str, float]:
+    """Times importing the module and a no-op run in fresh interpreters; keeps the fastest of repeat.
+
+    Runs against a throwaway project tree holding a copy of the script and one
+    already processed photo, so the no-op run does the full manifest check.
+    """
+    script = os.path.abspath(photo_md.__file__)
+    commands = {
+        'import': [sys.executable, '-c', 'import generate_photo_md'],
+        'noop': [sys.executable, 'generate_photo_md.py', '--log-level', 'ERROR'],
+    }
+    timings = {}
+    with tempfile.TemporaryDirectory(prefix='photo-startup-') as project:
+        shutil.copy(script, project)
+        photographs = os.path.join(project, 'public', 'photographs')
+        os.makedirs(photographs)
+        synthetic_image(0.5, seed=1).save(os.path.join(photographs, 'startup.jpg'), 'JPEG', quality=90)
+        subprocess.run(commands['noop'], cwd=project, check=True, capture_output=True)
+        for name, command in commands.items():
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                subprocess.run(command, cwd=project, check=True, capture_output=True)
+                best = min(best, time.perf_counter() - start)
+            timings[name] = round(best, 4)
+            logger.info("startup[%s]: %.3fs (budget %.1fs)", name, best, STARTUP_BUDGET_SECONDS[name])
+    return timings
+
+def measure_exif_strip(repeat: int) -> Tuple[Dict[str, float], List[str]]:
+    """Times the TIFF rewrite and the piexif round trip on synthetic_exif(); keeps the fastest of repeat.
+
+    Returns microseconds per call for each path, plus a problem for each
+    orientation mode whose output extract_exif reads differently.
+    """
+    exif_bytes = synthetic_exif()
+    paths = {
+        'tiff': photo_md.rewrite_exif,
+        'piexif': photo_md._strip_gps_with_piexif,
+    }
+    timings = {}
+    for name, strip in paths.items():
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(EXIF_STRIP_ITERATIONS):
+                strip(exif_bytes, True)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = round(best / EXIF_STRIP_ITERATIONS * 1e6, 2)
+    logger.info(
+        "exif_strip: tiff %.1fus, piexif %.1fus per call (%.1fx)",
+        timings['tiff'], timings['piexif'], timings['piexif'] / timings['tiff']
+    )
+
+    problems = []
+    image = Image.new('RGB', (16, 16))
+    with tempfile.TemporaryDirectory(prefix='photo-exif-') as directory:
+        for reset_orientation in (False, True):
+            read = {}
+            for name, strip in paths.items():
+                path = os.path.join(directory, f"{name}-{reset_orientation}.jpg")
+                image.save(path, 'JPEG', exif=strip(exif_bytes, reset_orientation))
+                read[name] = photo_md.extract_exif(path)
+            if read['tiff'] != read['piexif']:
+                problems.append(
+                    f"exif_strip: extract_exif differs (reset_orientation={reset_orientation}): "
+                    f"{read['tiff']} vs {read['piexif']}"
+                )
+    return timings, problems
+
+def load_baseline(path: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Returns the baseline results recorded at path, or None if there are none yet."""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def compare_with_baseline(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]],
+                          tolerance: float) -> List[str]:
+    """Returns a description of every case that regressed beyond tolerance."""
+    regressions = []
+    for case, current in sorted(results.items()):
+        previous = baseline.get(case)
+        if not previous:
+            continue
+        if current['imagesPerSecond'] < previous['imagesPerSecond'] * (1 - tolerance):
+            regressions.append(
+                f"{case}: {current['imagesPerSecond']:.3f} img/s vs baseline {previous['imagesPerSecond']:.3f} img/s"
+            )
+        if current['peakRssMb'] > previous['peakRssMb'] * (1 + tolerance):
+            regressions.append(
+                f"{case}: peak {current['peakRssMb']:.0f} MB vs baseline {previous['peakRssMb']:.0f} MB"
+            )
+    return regressions
+
+def print_table(results: Dict[str, Dict[str, Any]]) -> None:
+    """Prints the results as an aligned table."""
+    width = max(len(case) for case in results)
+    print(f"{'case':<{width}}  {'seconds':>8}  {'img/s':>8}  {'MP/s':>8}  {'peak MB':>8}")
+    for case, result in sorted(results.items()):
+        print(
+            f"{case:<{width}}  {result['seconds']:>8.3f}  {result['imagesPerSecond']:>8.2f}  "
+            f"{result['megapixelsPerSecond']:>8.1f}  {result['peakRssMb']:>8.0f}"
+            + ("" if result['ok'] else "  FAILED")
+        )
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parses command line options."""
+    parser = argparse.ArgumentParser(description="Benchmark the generate_photo_md.py pipeline.")
+    parser.add_argument(
+        '--megapixels', default=','.join(str(mp) for mp in DEFAULT_MEGAPIXELS),
+        help="Comma-separated fixture sizes in megapixels (default: %(default)s)"
+    )
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case, the fastest is kept (default: %(default)s)")
+    parser.add_argument('--only', help=f"Comma-separated subset of: {', '.join([*BENCHMARKS, *EXTRA_CASES])}")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help="Baseline JSON file (default: %(default)s)")
+    parser.add_argument('--update-baseline', action='store_true', help="Write the results as the new baseline (with --only, replace just those cases in it)")
+    parser.add_argument(
+        '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help="Allowed relative slowdown / memory growth before the run fails (default: %(default)s)"
+    )
+    args = parser.parse_args(argv)
+    args.megapixels = [float(mp) for mp in args.megapixels.split(',') if mp.strip()]
+    args.only = [name.strip() for name in args.only.split(',')] if args.only else None
+    if args.only and any(name not in BENCHMARKS and name not in EXTRA_CASES for name in args.only):
+        parser.error(f"--only must name benchmarks from: {', '.join([*BENCHMARKS, *EXTRA_CASES])}")
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    return args
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Runs the benchmarks and checks them against the startup budget and the baseline.
+
+    Exits with status 1 when a case fails, a budget is exceeded or a case
+    regressed compared with the baseline.
+    """
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format=photo_md.LOG_FORMAT)
+    problems = []
+    if not args.only or STARTUP_CASE in args.only:
+        startup = measure_startup(args.repeat)
+        problems.extend(
+            f"startup[{name}]: {seconds:.3f}s, over its {STARTUP_BUDGET_SECONDS[name]:.1f}s budget"
+            for name, seconds in startup.items() if seconds > STARTUP_BUDGET_SECONDS[name]
+        )
+    if not args.only or EXIF_STRIP_CASE in args.only:
+        _, strip_problems = measure_exif_strip(args.repeat)
+        problems.extend(strip_problems)
+    results = {}
+    if not args.only or any(name in BENCHMARKS for name in args.only):
+        results = run_benchmarks(args.megapixels, args.repeat, args.only)
+        print_table(results)
+        problems.extend(f"{case}: failed" for case, result in sorted(results.items()) if not result['ok'])
+
+    if args.update_baseline:
+        # With --only, the cases that did not run keep their recorded baseline
+        baseline = (load_baseline(args.baseline) or {}) if args.only else {}
+        baseline.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        logger.info("Baseline written to %s", args.baseline)
+    else:
+        baseline = load_baseline(args.baseline)
+        if baseline is None:
+            logger.info("No baseline at %s; run with --update-baseline to record one", args.baseline)
+        else:
+            problems.extend(compare_with_baseline(results, baseline, args.tolerance))
+
+    if problems:
+        logger.error("Benchmark failures and performance regressions (tolerance %.0f%%):", args.tolerance * 100)
+        for problem in problems:
+            logger.error("- %s", problem)
+        sys.exit(1)
+    logger.info("No performance regressions")
+
+if __name__ == '__main__':
+    main()
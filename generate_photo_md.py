@@ -1,25 +1,41 @@
-whats import os
-import yaml
-from PIL import Image, ExifTags, ImageOps
+from __future__ import annotations
+
+import os
+import io
 from datetime import datetime
-import pillow_heif
 import logging
 from pathlib import Path
-import shutil
-from typing import Dict, Any, Optional, List, Tuple
-import piexif
-from tqdm import tqdm
+from typing import TYPE_CHECKING, Dict, Any, Optional, List, Tuple, Iterable, Iterator
 import sys
 import math
+import json
+import gzip
+import hashlib
+import time
+import queue
+import threading
+import argparse
+import select
+import signal
+import struct
+import cProfile
+from contextlib import contextmanager
 from fractions import Fraction
-from PIL.TiffImagePlugin import IFDRational
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+if TYPE_CHECKING:
+    # Only named in annotations, which are never evaluated at runtime
+    from concurrent.futures import Future, ThreadPoolExecutor
+    from PIL import Image
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Heavy dependencies (PIL, pillow_heif, piexif, yaml, tqdm, numpy) are imported
+# inside the functions that need them, so a run with nothing to do never pays
+# for them; logging is configured in main() from --log-level.
 logger = logging.getLogger(__name__)
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 
 # Define your project's root directory and relevant paths
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -27,10 +43,124 @@ PHOTOGRAPHS_DIR = os.path.join(PROJECT_ROOT, 'public', 'photographs')
 OUTPUT_DIR = os.path.join(PROJECT_ROOT, 'src', 'data', 'photography')
 FALLBACK_IMAGE = '/valipokkann_transparent_logo.png'
 OPTIMIZED_DIR = os.path.join(PHOTOGRAPHS_DIR, 'optimized')
+MANIFEST_PATH = os.path.join(PROJECT_ROOT, '.photo-manifest.json')
+# Version 2: markdown carries the responsive variant list, so version 1
+# entries are reprocessed once to add it
+MANIFEST_VERSION = 2
+# One JSON file with every photo's frontmatter and variants, next to the markdown
+INDEX_FILENAME = 'index.json'
+# Version 2: the frontmatter in a record no longer repeats the variant list
+INDEX_VERSION = 2
+HASH_INDEX_PATH = os.path.join(PROJECT_ROOT, '.photo-hashes.json')
+HASH_INDEX_VERSION = 1
+# Partial manifests written by --shard runs and combined by --merge-shards
+SHARD_MANIFEST_PATTERN = '.photo-manifest.shard-{index}-of-{count}.json'
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.heic', '.heif')
+
+# Web variants generated for every photo: longest-edge bounding boxes
+VARIANT_SIZES = {
+    'thumb': (400, 400),
+    'medium': (800, 800),
+    'large': (1200, 1200),
+    'full': (1920, 1920),
+}
+JPEG_QUALITY = 85
+WEBP_QUALITY = 85
+WEBP_METHOD = 6
+AVIF_QUALITY = 60
+AVIF_SPEED = 6
+BLUR_SIZE = (20, 20)
+BLUR_QUALITY = 30
+
+# Encoders available for the size ladder, selected with --formats. Only the
+# JPEG variants carry EXIF; the markdown and EXIF checks read _full.jpg.
+OUTPUT_FORMAT_SETTINGS = {
+    'jpeg': {'format': 'JPEG', 'ext': 'jpg', 'exif': True, 'options': {'quality': JPEG_QUALITY, 'optimize': True}},
+    'webp': {'format': 'WEBP', 'ext': 'webp', 'exif': False, 'options': {'quality': WEBP_QUALITY, 'method': WEBP_METHOD}},
+    'avif': {'format': 'AVIF', 'ext': 'avif', 'exif': False, 'options': {'quality': AVIF_QUALITY, 'speed': AVIF_SPEED}},
+}
+DEFAULT_OUTPUT_FORMATS = ['jpeg', 'webp']
+# Faster encoder effort for --draft builds, merged over the options above
+DRAFT_FORMAT_OPTIONS = {
+    'jpeg': {'optimize': False},
+    'webp': {'method': 4},
+    'avif': {'speed': 9},
+}
+BLUR_FORMAT = {'format': 'JPEG', 'ext': 'jpg', 'exif': False, 'options': {'quality': BLUR_QUALITY}}
+# Qualities --target-ssim / --target-bytes-per-pixel bisect over for every
+# variant except the blur (see search_quality())
+QUALITY_SEARCH_RANGE = (30, 95)
+
+# Resize cascade: the source is first shrunk with a cheap integer-factor
+# Image.reduce() while staying at least this many times larger than the biggest
+# variant, then LANCZOS takes it to that size and each smaller variant is
+# resized from the previous one.
+RESIZE_REDUCING_GAP = 2.0
+# Sources with an embedded ICC profile (Display P3 from iPhones, Adobe RGB
+# from cameras) are converted to untagged sRGB, which browsers assume, at the
+# largest variant size; see to_srgb().
+OUTPUT_COLOR_SPACE = 'sRGB'
+# With --verify-resize every cascaded variant is compared against a direct
+# LANCZOS resize of the source and replaced by it below this SSIM.
+RESIZE_SSIM_THRESHOLD = 0.98
+
+# JPEG sources that are upright and already fit a variant's box are copied
+# into that JPEG variant rather than decoded and re-encoded (see
+# passthrough_variants()), as long as the copy stays within this budget;
+# q85 derivatives of typical photos take 0.1-0.35 bytes per pixel.
+PASSTHROUGH_MAX_BYTES_PER_PIXEL = 0.5
+
+# Duplicate detection: every source gets a 64-bit DCT perceptual hash of a
+# reduced decode (at least PHASH_DECODE_SIZE), kept in HASH_INDEX_PATH.
+# Resized, recompressed or retouched re-exports of a shot land within a few
+# bits of each other, while crops and distinct photos are 10+ bits apart, but
+# so can burst shots be: groups are only reported unless --dedupe merges them.
+PHASH_DECODE_SIZE = (256, 256)
+DEDUPE_MAX_DISTANCE = 6
+
+# Inline placeholders stored in the frontmatter, computed from the thumb
+# variant (or an embedded preview, see preview_variants()) reduced to fit
+# PLACEHOLDER_SAMPLE_SIZE. BLURHASH_COMPONENTS is
+# (x, y) for landscape photos and swapped for portrait ones.
+PLACEHOLDER_SAMPLE_SIZE = (64, 64)
+BLURHASH_COMPONENTS = (4, 3)
+LUMINANCE_HISTOGRAM_BINS = 16
+PLACEHOLDER_KEYS = ('blurhash', 'averageColor', 'dominantColor', 'luminanceHistogram')
+
+# Streaming pipeline (--stream): items waiting between two stages, default
+# memory budget, and how much the decoded pixel buffer (width x height x 4) is
+# scaled by to also cover the resize ladder and encoder buffers.
+STREAM_QUEUE_SIZE = 2
+DEFAULT_MEMORY_BUDGET_MB = 1024
+STREAM_MEMORY_OVERHEAD = 1.5
+
+# Outputs are written to <path>.<pid>.tmp and renamed into place; leftovers
+# of an interrupted run are removed when the next one starts. Next to the
+# manifest and hash index only the pipeline's own files are touched.
+TEMP_FILE_PATTERN = '*.tmp'
+PROJECT_TEMP_FILE_PATTERN = '.photo-*.tmp'
+# Temp files of the conversion path used before the atomic writes
+LEGACY_TEMP_FILE_PATTERN = '*.temp.jpg'
 
-# Ensure directories exist
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-os.makedirs(OPTIMIZED_DIR, exist_ok=True)
+# --watch: a changed photo is processed once its size and mtime have held
+# still for WATCH_SETTLE_SECONDS, so half-copied files are never picked up
+WATCH_SETTLE_SECONDS = 2.0
+WATCH_POLL_INTERVAL = 0.5
+
+# Runtime options set from the command line; worker processes receive them
+# through init_worker() as the pool initializer.
+PIPELINE_OPTIONS: Dict[str, Any] = {
+    'verify_resize': False,
+    'formats': DEFAULT_OUTPUT_FORMATS,
+    'draft': False,
+    'passthrough': True,
+    'previews': True,
+    # None for the fixed qualities above, else {'ssim': ...} or {'bytesPerPixel': ...}
+    'quality_target': None,
+    # Duplicate photo -> the photo whose derivatives it shares, see find_duplicates()
+    'duplicates': {},
+}
 
 # List of EXIF tags to ignore (especially location data)
 EXIF_IGNORE_TAGS = [
@@ -52,220 +182,1173 @@ EXIF_MAPPING = {
     'DateTimeOriginal': 'dateTaken',
 }
 
-def strip_gps_from_exif_bytes(exif_bytes):
+# TIFF tags dropped from the 0th and Exif IFDs of every derivative: the GPS
+# IFD pointer, plus the sub-second and time-offset tags of EXIF_IGNORE_TAGS
+GPS_IFD_TAG = 0x8825
+EXIF_IFD_TAG = 0x8769
+ORIENTATION_TAG = 0x0112
+EXIF_STRIP_TAGS = {
+    GPS_IFD_TAG,
+    0x9010, 0x9011, 0x9012,  # OffsetTime, OffsetTimeOriginal, OffsetTimeDigitized
+    0x9291, 0x9292,  # SubSecTimeOriginal, SubSecTimeDigitized
+}
+# Bytes per value of each TIFF field type
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+
+def rewrite_exif(exif_bytes: bytes, reset_orientation: bool = False) -> bytes:
+    """Strips GPS and time-offset tags by editing the TIFF structure of EXIF bytes in place.
+
+    Works on a single copy of the bytes through a memoryview instead of
+    decoding the whole tag tree: the entries of EXIF_STRIP_TAGS are removed
+    from the IFD0 and Exif IFD entry tables (later entries shift down inside
+    the table, nothing else moves, so every other offset stays valid,
+    MakerNote internals included) and the data they pointed at, the whole
+    GPS IFD with its values, is zeroed. With reset_orientation the IFD0
+    Orientation is set to 1. Raises ValueError on malformed data.
+    """
+    data = bytearray(exif_bytes)
+    view = memoryview(data)
+    base = 6 if data.startswith(b'Exif\x00\x00') else 0
+    order = {b'II': '<', b'MM': '>'}.get(bytes(view[base:base + 2]))
+    if order is None or len(data) < base + 8 or struct.unpack_from(order + 'H', view, base + 2)[0] != 42:
+        raise ValueError("not a TIFF/EXIF block")
+    short = struct.Struct(order + 'H')
+    entry_format = struct.Struct(order + 'HHII')
+
+    def span(offset: int, size: int) -> int:
+        # Absolute position of size bytes at a TIFF offset, bounds-checked
+        if offset < 0 or base + offset + size > len(data):
+            raise ValueError("EXIF offset out of range")
+        return base + offset
+
+    def zero_value(entry: int) -> None:
+        _, field_type, count, value = entry_format.unpack_from(view, entry)
+        size = TIFF_TYPE_SIZES.get(field_type, 1) * count
+        if size > 4:
+            start = span(value, size)
+            view[start:start + size] = bytes(size)
+
+    def zero_ifd(offset: int) -> None:
+        start = span(offset, 2)
+        count = short.unpack_from(view, start)[0]
+        size = 2 + count * 12 + 4
+        span(offset, size)
+        for i in range(count):
+            zero_value(start + 2 + i * 12)
+        view[start:start + size] = bytes(size)
+
+    def edit_ifd(offset: int, is_ifd0: bool) -> Optional[int]:
+        # Returns the Exif IFD offset when editing IFD0
+        start = span(offset, 2)
+        count = short.unpack_from(view, start)[0]
+        span(offset, 2 + count * 12 + 4)
+        exif_ifd = None
+        kept = 0
+        for i in range(count):
+            entry = start + 2 + i * 12
+            tag, field_type, value_count, value = entry_format.unpack_from(view, entry)
+            if tag in EXIF_STRIP_TAGS:
+                if tag == GPS_IFD_TAG:
+                    zero_ifd(value)
+                else:
+                    zero_value(entry)
+                continue
+            if is_ifd0 and tag == EXIF_IFD_TAG:
+                exif_ifd = value
+            elif is_ifd0 and reset_orientation and tag == ORIENTATION_TAG and field_type == 3 and value_count == 1:
+                short.pack_into(view, entry + 8, 1)
+            if kept != i:
+                target = start + 2 + kept * 12
+                view[target:target + 12] = view[entry:entry + 12]
+            kept += 1
+        if kept != count:
+            # IFD0's next-IFD offset (the thumbnail IFD) moves up with the
+            # table, sub-IFDs get 0; the old slot is left alone since piexif
+            # omits it on sub-IFDs and puts value data there instead
+            table_end = start + 2 + count * 12
+            next_ifd = bytes(view[table_end:table_end + 4]) if is_ifd0 else bytes(4)
+            short.pack_into(view, start, kept)
+            view[start + 2 + kept * 12:start + 2 + kept * 12 + 4] = next_ifd
+            view[start + 2 + kept * 12 + 4:table_end] = bytes((count - kept) * 12 - 4)
+        return exif_ifd
+
+    exif_ifd = edit_ifd(struct.unpack_from(order + 'I', view, base + 4)[0], True)
+    if exif_ifd is not None:
+        edit_ifd(exif_ifd, False)
+    view.release()
+    return bytes(data)
+
+def _strip_gps_with_piexif(exif_bytes: bytes, reset_orientation: bool = False) -> bytes:
+    """The piexif load/dump equivalent of rewrite_exif(), for EXIF it cannot parse."""
+    import piexif
+
+    exif_dict = piexif.load(exif_bytes)
+    # Remove GPS IFD
+    exif_dict['GPS'] = {}
+    # Remove GPS-related tags from 0th and Exif IFDs if present
+    for ifd in ['0th', 'Exif']:
+        for tag in [tag for tag in exif_dict[ifd] if tag in EXIF_STRIP_TAGS]:
+            del exif_dict[ifd][tag]
+    if reset_orientation and exif_dict['0th'].get(piexif.ImageIFD.Orientation, 1) != 1:
+        exif_dict['0th'][piexif.ImageIFD.Orientation] = 1
+    return piexif.dump(exif_dict)
+
+def strip_gps_from_exif_bytes(exif_bytes: bytes, reset_orientation: bool = False) -> bytes:
+    """Removes GPS and time-offset data from EXIF bytes, optionally resetting Orientation to 1.
+
+    Uses the in-place TIFF rewriter and falls back to a piexif round trip for
+    EXIF it cannot parse; returns the input unchanged if both fail.
+    """
+    try:
+        return rewrite_exif(exif_bytes, reset_orientation)
+    except (ValueError, struct.error) as e:
+        logger.debug("TIFF rewrite of EXIF failed (%s), falling back to piexif", e)
     try:
-        exif_dict = piexif.load(exif_bytes)
-        # Remove GPS IFD
-        exif_dict['GPS'] = {}
-        # Remove GPS-related tags from 0th and Exif IFDs if present
-        for ifd in ['0th', 'Exif']:
-            tags_to_remove = []
-            for tag, value in exif_dict[ifd].items():
-                tag_name = piexif.TAGS[ifd][tag]["name"] if tag in piexif.TAGS[ifd] else str(tag)
-                if tag_name.startswith('GPS') or tag_name in [
-                    'GPSInfo', 'GPSLatitudeRef', 'GPSLatitude', 'GPSLongitudeRef', 'GPSLongitude',
-                    'GPSAltitudeRef', 'GPSAltitude', 'GPSTimeStamp', 'GPSDateStamp',
-                    'GPSProcessingMethod', 'GPSVersionID', 'SubSecTimeOriginal', 'SubSecTimeDigitized',
-                    'OffsetTime', 'OffsetTimeOriginal', 'OffsetTimeDigitized']:
-                    tags_to_remove.append(tag)
-            for tag in tags_to_remove:
-                del exif_dict[ifd][tag]
-        return piexif.dump(exif_dict)
+        return _strip_gps_with_piexif(exif_bytes, reset_orientation)
     except Exception as e:
-        logger.warning(f"Failed to strip GPS from EXIF: {e}")
+        logger.warning("Failed to strip GPS from EXIF: %s", e)
         return exif_bytes
 
+def peak_rss_mb() -> float:
+    """Returns the peak resident set size of this process in MB (0 where unsupported)."""
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+@contextmanager
+def measure_stage(stats: Optional[Dict[str, Any]], name: str) -> Iterator[Dict[str, Any]]:
+    """Times one pipeline stage and appends its record to stats['stages'].
+
+    The record holds the wall time, the CPU time of the calling thread and the
+    process's peak RSS once the stage is done; the stage itself fills in
+    bytesRead and bytesWritten on the yielded record. With stats=None the
+    record is still filled in but not stored anywhere.
+    """
+    record = {'stage': name, 'bytesRead': 0, 'bytesWritten': 0}
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    try:
+        yield record
+    finally:
+        record['wallSeconds'] = time.perf_counter() - wall_start
+        record['cpuSeconds'] = time.thread_time() - cpu_start
+        record['peakRssMb'] = peak_rss_mb()
+        if stats is not None:
+            stats.setdefault('stages', []).append(record)
+
+def heif_exif_bytes(heif_file, input_path: str) -> Optional[bytes]:
+    """Returns the raw EXIF bytes of an opened HEIF file, or None."""
+    exif_bytes = None
+    if "exif" in heif_file.info and heif_file.info["exif"]:
+        exif_bytes = heif_file.info["exif"]
+        logger.debug("Found EXIF in heif_file.info for %s", input_path)
+    elif hasattr(heif_file, 'metadata'):
+        for metadata in heif_file.metadata:
+            if metadata.get('type') == 'Exif' and metadata.get('data'):
+                exif_bytes = metadata['data']
+                logger.debug("Found EXIF in metadata for %s", input_path)
+                break
+    if not exif_bytes:
+        logger.warning("No EXIF data found in HEIF file %s", input_path)
+    return exif_bytes
+
+def load_heic_image(input_path: str, stats: Optional[Dict[str, Any]] = None) -> Tuple[Optional[Image.Image], Optional[bytes]]:
+    """Decodes a HEIC/HEIF file once into an upright RGB image plus GPS-stripped EXIF bytes.
+
+    The image carries the file's ICC profile in info['icc_profile'], as Pillow
+    does for JPEG and PNG sources.
+
+    libheif applies the container's rotation/mirror transforms while decoding, so
+    the pixels are already upright; the orientation step only has to reset the
+    EXIF Orientation tag to 1 so viewers don't rotate the derivatives again,
+    which it does in the same pass over the EXIF that strips the GPS data.
+    If stats is given the decode and orientation stages are recorded in it.
+    """
+    from PIL import Image
+    import pillow_heif
+
+    try:
+        with measure_stage(stats, 'decode') as stage:
+            stage['bytesRead'] = os.path.getsize(input_path)
+            heif_file = pillow_heif.open_heif(input_path)
+            if not heif_file:
+                logger.error("Could not open HEIF file %s", input_path)
+                return None, None
+            exif_bytes = heif_exif_bytes(heif_file, input_path)
+            # Use only the correct attributes for PIL image construction
+            try:
+                image = Image.frombytes(
+                    heif_file.mode,
+                    heif_file.size,
+                    heif_file.data,
+                    'raw',
+                    heif_file.mode,
+                    heif_file.stride
+                )
+            except Exception as e:
+                logger.error("Failed to create PIL image from HEIF: %s", e)
+                return None, None
+            if image.mode in ('RGBA', 'P'):
+                image = image.convert('RGB')
+            if heif_file.info.get('icc_profile'):
+                image.info['icc_profile'] = heif_file.info['icc_profile']
+
+        # Strip GPS/location data and reset the orientation tag, the decoded
+        # pixels are already upright
+        if exif_bytes:
+            with measure_stage(stats, 'orientation'):
+                exif_bytes = strip_gps_from_exif_bytes(exif_bytes, reset_orientation=True)
+        return image, exif_bytes
+    except Exception as e:
+        logger.error("Failed to decode HEIF file %s: %s", input_path, e)
+        return None, None
+
 def convert_heic_to_jpeg(input_path: str, output_path: str) -> bool:
-    """Converts HEIC file to JPEG while preserving EXIF data (except GPS/location)."""
+    """Converts HEIC file to JPEG while preserving EXIF data (except GPS/location) and the ICC profile."""
+    import piexif
+
     try:
-        heif_file = pillow_heif.open_heif(input_path)
-        if not heif_file:
-            logger.error(f"Could not open HEIF file {input_path}")
+        image, exif_bytes = load_heic_image(input_path)
+        if image is None:
             return False
-        exif_bytes = None
-        if "exif" in heif_file.info:
-            exif_bytes = heif_file.info["exif"]
-            logger.debug(f"Found EXIF in heif_file.info for {input_path}")
-        elif hasattr(heif_file, 'metadata'):
-            for metadata in heif_file.metadata:
-                if metadata.get('type') == 'Exif' and metadata.get('data'):
-                    exif_bytes = metadata['data']
-                    logger.debug(f"Found EXIF in metadata for {input_path}")
-                    break
         if not exif_bytes:
-            logger.warning(f"No EXIF data found in HEIF file {input_path}")
-            return False
-        # Strip GPS/location data
-        exif_bytes = strip_gps_from_exif_bytes(exif_bytes)
-        # Use only the correct attributes for PIL image construction
-        try:
-            image = Image.frombytes(
-                heif_file.mode,
-                heif_file.size,
-                heif_file.data,
-                'raw',
-                heif_file.mode,
-                heif_file.stride
-            )
-        except Exception as e:
-            logger.error(f"Failed to create PIL image from HEIF: {e}")
             return False
-        if image.mode in ('RGBA', 'P'):
-            image = image.convert('RGB')
-
-        # Apply EXIF orientation using ImageOps.exif_transpose
         try:
-            exif_dict = piexif.load(exif_bytes)
-            logger.debug(f"EXIF dictionary after loading for {input_path}: {exif_dict.keys()}")
-            if '0th' in exif_dict and piexif.ImageIFD.Orientation in exif_dict['0th']:
-                orientation = exif_dict['0th'][piexif.ImageIFD.Orientation]
-                logger.debug(f"Original Orientation for {input_path}: {orientation}")
-                logger.debug(f"Image size before rotation: {image.size}")
-
-                image = ImageOps.exif_transpose(image)
-
-                # Reset orientation tag after rotating
-                exif_dict['0th'][piexif.ImageIFD.Orientation] = 1
-                exif_bytes = piexif.dump(exif_dict)
-                logger.debug(f"Image size after rotation: {image.size}")
-                logger.debug(f"Orientation set to 1 for {input_path}")
-        except Exception as e:
-            logger.warning(f"Failed to apply EXIF orientation: {e}")
-
-        try:
-            image.save(output_path, 'JPEG', quality=95, exif=exif_bytes)
-            logger.debug(f"Saved JPEG with EXIF (GPS stripped) for {input_path}")
+            image.save(output_path, 'JPEG', quality=95, exif=exif_bytes, icc_profile=image.info.get('icc_profile'))
+            logger.debug("Saved JPEG with EXIF (GPS stripped) for %s", input_path)
         except Exception as save_error:
-            logger.warning(f"Failed to save with EXIF bytes: {save_error}")
+            logger.warning("Failed to save with EXIF bytes: %s", save_error)
             try:
                 exif_dict = piexif.load(exif_bytes)
                 exif_bytes2 = piexif.dump(exif_dict)
-                image.save(output_path, 'JPEG', quality=95, exif=exif_bytes2)
-                logger.debug(f"Saved JPEG with piexif-processed EXIF (GPS stripped) for {input_path}")
+                image.save(output_path, 'JPEG', quality=95, exif=exif_bytes2,
+                           icc_profile=image.info.get('icc_profile'))
+                logger.debug("Saved JPEG with piexif-processed EXIF (GPS stripped) for %s", input_path)
             except Exception as piexif_error:
-                logger.error(f"Failed to save with piexif: {piexif_error}")
+                logger.error("Failed to save with piexif: %s", piexif_error)
                 return False
         if not verify_exif_preservation(input_path, output_path):
-            logger.error(f"EXIF verification failed after conversion for {input_path}")
+            logger.error("EXIF verification failed after conversion for %s", input_path)
             return False
         return True
     except Exception as e:
-        logger.error(f"Failed to convert HEIC to JPEG {input_path}: {e}")
+        logger.error("Failed to convert HEIC to JPEG %s: %s", input_path, e)
         return False
 
-def optimize_image(input_path: str, output_path: str, max_size: tuple = (1920, 1920)) -> bool:
-    """Optimizes an image for web use while preserving EXIF data (except GPS/location)."""
+def set_pipeline_options(options: Dict[str, Any]) -> None:
+    """Applies runtime options in this process."""
+    PIPELINE_OPTIONS.update(options)
+
+def init_worker(options: Dict[str, Any], log_level: int) -> None:
+    """Pool initializer: applies the parent's runtime options and log level.
+
+    Spawned workers (the default outside Linux) start without the parent's
+    logging configuration, so it is set up again here.
+    """
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
+    set_pipeline_options(options)
+
+def worker_initargs() -> Tuple[Dict[str, Any], int]:
+    """Returns the init_worker() arguments for a pool started from this process."""
+    return dict(PIPELINE_OPTIONS), logging.getLogger().getEffectiveLevel()
+
+def output_formats() -> List[Dict[str, Any]]:
+    """Returns the effective settings of the selected output formats."""
+    formats = []
+    for name in PIPELINE_OPTIONS['formats']:
+        settings = dict(OUTPUT_FORMAT_SETTINGS[name], name=name)
+        if PIPELINE_OPTIONS['draft']:
+            settings['options'] = dict(settings['options'], **DRAFT_FORMAT_OPTIONS.get(name, {}))
+        formats.append(settings)
+    return formats
+
+def fit_size(size: Tuple[int, int], box: Tuple[int, int]) -> Tuple[int, int]:
+    """Returns size scaled down to fit inside box, or unchanged if it already fits."""
+    ratio = min(box[0] / size[0], box[1] / size[1])
+    if ratio < 1:
+        return tuple(int(dim * ratio) for dim in size)
+    return size
+
+_SRGB_TRANSFORMS: Dict[str, Any] = {}
+_SRGB_TRANSFORMS_LOCK = threading.Lock()
+
+def srgb_transform(icc_profile: bytes):
+    """Returns the ImageCms transform from an RGB ICC profile to sRGB, or None if none is needed.
+
+    Building a transform parses the profile and precomputes its lookup
+    tables, so transforms are cached per process by the profile's SHA-256
+    and built once per distinct profile. sRGB profiles and profiles
+    LittleCMS cannot use map to None and the pixels are left as they are.
+    Transforms are built without LittleCMS's one-pixel cache, so one can be
+    applied from several threads at once, and with its high-resolution
+    precalculation, which is also faster to apply to whole images.
+    """
+    key = hashlib.sha256(icc_profile).hexdigest()
+    with _SRGB_TRANSFORMS_LOCK:
+        if key in _SRGB_TRANSFORMS:
+            return _SRGB_TRANSFORMS[key]
+        from PIL import ImageCms
+
+        transform = None
+        try:
+            profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+            description = ImageCms.getProfileDescription(profile).strip()
+            if 'srgb' not in description.lower():
+                transform = ImageCms.buildTransform(
+                    profile, ImageCms.createProfile(OUTPUT_COLOR_SPACE), 'RGB', 'RGB',
+                    renderingIntent=ImageCms.Intent.RELATIVE_COLORIMETRIC,
+                    flags=ImageCms.Flags.NOCACHE | ImageCms.Flags.HIGHRESPRECALC
+                )
+                logger.debug("Built %s to %s color transform", description, OUTPUT_COLOR_SPACE)
+        except (ImageCms.PyCMSError, OSError, ValueError) as e:
+            logger.warning("Ignoring unusable ICC profile %s: %s", key[:12], e)
+        _SRGB_TRANSFORMS[key] = transform
+        return transform
+
+def to_srgb(image: Image.Image, icc_profile: Optional[bytes], stats: Optional[Dict[str, Any]] = None) -> Image.Image:
+    """Converts an RGB image in the color space of icc_profile to sRGB.
+
+    Returns image itself when there is no profile, it is sRGB already or the
+    image is not RGB. The conversion (including building the transform the
+    first time a profile is seen, see srgb_transform()) is recorded as a
+    color stage in stats if given.
+    """
+    if not icc_profile or image.mode != 'RGB':
+        return image
+    from PIL import ImageCms
+
+    with measure_stage(stats, 'color'):
+        transform = srgb_transform(icc_profile)
+        if transform is not None:
+            image = ImageCms.applyTransform(image, transform)
+    return image
+
+def ssim(first: Image.Image, second: Image.Image, window: int = 7) -> float:
+    """Mean structural similarity of two same-sized images, computed on luminance."""
+    import numpy as np
+
+    a = np.asarray(first.convert('L'), dtype=np.float64)
+    b = np.asarray(second.convert('L'), dtype=np.float64)
+    window = min(window, *a.shape)
+
+    def box_mean(x):
+        # Sliding-window mean via an integral image
+        c = np.pad(x, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+        return (c[window:, window:] - c[:-window, window:] - c[window:, :-window] + c[:-window, :-window]) / (window * window)
+
+    mu_a, mu_b = box_mean(a), box_mean(b)
+    var_a = box_mean(a * a) - mu_a * mu_a
+    var_b = box_mean(b * b) - mu_b * mu_b
+    cov = box_mean(a * b) - mu_a * mu_b
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(ssim_map.mean())
+
+_BASE83 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+def _base83(value: int, length: int) -> str:
+    return ''.join(_BASE83[value // 83 ** (length - 1 - i) % 83] for i in range(length))
+
+def placeholder_stats(thumb: Image.Image) -> Dict[str, Any]:
+    """Computes inline placeholder data for the gallery from a thumbnail.
+
+    Returns a BlurHash string, the average color (the BlurHash DC term, i.e.
+    the mean in linear light) and the dominant color (the fullest bin of a
+    16-level-per-channel histogram) as #rrggbb, and the share of pixels in
+    each of LUMINANCE_HISTOGRAM_BINS Rec. 709 luma bins. Everything is
+    vectorized over a copy reduced to PLACEHOLDER_SAMPLE_SIZE, about a
+    millisecond per photo.
+    """
+    import numpy as np
+    from PIL import Image
+
+    sample = thumb if thumb.mode == 'RGB' else thumb.convert('RGB')
+    sample = sample.resize(fit_size(sample.size, PLACEHOLDER_SAMPLE_SIZE), Image.Resampling.BOX)
+    pixels = np.asarray(sample)
+    height, width = pixels.shape[:2]
+
+    # BlurHash: DCT-like basis factors of the image in linear light
+    levels = np.arange(256) / 255.0
+    to_linear = np.where(levels <= 0.04045, levels / 12.92, ((levels + 0.055) / 1.055) ** 2.4)
+    linear = to_linear[pixels]
+    nx, ny = BLURHASH_COMPONENTS if width >= height else BLURHASH_COMPONENTS[::-1]
+    basis_x = np.cos(np.pi * np.outer(np.arange(nx), np.arange(width)) / width)
+    basis_y = np.cos(np.pi * np.outer(np.arange(ny), np.arange(height)) / height)
+    factors = np.einsum('jy,ix,yxc->jic', basis_y, basis_x, linear) * (2.0 / (width * height))
+    factors[0, 0] /= 2
+    factors = factors.reshape(-1, 3)
+
+    def to_srgb(value):
+        value = np.clip(value, 0.0, 1.0)
+        return np.where(value <= 0.0031308, value * 12.92, 1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5
+
+    dc, ac = factors[0], factors[1:]
+    quantised_max = int(max(0, min(82, math.floor(float(np.abs(ac).max()) * 166 - 0.5))))
+    maximum = (quantised_max + 1) / 166
+    r, g, b = to_srgb(dc).astype(int)
+    quantised = np.clip(np.floor(np.sign(ac) * np.sqrt(np.abs(ac / maximum)) * 9 + 9.5), 0, 18).astype(int)
+    blurhash = (_base83((nx - 1) + (ny - 1) * 9, 1) + _base83(quantised_max, 1)
+                + _base83((int(r) << 16) + (int(g) << 8) + int(b), 4)
+                + ''.join(_base83(int(value), 2) for value in quantised @ np.array([19 * 19, 19, 1])))
+
+    flat = pixels.reshape(-1, 3)
+    bins = (flat >> 4).astype(np.int32) @ np.array([256, 16, 1], dtype=np.int32)
+    dominant = flat[bins == np.bincount(bins).argmax()].mean(axis=0).round().astype(int)
+    luma = flat @ np.array([0.2126, 0.7152, 0.0722])
+    histogram = np.bincount((luma * LUMINANCE_HISTOGRAM_BINS / 256).astype(int), minlength=LUMINANCE_HISTOGRAM_BINS)
+    return {
+        'blurhash': blurhash,
+        'averageColor': f"#{int(r):02x}{int(g):02x}{int(b):02x}",
+        'dominantColor': '#{:02x}{:02x}{:02x}'.format(*dominant),
+        'luminanceHistogram': [round(float(share), 3) for share in histogram / len(flat)],
+    }
+
+def resize_ladder(image: Image.Image, sizes: Dict[str, tuple], verify: bool = False,
+                  stats: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Image.Image], Dict[str, Any]]:
+    """Resizes image to every bounding box in sizes using a progressive cascade.
+
+    Only the largest variant is computed from the (reduced) source; every
+    smaller one is resized from the previous result, so the full-resolution
+    image is touched once instead of once per size. With verify=True each
+    cascaded variant is also resized directly from the source, compared by
+    SSIM and replaced if it falls below RESIZE_SSIM_THRESHOLD; the returned
+    stats then include the measured time saved. A source carrying an ICC
+    profile (image.info['icc_profile']) is converted to sRGB once, at the
+    largest variant: the smallest size every variant can still be resized
+    from. Each resize of the cascade and the color conversion are recorded
+    as stages in stats if given.
+    """
+    from PIL import Image
+
+    targets = {name: fit_size(image.size, box) for name, box in sizes.items()}
+    order = sorted(targets, key=lambda name: targets[name][0] * targets[name][1], reverse=True)
+    image.load()  # keep lazy JPEG/PNG decoding out of the resize timings
+    icc_profile = image.info.get('icc_profile')
+
+    start = time.perf_counter()
+    resized = {}
+    current = image
+    for size_name in order:
+        target = targets[size_name]
+        if target != current.size:
+            with measure_stage(stats, f'resize:{size_name}'):
+                if current is image:
+                    factor = int(min(image.size[0] / target[0], image.size[1] / target[1]) / RESIZE_REDUCING_GAP)
+                    if factor >= 2:
+                        current = image.reduce(factor)
+                current = current.resize(target, Image.Resampling.LANCZOS)
+        if not resized:
+            current = to_srgb(current, icc_profile, stats)
+        resized[size_name] = current
+    ladder_stats = {'cascadeSeconds': time.perf_counter() - start}
+
+    if verify:
+        direct_seconds = 0.0
+        scores = {}
+        for size_name in order:
+            if resized[size_name] is image:
+                continue
+            start = time.perf_counter()
+            direct = to_srgb(image.resize(targets[size_name], Image.Resampling.LANCZOS), icc_profile)
+            direct_seconds += time.perf_counter() - start
+            scores[size_name] = ssim(resized[size_name], direct)
+            if scores[size_name] < RESIZE_SSIM_THRESHOLD:
+                logger.warning(
+                    "Cascaded %s variant below SSIM threshold (%.4f), using direct resize",
+                    size_name, scores[size_name]
+                )
+                resized[size_name] = direct
+        ladder_stats['directSeconds'] = direct_seconds
+        ladder_stats['savedSeconds'] = direct_seconds - ladder_stats['cascadeSeconds']
+        ladder_stats['ssim'] = scores
+    return resized, ladder_stats
+
+def derivative_paths(image_filename: str) -> Dict[str, str]:
+    """Maps every derivative of a photo ('thumb.jpg', ..., 'blur.jpg') to its path.
+
+    A duplicate photo's derivatives are those of the photo it duplicates.
+    """
+    image_filename = PIPELINE_OPTIONS['duplicates'].get(image_filename, image_filename)
+    base_path = os.path.join(OPTIMIZED_DIR, os.path.splitext(image_filename)[0])
+    paths = {}
+    for size_name in VARIANT_SIZES:
+        for output_format in output_formats():
+            paths[f"{size_name}.{output_format['ext']}"] = f"{base_path}_{size_name}.{output_format['ext']}"
+    paths['blur.jpg'] = f"{base_path}_blur.jpg"
+    return paths
+
+def stale_derivatives(image_filename: str, rebuild: bool = False) -> List[str]:
+    """Returns the derivatives of a photo that are missing or older than the source.
+
+    rebuild=True returns all of them, for sources whose content or encoder
+    settings changed in a way file mtimes can't show. A duplicate photo has
+    none: its derivatives are regenerated from the photo it duplicates.
+    """
+    if image_filename in PIPELINE_OPTIONS['duplicates']:
+        return []
+    if rebuild:
+        return list(derivative_paths(image_filename))
+    source_mtime = os.path.getmtime(os.path.join(PHOTOGRAPHS_DIR, image_filename))
+    stale = []
+    for variant, path in derivative_paths(image_filename).items():
+        try:
+            if os.path.getmtime(path) < source_mtime:
+                stale.append(variant)
+        except OSError:
+            stale.append(variant)
+    return stale
+
+def requested_sizes(sizes: Dict[str, tuple], variants: Optional[List[str]] = None) -> Dict[str, tuple]:
+    """Returns the entries of sizes needed to produce the given derivatives."""
+    return {
+        size_name: size for size_name, size in sizes.items()
+        if variants is None or any(variant.startswith(size_name + '.') for variant in variants)
+        or (size_name == 'thumb' and 'blur.jpg' in variants)
+    }
+
+def open_for_resize(input_path: str, sizes: Dict[str, tuple]) -> Image.Image:
+    """Opens a non-HEIC source, letting libjpeg decode JPEGs at a reduced scale.
+
+    Camera MPO files (a JPEG primary image followed by e.g. a large preview)
+    decode the same way.
+
+    JPEG DCT scaling decodes straight at 1/2, 1/4 or 1/8 of the full size, which
+    is much cheaper in both time and memory than decoding everything and
+    resizing afterwards. The scale is only chosen while the decoded image
+    stays RESIZE_REDUCING_GAP times larger than the biggest requested variant,
+    the same headroom the resize cascade keeps.
+    """
+    from PIL import Image
+
+    image = Image.open(input_path)
+    if image.format in ('JPEG', 'MPO') and sizes:
+        largest = max((fit_size(image.size, box) for box in sizes.values()), key=lambda size: size[0] * size[1])
+        full_size = image.size
+        requested = (int(largest[0] * RESIZE_REDUCING_GAP), int(largest[1] * RESIZE_REDUCING_GAP))
+        if image.draft(None, requested) is not None and image.size != full_size:
+            logger.debug("Draft decoding %s at %s instead of %s", os.path.basename(input_path), image.size, full_size)
+    return image
+
+_ENCODER_POOL: Optional[ThreadPoolExecutor] = None
+
+def encoder_pool() -> ThreadPoolExecutor:
+    """Returns this process's encoder thread pool, creating it on first use.
+
+    Pillow releases the GIL while encoding, so the formats of a variant are
+    encoded in parallel even inside a single worker process.
+    """
+    global _ENCODER_POOL
+    if _ENCODER_POOL is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _ENCODER_POOL = ThreadPoolExecutor(
+            max_workers=len(OUTPUT_FORMAT_SETTINGS) + 1, thread_name_prefix='encoder'
+        )
+    return _ENCODER_POOL
+
+def search_quality(image: Image.Image, output_format: Dict[str, Any],
+                   exif_bytes: Optional[bytes] = None) -> Tuple[bytes, Dict[str, Any]]:
+    """Encodes image at the quality that meets PIPELINE_OPTIONS['quality_target'], bisecting in memory.
+
+    An 'ssim' target takes the lowest quality whose decoded result reaches
+    that SSIM against image, a 'bytesPerPixel' target the highest quality
+    that fits in that many bytes per pixel. Treating both as monotonic in
+    quality, QUALITY_SEARCH_RANGE takes about seven trial encodes; when no
+    quality meets the target the end of the range closest to it is used.
+    Returns the encoded bytes and the search's quality, encode count and,
+    for SSIM targets, the score reached.
+    """
+    from PIL import Image
+
+    target = PIPELINE_OPTIONS['quality_target']
+    options = dict(output_format['options'])
+    if exif_bytes and output_format.get('exif'):
+        options['exif'] = exif_bytes
+    # Image.save() keeps its options on the image object (encoderinfo), so
+    # the formats of one size encoding concurrently each need their own
+    image = image.copy()
+    trials = {}
+
+    def encode(quality: int) -> bytes:
+        if quality not in trials:
+            buffer = io.BytesIO()
+            image.save(buffer, output_format['format'], **dict(options, quality=quality))
+            trials[quality] = buffer.getvalue()
+        return trials[quality]
+
+    def score(data: bytes) -> float:
+        with Image.open(io.BytesIO(data)) as decoded:
+            return ssim(image, decoded)
+
+    low, high = QUALITY_SEARCH_RANGE
+    best = None
+    if 'ssim' in target:
+        while low <= high:
+            quality = (low + high) // 2
+            reached = score(encode(quality))
+            if reached >= target['ssim']:
+                best, high = (quality, reached), quality - 1
+            else:
+                low = quality + 1
+        quality, reached = best or (QUALITY_SEARCH_RANGE[1], score(encode(QUALITY_SEARCH_RANGE[1])))
+        search = {'quality': quality, 'encodes': len(trials), 'ssim': round(reached, 5)}
+    else:
+        budget = target['bytesPerPixel'] * image.size[0] * image.size[1]
+        while low <= high:
+            quality = (low + high) // 2
+            if len(encode(quality)) <= budget:
+                best, low = quality, quality + 1
+            else:
+                high = quality - 1
+        quality = best or QUALITY_SEARCH_RANGE[0]
+        search = {'quality': quality, 'encodes': len(trials) + (quality not in trials)}
+    return encode(quality), search
+
+def encode_image(image: Image.Image, output_format: Dict[str, Any], exif_bytes: Optional[bytes] = None,
+                 stage_name: str = 'encode') -> Tuple[bytes, Dict[str, Any]]:
+    """Encodes image in memory; returns the encoded bytes and the encode's stage record.
+
+    The record's CPU time is the encoder thread's own, since concurrent encodes
+    share the cores, and its bytesWritten is the encoded size. With a quality
+    target the output formats' variants go through search_quality(), whose
+    stats the record keeps under 'search'.
+    """
+    with measure_stage(None, stage_name) as stage:
+        if PIPELINE_OPTIONS['quality_target'] and output_format.get('name') in OUTPUT_FORMAT_SETTINGS:
+            data, stage['search'] = search_quality(image, output_format, exif_bytes)
+        else:
+            buffer = io.BytesIO()
+            options = dict(output_format['options'])
+            if exif_bytes and output_format.get('exif'):
+                options['exif'] = exif_bytes
+            # Image.save() keeps its options on the image object (encoderinfo), so
+            # the formats of one size encoding concurrently each need their own
+            image.copy().save(buffer, output_format['format'], **options)
+            data = buffer.getvalue()
+        stage['bytesWritten'] = len(data)
+    return data, stage
+
+def decode_source(input_path: str, sizes: Dict[str, tuple],
+                  stats: Optional[Dict[str, Any]] = None) -> Tuple[Optional[Image.Image], Optional[bytes]]:
+    """Decodes a source photo into an upright RGB image plus its GPS-stripped EXIF bytes.
+
+    sizes are the variants that will be resized from it, which lets JPEG
+    sources decode at a reduced scale (see open_for_resize()). The pixels are
+    fully decoded before returning, so the decode stage recorded in stats
+    covers the actual decoding work. JPEG/PNG pixels are rotated by their
+    EXIF Orientation and the tag is reset to 1, as load_heic_image() does, so
+    every derivative (with or without EXIF) displays the same way up and
+    reports its displayed size.
+    """
+    from PIL import ImageOps
+
+    if input_path.lower().endswith(('.heic', '.heif')):
+        # Decode once and resize straight from memory, no intermediate JPEG
+        return load_heic_image(input_path, stats)
+
+    with measure_stage(stats, 'decode') as stage:
+        stage['bytesRead'] = os.path.getsize(input_path)
+        image = open_for_resize(input_path, sizes)
+        image.load()
+        exif_bytes = image.info.get('exif')
+        if image.mode in ('RGBA', 'P'):
+            image = image.convert('RGB')
+    with measure_stage(stats, 'orientation'):
+        ImageOps.exif_transpose(image, in_place=True)
+        if exif_bytes:
+            exif_bytes = strip_gps_from_exif_bytes(exif_bytes, reset_orientation=True)
+    return image, exif_bytes
+
+def _jpeg_image_end(data: bytes, pos: int) -> int:
+    """Returns the offset just past the EOI marker that ends the scans starting at pos."""
+    while True:
+        pos = data.find(b'\xff', pos)
+        if pos < 0 or pos + 1 >= len(data):
+            raise ValueError("JPEG has no EOI marker")
+        marker = data[pos + 1]
+        if marker == 0xD9:
+            return pos + 2
+        if marker == 0xFF:
+            pos += 1
+        elif marker == 0x00 or 0xD0 <= marker <= 0xD7:
+            # Stuffed 0xFF byte or restart marker inside the entropy-coded data
+            pos += 2
+        else:
+            # Tables and further scans of a progressive JPEG
+            if pos + 4 > len(data):
+                raise ValueError("JPEG has no EOI marker")
+            pos += 2 + struct.unpack_from('>H', data, pos + 2)[0]
+
+def rewrap_jpeg(data: bytes, exif_bytes: Optional[bytes] = None) -> bytes:
+    """Rebuilds a JPEG file around its compressed image data without decoding it.
+
+    Keeps what decoders need (tables, frame and scans) plus the JFIF, ICC
+    profile and Adobe colour transform segments, replaces any EXIF with
+    exif_bytes and drops the rest: XMP, IPTC and comments, which can carry
+    location data too, and MPF secondary images stored after EOI. Raises
+    ValueError if data is not a well-formed JPEG.
+    """
+    if not data.startswith(b'\xff\xd8'):
+        raise ValueError("not a JPEG")
+    view = memoryview(data)
+    segments = [view[:2]]
+    exif_index = 1
+    pos = 2
+    while True:
+        if pos + 4 > len(data) or data[pos] != 0xFF:
+            raise ValueError("corrupt JPEG marker")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        end = pos + 2 + struct.unpack_from('>H', data, pos + 2)[0]
+        if marker == 0xDA:
+            segments.append(view[pos:_jpeg_image_end(data, end)])
+            break
+        if 0xE0 <= marker <= 0xEF or marker == 0xFE:
+            payload = view[pos + 4:end]
+            if marker == 0xE0 and payload[:5] == b'JFIF\x00' and len(segments) == 1:
+                segments.append(view[pos:end])
+                exif_index = 2
+            elif (marker == 0xE2 and payload[:12] == b'ICC_PROFILE\x00') or (marker == 0xEE and payload[:5] == b'Adobe'):
+                segments.append(view[pos:end])
+        else:
+            segments.append(view[pos:end])
+        pos = end
+    if exif_bytes:
+        if not exif_bytes.startswith(b'Exif\x00\x00'):
+            exif_bytes = b'Exif\x00\x00' + exif_bytes
+        if len(exif_bytes) + 2 > 0xFFFF:
+            raise ValueError("EXIF too large for an APP1 segment")
+        segments.insert(exif_index, b'\xff\xe1' + struct.pack('>H', len(exif_bytes) + 2) + exif_bytes)
+    return b''.join(segments)
+
+def passthrough_variants(input_path: str, base_path: str, sizes: Dict[str, tuple],
+                         variants: Optional[List[str]] = None,
+                         stats: Optional[Dict[str, Any]] = None) -> Tuple[List[Tuple[str, bytes]], Dict[str, Any]]:
+    """Copies a JPEG source into the JPEG variants whose box it already fits.
+
+    Re-encoding such a source only resaves the same pixels at a lower quality,
+    so when it is an upright RGB or greyscale JPEG already in sRGB (untagged
+    or with an sRGB profile, see srgb_transform()) the variant is the source
+    passed through rewrap_jpeg() with GPS-stripped EXIF instead, provided the
+    copy stays within PASSTHROUGH_MAX_BYTES_PER_PIXEL (and any
+    --target-bytes-per-pixel budget). Returns the (path,
+    bytes) pairs to write and per-derivative stats like encode_variants(),
+    both empty when no variant qualifies; the check is recorded as a
+    passthrough stage in stats if given.
+    """
+    from PIL import Image
+
+    ext = OUTPUT_FORMAT_SETTINGS['jpeg']['ext']
+    candidates = [size_name for size_name in sizes if variants is None or f"{size_name}.{ext}" in variants]
+    if not PIPELINE_OPTIONS['passthrough'] or not candidates or not input_path.lower().endswith(('.jpg', '.jpeg')):
+        return [], {}
     try:
+        with measure_stage(stats, 'passthrough') as stage:
+            with Image.open(input_path) as image:
+                # iPhone JPEGs carrying MPF secondary images open as MPO
+                upright = image.format in ('JPEG', 'MPO') and image.mode in ('RGB', 'L') \
+                    and image.getexif().get(ORIENTATION_TAG, 1) == 1
+                # Wide-gamut sources are converted to sRGB, which a copy can't be
+                icc_profile = image.info.get('icc_profile')
+                upright = upright and (image.mode == 'L' or not icc_profile or srgb_transform(icc_profile) is None)
+                size = image.size
+                exif_bytes = image.info.get('exif')
+            fitting = [size_name for size_name in candidates if fit_size(size, sizes[size_name]) == size]
+            if not upright or not fitting:
+                return [], {}
+            with open(input_path, 'rb') as f:
+                data = f.read()
+            stage['bytesRead'] = len(data)
+            copy = rewrap_jpeg(data, strip_gps_from_exif_bytes(exif_bytes) if exif_bytes else None)
+            max_bytes_per_pixel = min(
+                PASSTHROUGH_MAX_BYTES_PER_PIXEL, (PIPELINE_OPTIONS['quality_target'] or {}).get('bytesPerPixel', 1)
+            )
+            if len(copy) > size[0] * size[1] * max_bytes_per_pixel:
+                logger.debug(
+                    "Not passing %s through: %.2f bytes per pixel",
+                    os.path.basename(input_path), len(copy) / (size[0] * size[1])
+                )
+                return [], {}
+            stage['bytesWritten'] = len(copy) * len(fitting)
+    except (OSError, ValueError, struct.error) as e:
+        logger.debug("Not passing %s through: %s", os.path.basename(input_path), e)
+        return [], {}
+
+    encoded = [(f"{base_path}_{size_name}.{ext}", copy) for size_name in fitting]
+    passthrough_stats = {
+        f"{size_name}.{ext}": {
+            'format': 'JPEG',
+            'width': size[0],
+            'height': size[1],
+            'bytes': len(copy),
+            'seconds': stage['cpuSeconds'] / len(fitting),
+            'passthrough': True,
+        }
+        for size_name in fitting
+    }
+    logger.debug("Passing %s through as %s", os.path.basename(input_path), ', '.join(passthrough_stats))
+    return encoded, passthrough_stats
+
+def load_embedded_preview(input_path: str, stats: Optional[Dict[str, Any]] = None
+                          ) -> Tuple[Optional[Image.Image], Tuple[int, int], Optional[bytes]]:
+    """Decodes the preview image embedded in a source without decoding the source itself.
+
+    HEIC/HEIF files from phones carry a thumbnail image next to the primary
+    one (decoded upright, like load_heic_image()); JPEGs may carry a small
+    JPEG in their EXIF thumbnail IFD, stored unrotated and turned upright by
+    the source's Orientation like the decode_source() pixels. Returns
+    (preview, full_size, exif_bytes) with the upright full size, exif_bytes
+    as decode_source() would return them and the source's ICC profile in
+    preview.info['icc_profile']. preview is None when there is none or
+    its aspect ratio differs from the source's, e.g. a letterboxed EXIF
+    thumbnail. The work is recorded as a preview stage in stats if given.
+    """
+    from PIL import Image
+
+    with measure_stage(stats, 'preview') as stage:
+        preview = None
         if input_path.lower().endswith(('.heic', '.heif')):
-            temp_jpeg = output_path + '.temp.jpg'
-            if not convert_heic_to_jpeg(input_path, temp_jpeg):
-                return False
-            image = Image.open(temp_jpeg)
-            exif_bytes = None
-            try:
+            import pillow_heif
+
+            heif_file = pillow_heif.open_heif(input_path)
+            full_size = heif_file.size
+            icc_profile = heif_file.info.get('icc_profile')
+            exif_bytes = heif_exif_bytes(heif_file, input_path)
+            if exif_bytes:
+                exif_bytes = strip_gps_from_exif_bytes(exif_bytes, reset_orientation=True)
+            primary = heif_file[heif_file.primary_index]
+            if primary.info.get('thumbnails'):
+                preview = primary.get_thumbnail(0).to_pillow()
+        else:
+            with Image.open(input_path) as image:
+                full_size = image.size
+                icc_profile = image.info.get('icc_profile')
                 exif_bytes = image.info.get('exif')
-                if exif_bytes:
-                    exif_bytes = strip_gps_from_exif_bytes(exif_bytes)
-                else:
-                    logger.warning(f"No EXIF data found in temporary JPEG {temp_jpeg}")
-            except Exception as exif_error:
-                logger.warning(f"Failed to extract EXIF from temporary JPEG: {exif_error}")
-            
-            # Generate multiple sizes
-            sizes = {
-                'thumb': (400, 400),
-                'medium': (800, 800),
-                'large': (1200, 1200),
-                'full': max_size
-            }
-            
-            base_path = os.path.splitext(output_path)[0]
-            
-            for size_name, size in sizes.items():
-                # Resize image
-                ratio = min(size[0] / image.size[0], size[1] / image.size[1])
-                if ratio < 1:
-                    new_size = tuple(int(dim * ratio) for dim in image.size)
-                    resized = image.resize(new_size, Image.Resampling.LANCZOS)
-                else:
-                    resized = image
-                
-                # Save JPEG version
-                jpeg_path = f"{base_path}_{size_name}.jpg"
-                if exif_bytes:
-                    resized.save(jpeg_path, 'JPEG', quality=85, optimize=True, exif=exif_bytes)
-                else:
-                    resized.save(jpeg_path, 'JPEG', quality=85, optimize=True)
-                
-                # Save WebP version
-                webp_path = f"{base_path}_{size_name}.webp"
-                resized.save(webp_path, 'WEBP', quality=85, method=6)
-                
-                # Generate blur-up thumbnail
-                if size_name == 'thumb':
-                    blur_path = f"{base_path}_blur.jpg"
-                    blur_size = (20, 20)
-                    blur = resized.resize(blur_size, Image.Resampling.LANCZOS)
-                    blur.save(blur_path, 'JPEG', quality=30)
-            
+                orientation = image.getexif().get(ORIENTATION_TAG, 1)
+            if exif_bytes:
+                import piexif
+
+                try:
+                    thumbnail = piexif.load(exif_bytes).get('thumbnail')
+                except Exception as e:
+                    logger.debug("Could not read the EXIF thumbnail of %s: %s", os.path.basename(input_path), e)
+                    thumbnail = None
+                if thumbnail:
+                    stage['bytesRead'] = len(thumbnail)
+                    preview = Image.open(io.BytesIO(thumbnail))
+                    # Stored unrotated like the main image: turn both upright as decode_source() does
+                    method = {
+                        2: Image.Transpose.FLIP_LEFT_RIGHT, 3: Image.Transpose.ROTATE_180,
+                        4: Image.Transpose.FLIP_TOP_BOTTOM, 5: Image.Transpose.TRANSPOSE,
+                        6: Image.Transpose.ROTATE_270, 7: Image.Transpose.TRANSVERSE, 8: Image.Transpose.ROTATE_90,
+                    }.get(orientation)
+                    if method is not None:
+                        preview = preview.transpose(method)
+                    if orientation in (5, 6, 7, 8):
+                        full_size = (full_size[1], full_size[0])
+                exif_bytes = strip_gps_from_exif_bytes(exif_bytes, reset_orientation=True)
+        if preview is not None:
+            preview.load()
+            if preview.mode != 'RGB':
+                preview = preview.convert('RGB')
+            expected = fit_size(full_size, preview.size)
+            if abs(expected[0] - preview.size[0]) > 1 or abs(expected[1] - preview.size[1]) > 1:
+                logger.debug("Ignoring the %s preview of %s: aspect ratio differs", preview.size,
+                             os.path.basename(input_path))
+                preview = None
+            else:
+                # The preview is in the source's color space, whatever it is tagged with
+                preview.info['icc_profile'] = icc_profile
+    return preview, full_size, exif_bytes
+
+def preview_variants(input_path: str, base_path: str, sizes: Dict[str, tuple],
+                     variants: Optional[List[str]] = None,
+                     stats: Optional[Dict[str, Any]] = None) -> Tuple[List[Tuple[str, bytes]], Dict[str, Any]]:
+    """Encodes the thumb and blur derivatives from the source's embedded preview where it is large enough.
+
+    The thumb variants are resized from the preview when it covers the thumb
+    box; the blur and the placeholder come from that thumb, or from the
+    preview itself when it only covers PLACEHOLDER_SAMPLE_SIZE. This depends
+    only on the source, not on which variants are stale, so a blur-only or
+    thumb-only rebuild matches a full one and never decodes the source. The
+    placeholder is stored in stats['placeholder'] whenever a thumb or blur is
+    requested and the preview is usable. Returns the (path, bytes) pairs to
+    write and per-derivative stats like encode_variants(), both empty when
+    the preview serves no requested variant.
+    """
+    from PIL import Image
+
+    thumb_variants = [f"thumb.{fmt['ext']}" for fmt in output_formats()]
+    wanted = [variant for variant in thumb_variants + ['blur.jpg'] if variants is None or variant in variants]
+    if not PIPELINE_OPTIONS['previews'] or 'thumb' not in sizes or not wanted:
+        return [], {}
+    try:
+        preview, full_size, exif_bytes = load_embedded_preview(input_path, stats)
+    except Exception as e:
+        logger.debug("Could not read the embedded preview of %s: %s", os.path.basename(input_path), e)
+        return [], {}
+    if preview is None:
+        return [], {}
+    sample = fit_size(full_size, PLACEHOLDER_SAMPLE_SIZE)
+    if preview.size[0] < sample[0] or preview.size[1] < sample[1]:
+        return [], {}
+
+    icc_profile = preview.info.get('icc_profile')
+    target = fit_size(full_size, sizes['thumb'])
+    if preview.size[0] >= target[0] and preview.size[1] >= target[1]:
+        if preview.size != target:
+            with measure_stage(stats, 'resize:thumb'):
+                preview = preview.resize(target, Image.Resampling.LANCZOS)
+    else:
+        # Too small for the thumb itself, which is then resized from the full decode
+        wanted = [variant for variant in wanted if variant not in thumb_variants]
+    preview = to_srgb(preview, icc_profile, stats)
+    if stats is not None:
+        with measure_stage(stats, 'placeholder'):
+            stats['placeholder'] = placeholder_stats(preview)
+    if not wanted:
+        return [], {}
+    logger.debug("Using the embedded %s preview of %s for %s", preview.size, os.path.basename(input_path),
+                 ', '.join(wanted))
+    return encode_variants({'thumb': preview}, exif_bytes, base_path, wanted, stats)
+
+def encode_variants(resized_images: Dict[str, Image.Image], exif_bytes: Optional[bytes], base_path: str,
+                    variants: Optional[List[str]] = None,
+                    stats: Optional[Dict[str, Any]] = None) -> Tuple[List[Tuple[str, bytes]], Dict[str, Any]]:
+    """Encodes the requested derivatives of an already resized ladder (all by default).
+
+    Every format of every size is encoded concurrently on the encoder pool.
+    Returns the (path, bytes) pairs to write and, per derivative, the format,
+    dimensions, encoded bytes and encode CPU time, plus the chosen quality and
+    the number of trial encodes with a quality target. Each encode is
+    recorded as a stage in stats if given.
+    """
+    from PIL import Image
+
+    jobs = []
+    for size_name, resized in resized_images.items():
+        for output_format in output_formats():
+            variant = f"{size_name}.{output_format['ext']}"
+            if variants is None or variant in variants:
+                jobs.append((variant, f"{base_path}_{size_name}.{output_format['ext']}", resized, output_format))
+        
+        # Generate blur-up thumbnail
+        if size_name == 'thumb' and (variants is None or 'blur.jpg' in variants):
+            blur = resized.resize(BLUR_SIZE, Image.Resampling.LANCZOS)
+            jobs.append(('blur.jpg', f"{base_path}_blur.jpg", blur, BLUR_FORMAT))
+
+    pool = encoder_pool()
+    futures = [(variant, path, img, output_format,
+                pool.submit(encode_image, img, output_format, exif_bytes, f'encode:{variant}'))
+               for variant, path, img, output_format in jobs]
+    encoded = []
+    encode_stats = {}
+    for variant, path, img, output_format, future in futures:
+        data, stage = future.result()
+        encoded.append((path, data))
+        encode_stats[variant] = {
+            'format': output_format['format'],
+            'width': img.size[0],
+            'height': img.size[1],
+            'bytes': len(data),
+            'seconds': stage['cpuSeconds'],
+        }
+        if 'search' in stage:
+            encode_stats[variant]['quality'] = stage['search']['quality']
+            encode_stats[variant]['searchEncodes'] = stage['search']['encodes']
+        if stats is not None:
+            stats.setdefault('stages', []).append(stage)
+    return encoded, encode_stats
+
+def write_files_atomically(files: List[Tuple[str, bytes]], stats: Optional[Dict[str, Any]] = None) -> int:
+    """Replaces a group of files together, skipping those that already hold exactly their bytes.
+
+    Every changed file is written to a temp name next to it first and only
+    once all of them are complete are they renamed into place, so an error
+    or crash part-way leaves the previous set intact (plus temp files that
+    the next run removes, see TEMP_FILE_PATTERN). Unchanged files keep their
+    mtime. Returns the number of files written; recorded as one write stage
+    in stats if given.
+    """
+    with measure_stage(stats, 'write') as stage:
+        staged = []
+        try:
+            for path, data in files:
+                try:
+                    with open(path, 'rb') as f:
+                        if f.read() == data:
+                            continue
+                except FileNotFoundError:
+                    pass
+                # Per-process temp name: workers sharing a stem may write the same output
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                staged.append((temp_path, path))
+                stage['bytesWritten'] += len(data)
+        except Exception:
+            for temp_path, _ in staged:
+                os.remove(temp_path)
+            raise
+        for temp_path, path in staged:
+            os.replace(temp_path, path)
+    return len(staged)
+
+def write_file_if_changed(path: str, data: bytes) -> bool:
+    """Atomically replaces path with data unless it already holds exactly those bytes.
+
+    Returns whether the file was written; an unchanged file keeps its mtime.
+    """
+    return write_files_atomically([(path, data)]) == 1
+
+class OutputWriter:
+    """Writes groups of files on a background thread, in the order they were submitted.
+
+    Each group goes through write_files_atomically(), so compute carries on
+    with the next step while a photo's derivatives land on disk. Once a group
+    fails, the groups queued behind it fail with the same error until flush()
+    has reported it, so nothing written later can refer to the lost files.
+    At most maxsize groups wait in the queue; submit() blocks beyond that.
+    """
+
+    def __init__(self, maxsize: int = STREAM_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._pending = []
+        self._error = None
+        self.pid = os.getpid()
+        threading.Thread(target=self._run, name='writer', daemon=True).start()
+
+    def _run(self) -> None:
+        while True:
+            files, stats, future = self._queue.get()
+            if self._error is not None:
+                future.set_exception(self._error)
+                continue
             try:
-                os.remove(temp_jpeg)
+                future.set_result(write_files_atomically(files, stats))
             except Exception as e:
-                logger.warning(f"Failed to remove temporary file {temp_jpeg}: {e}")
-            
-            return True
-        else:
-            image = Image.open(input_path)
-            exif_bytes = image.info.get('exif')
-            if exif_bytes:
-                exif_bytes = strip_gps_from_exif_bytes(exif_bytes)
-            if image.mode in ('RGBA', 'P'):
-                image = image.convert('RGB')
-            
+                self._error = e
+                future.set_exception(e)
+
+    def submit(self, files: List[Tuple[str, bytes]], stats: Optional[Dict[str, Any]] = None) -> Future:
+        """Queues a group of (path, bytes) to be written together; returns its future."""
+        from concurrent.futures import Future
+
+        future = Future()
+        self._pending.append(future)
+        self._queue.put((files, stats, future))
+        return future
+
+    def flush(self) -> None:
+        """Waits until every submitted group is written; raises the first write error, if any."""
+        pending, self._pending = self._pending, []
+        errors = []
+        for future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+        self._error = None
+        if errors:
+            raise errors[0]
+
+_OUTPUT_WRITER: Optional[OutputWriter] = None
+
+def output_writer() -> OutputWriter:
+    """Returns this process's output writer, creating it on first use.
+
+    Keyed by process id: a forked worker does not inherit the parent's thread.
+    """
+    global _OUTPUT_WRITER
+    if _OUTPUT_WRITER is None or _OUTPUT_WRITER.pid != os.getpid():
+        _OUTPUT_WRITER = OutputWriter()
+    return _OUTPUT_WRITER
+
+def write_variants(encoded: List[Tuple[str, bytes]], stats: Optional[Dict[str, Any]] = None) -> Future:
+    """Queues a photo's encoded derivatives on the output writer as one group.
+
+    Returns the group's future; the write stage lands in stats once it is
+    done. The encoders are deterministic, so a rebuild with unchanged inputs
+    leaves every derivative (and its mtime) untouched.
+    """
+    return output_writer().submit(encoded, stats)
+
+def log_resize_stats(input_path: str, resize_stats: Dict[str, Any]) -> None:
+    """Logs the resize cascade timings of a photo, against direct resizes under --verify-resize."""
+    if 'savedSeconds' in resize_stats:
+        logger.info(
+            "Resize cascade for %s: %.3fs vs %.3fs direct, saved %.3fs",
+            os.path.basename(input_path), resize_stats['cascadeSeconds'], resize_stats['directSeconds'],
+            resize_stats['savedSeconds']
+        )
+    else:
+        logger.info("Resize cascade for %s: %.3fs", os.path.basename(input_path), resize_stats['cascadeSeconds'])
+
+def optimize_image(input_path: str, output_path: str, max_size: tuple = VARIANT_SIZES['full'],
+                   variants: Optional[List[str]] = None, stats: Optional[Dict[str, Any]] = None) -> bool:
+    """Optimizes an image for web use while preserving EXIF data (except GPS/location).
+
+    variants limits the work to a subset of derivative_paths() keys, e.g. the
+    ones reported by stale_derivatives(); by default every derivative is written.
+    JPEG variants the source can be copied into (see passthrough_variants())
+    are, and the source is only decoded if any other variant is needed.
+    If stats is given it receives the resize stats under 'resize', the
+    per-derivative encode stats under 'encode', a record per stage under
+    'stages' (see measure_stage()) and, when the thumb is regenerated, its
+    placeholder_stats() under 'placeholder'. The derivatives are queued on
+    the output writer as one group (see write_variants()); flush it before
+    relying on them being on disk.
+    """
+    try:
+        all_sizes = dict(VARIANT_SIZES, full=max_size)
+        base_path = os.path.splitext(output_path)[0]
+        encoded, encode_stats = passthrough_variants(input_path, base_path, all_sizes, variants, stats)
+        if variants is None:
+            variants = list(derivative_paths(os.path.basename(input_path)))
+        variants = [variant for variant in variants if variant not in encode_stats]
+        previewed, preview_stats = preview_variants(input_path, base_path, all_sizes, variants, stats)
+        encoded.extend(previewed)
+        encode_stats.update(preview_stats)
+        variants = [variant for variant in variants if variant not in preview_stats]
+
+        resize_stats = None
+        if variants:
             # Generate multiple sizes
-            sizes = {
-                'thumb': (400, 400),
-                'medium': (800, 800),
-                'large': (1200, 1200),
-                'full': max_size
-            }
-            
-            base_path = os.path.splitext(output_path)[0]
-            
-            for size_name, size in sizes.items():
-                # Resize image
-                ratio = min(size[0] / image.size[0], size[1] / image.size[1])
-                if ratio < 1:
-                    new_size = tuple(int(dim * ratio) for dim in image.size)
-                    resized = image.resize(new_size, Image.Resampling.LANCZOS)
-                else:
-                    resized = image
-                
-                # Save JPEG version
-                jpeg_path = f"{base_path}_{size_name}.jpg"
-                if exif_bytes:
-                    resized.save(jpeg_path, 'JPEG', quality=85, optimize=True, exif=exif_bytes)
-                else:
-                    resized.save(jpeg_path, 'JPEG', quality=85, optimize=True)
-                
-                # Save WebP version
-                webp_path = f"{base_path}_{size_name}.webp"
-                resized.save(webp_path, 'WEBP', quality=85, method=6)
-                
-                # Generate blur-up thumbnail
-                if size_name == 'thumb':
-                    blur_path = f"{base_path}_blur.jpg"
-                    blur_size = (20, 20)
-                    blur = resized.resize(blur_size, Image.Resampling.LANCZOS)
-                    blur.save(blur_path, 'JPEG', quality=30)
-            
-            return True
+            sizes = requested_sizes(all_sizes, variants)
+            image, exif_bytes = decode_source(input_path, sizes, stats)
+            if image is None:
+                return False
+            resized_images, resize_stats = resize_ladder(
+                image, sizes, verify=PIPELINE_OPTIONS['verify_resize'], stats=stats
+            )
+            # Let the full-resolution decode go before the encoders allocate their buffers
+            image = None
+            if stats is not None and 'thumb' in resized_images and 'placeholder' not in stats:
+                with measure_stage(stats, 'placeholder'):
+                    stats['placeholder'] = placeholder_stats(resized_images['thumb'])
+            reencoded, reencode_stats = encode_variants(resized_images, exif_bytes, base_path, variants, stats)
+            resized_images = None
+            encoded.extend(reencoded)
+            encode_stats.update(reencode_stats)
+        write_variants(encoded, stats)
+
+        if stats is not None:
+            stats['encode'] = encode_stats
+            if resize_stats is not None:
+                stats['resize'] = resize_stats
+        if resize_stats is not None:
+            log_resize_stats(input_path, resize_stats)
+        return True
     except Exception as e:
-        logger.error(f"Failed to optimize {input_path}: {e}")
+        logger.error("Failed to optimize %s: %s", input_path, e)
         return False
 
 def _convert_rational(value, as_fraction_string: bool = False) -> Any:
     """Helper to convert rational numbers (tuples or IFDRational) to float or fraction string."""
+    from PIL.TiffImagePlugin import IFDRational
+
     if isinstance(value, IFDRational):
         try:
             value = (value.numerator, value.denominator)
@@ -292,6 +1375,8 @@ def _convert_rational(value, as_fraction_string: bool = False) -> Any:
 
 def convert_exif_value(key: str, value: Any) -> Any:
     """Converts EXIF values to more readable/storable formats."""
+    from PIL.TiffImagePlugin import IFDRational
+
     if isinstance(value, bytes):
         try:
             return value.decode('utf-8')
@@ -306,60 +1391,96 @@ def convert_exif_value(key: str, value: Any) -> Any:
         return _convert_rational(value, as_fraction_string=False)
     return value
 
+# Parsed EXIF per (path, size, mtime), shared by every consumer in this process
+_EXIF_CACHE: Dict[Tuple[str, int, int], Dict[str, Any]] = {}
+EXIF_CACHE_STATS = {'hits': 0, 'misses': 0}
+_EXIF_CACHE_LOCK = threading.Lock()
+
 def extract_exif(image_path: str) -> Dict[str, Any]:
+    """Extracts and cleans EXIF data from an image, parsing each file only once.
+
+    Results are memoized by path, size and mtime, so process_image,
+    generate_markdown_file and verify_exif_preservation all share one parse
+    per file without reading it just to key the cache; a file rewritten in
+    place gets a new mtime and is parsed again.
+    """
+    try:
+        stat = os.stat(image_path)
+    except OSError as e:
+        logger.error("Error extracting EXIF from %s: %s", image_path, e)
+        return {}
+    key = (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+    with _EXIF_CACHE_LOCK:
+        if key in _EXIF_CACHE:
+            EXIF_CACHE_STATS['hits'] += 1
+        else:
+            EXIF_CACHE_STATS['misses'] += 1
+            _EXIF_CACHE[key] = _read_exif(image_path)
+        return dict(_EXIF_CACHE[key])
+
+def _read_exif(image_path: str) -> Dict[str, Any]:
     """Extracts and cleans EXIF data from an image."""
+    from PIL import ExifTags, Image
+    import pillow_heif
+    import piexif
+
     try:
         exif_data_raw = {}
         if image_path.lower().endswith(('.heic', '.heif')):
             try:
                 heif_file = pillow_heif.open_heif(image_path)
                 if heif_file:
-                    logger.debug(f"HEIF file opened for {image_path}")
+                    logger.debug("HEIF file opened for %s", image_path)
                     # First try heif_file.info["exif"]
                     exif_bytes = heif_file.info.get("exif")
                     if exif_bytes:
-                        logger.debug(f"Found EXIF in heif_file.info['exif'] for {image_path}")
+                        logger.debug("Found EXIF in heif_file.info['exif'] for %s", image_path)
                         try:
                             loaded_exif = piexif.load(exif_bytes)
                             if loaded_exif is not None:
                                 exif_data_raw = loaded_exif
                             else:
-                                logger.warning(f"piexif.load returned None or empty for {image_path}.")
+                                logger.warning("piexif.load returned None or empty for %s.", image_path)
                                 exif_data_raw = {}
                         except Exception as exif_e:
-                            logger.warning(f"piexif.load failed for {image_path}: {exif_e}")
+                            logger.warning("piexif.load failed for %s: %s", image_path, exif_e)
                             exif_data_raw = {}
                     # If that fails, try heif_file.metadata
                     elif hasattr(heif_file, 'metadata') and heif_file.metadata:
-                        logger.debug(f"Checking heif_file.metadata for {image_path}")
+                        logger.debug("Checking heif_file.metadata for %s", image_path)
                         for metadata in heif_file.metadata:
                             if metadata.get('type') == 'Exif' and metadata.get('data'):
-                                logger.debug(f"Found EXIF in metadata for {image_path}")
+                                logger.debug("Found EXIF in metadata for %s", image_path)
                                 try:
                                     loaded_exif = piexif.load(metadata['data'])
                                     if loaded_exif is not None:
                                         exif_data_raw = loaded_exif
                                     else:
-                                        logger.warning(f"piexif.load returned None or empty for {image_path} (metadata).")
+                                        logger.warning(
+                                            "piexif.load returned None or empty for %s (metadata).",
+                                            image_path
+                                        )
                                         exif_data_raw = {}
                                 except Exception as exif_e:
-                                    logger.warning(f"piexif.load failed for {image_path} (metadata): {exif_e}")
+                                    logger.warning("piexif.load failed for %s (metadata): %s", image_path, exif_e)
                                     exif_data_raw = {}
                                 break
                     if not exif_data_raw:
-                        logger.warning(f"No valid EXIF data found in HEIF file {image_path}")
+                        logger.warning("No valid EXIF data found in HEIF file %s", image_path)
                         return {}
                 else:
-                    logger.warning(f"Could not open HEIF file {image_path}")
+                    logger.warning("Could not open HEIF file %s", image_path)
                     return {}
             except Exception as heif_e:
-                logger.error(f"Error processing HEIF file {image_path}: {heif_e}")
+                logger.error("Error processing HEIF file %s: %s", image_path, heif_e)
                 return {}
         else:
-            img = Image.open(image_path)
-            exif_data_raw = img._getexif()
+            # Image.open only parses the headers; the EXIF block is read without
+            # decoding any pixel data and the file is closed straight away
+            with Image.open(image_path) as img:
+                exif_data_raw = img._getexif() if hasattr(img, '_getexif') else None
             if exif_data_raw is None:
-                logger.warning(f"_getexif() returned None for {image_path}")
+                logger.warning("_getexif() returned None for %s", image_path)
                 return {}
 
         if not exif_data_raw:
@@ -391,7 +1512,7 @@ def extract_exif(image_path: str) -> Dict[str, Any]:
                 # Special handling for DateTimeOriginal
                 if exif_key == 'DateTimeOriginal':
                     dt_str = value
-                    logger.debug(f"Raw DateTimeOriginal: {dt_str}")
+                    logger.debug("Raw DateTimeOriginal: %s", dt_str)
                     if isinstance(dt_str, bytes):
                         dt_str = dt_str.decode('utf-8')
                     try:
@@ -403,7 +1524,10 @@ def extract_exif(image_path: str) -> Dict[str, Any]:
                         processed_value = dt_obj.isoformat(timespec='seconds') + 'Z'
                         processed_exif[field_name] = processed_value
                     except ValueError:
-                        logger.warning(f"Could not parse DateTimeOriginal '{dt_str}' from {image_path}. Trying fallback.")
+                        logger.warning(
+                            "Could not parse DateTimeOriginal '%s' from %s. Trying fallback.",
+                            dt_str, image_path
+                        )
                         # Try fallback to DateTime if available
                         if 'DateTime' in exif:
                             dt_str = exif['DateTime']
@@ -414,7 +1538,10 @@ def extract_exif(image_path: str) -> Dict[str, Any]:
                                 processed_value = dt_obj.isoformat(timespec='seconds') + 'Z'
                                 processed_exif[field_name] = processed_value
                             except ValueError:
-                                logger.warning(f"Could not parse DateTime fallback '{dt_str}' from {image_path}. Using file modification time.")
+                                logger.warning(
+                                    "Could not parse DateTime fallback '%s' from %s. Using file modification time.",
+                                    dt_str, image_path
+                                )
                                 # Use file modification time as last resort
                                 file_time = datetime.fromtimestamp(os.path.getmtime(image_path))
                                 processed_value = file_time.isoformat(timespec='seconds') + 'Z'
@@ -425,42 +1552,194 @@ def extract_exif(image_path: str) -> Dict[str, Any]:
 
         return processed_exif
     except Exception as e:
-        logger.error(f"Error extracting EXIF from {image_path}: {e}")
+        logger.error("Error extracting EXIF from %s: %s", image_path, e)
         return {}
 
+# Parsed frontmatter by markdown path, with the (size, mtime_ns) it was read at
+_FRONTMATTER_CACHE: Dict[str, Tuple[Tuple[int, int], Optional[Dict[str, Any]]]] = {}
+
+def parse_frontmatter(content: str) -> Optional[Dict[str, Any]]:
+    """Returns the YAML frontmatter of a markdown document, or None if it has none."""
+    import yaml
+
+    if '---' not in content:
+        return None
+    _, frontmatter, _ = content.split('---', 2)
+    # libyaml's C loader is several times faster; PyYAML builds without it fall back
+    return yaml.load(frontmatter, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+def render_frontmatter(frontmatter: Dict[str, Any]) -> str:
+    """Renders frontmatter as a markdown document, keeping the key order."""
+    import yaml
+
+    # The C dumper renders the same bytes as the pure-Python one, faster
+    yaml_content = yaml.dump(frontmatter, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper), sort_keys=False,
+                             default_flow_style=False, allow_unicode=True)
+    return f"---\n{yaml_content}---\n"
+
+def preload_frontmatter(directory: Optional[str] = None) -> int:
+    """Parses every markdown file in directory (OUTPUT_DIR by default) in one pass.
+
+    Later read_existing_markdown() calls are served from memory as long as
+    the file's size and mtime still match. Run before the worker pool starts,
+    forked workers inherit the parsed frontmatter. Returns the number of
+    files loaded.
+    """
+    directory = directory or OUTPUT_DIR
+    loaded = 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.endswith('.md'):
+                continue
+            try:
+                stat = entry.stat()
+                with open(entry.path, 'r', encoding='utf-8') as f:
+                    frontmatter = parse_frontmatter(f.read())
+            except Exception as e:
+                logger.warning("Could not read existing markdown %s: %s", entry.path, e)
+                continue
+            _FRONTMATTER_CACHE[entry.path] = ((stat.st_size, stat.st_mtime_ns), frontmatter)
+            loaded += 1
+    return loaded
+
 def read_existing_markdown(md_path: str) -> Optional[Dict[str, Any]]:
     """Reads existing markdown file to preserve manual edits."""
     try:
+        stat = os.stat(md_path)
+        cached = _FRONTMATTER_CACHE.get(md_path)
+        if cached and cached[0] == (stat.st_size, stat.st_mtime_ns):
+            return dict(cached[1]) if cached[1] is not None else None
         with open(md_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-            if '---' in content:
-                _, frontmatter, _ = content.split('---', 2)
-                return yaml.safe_load(frontmatter)
+            return parse_frontmatter(f.read())
     except Exception as e:
-        logger.warning(f"Could not read existing markdown {md_path}: {e}")
+        logger.warning("Could not read existing markdown %s: %s", md_path, e)
     return None
 
-def generate_markdown_file(image_filename: str, exif_data: Dict[str, Any], force_update: bool = False) -> None:
-    """Generates a Markdown file with YAML frontmatter."""
+def thumb_placeholder(image_filename: str, existing_data: Optional[Dict[str, Any]],
+                      stats: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Returns a photo's placeholder frontmatter fields.
+
+    Prefers the ones computed from a freshly resized thumb (stats['placeholder']),
+    then those already in the markdown, and only then decodes the thumb
+    variant on disk. Duplicate photos always use the shared thumb, which
+    may have been regenerated since their markdown was written.
+    """
+    from PIL import Image
+
+    if stats and stats.get('placeholder'):
+        return stats['placeholder']
+    if image_filename in PIPELINE_OPTIONS['duplicates']:
+        existing_data = None
+    if existing_data and all(key in existing_data for key in PLACEHOLDER_KEYS):
+        return {key: existing_data[key] for key in PLACEHOLDER_KEYS}
+    thumb_path = derivative_paths(image_filename)['thumb.jpg']
+    if not os.path.exists(thumb_path):
+        return {}
+    try:
+        with Image.open(thumb_path) as thumb:
+            return placeholder_stats(thumb)
+    except Exception as e:
+        logger.warning("Could not compute placeholder for %s: %s", image_filename, e)
+        return {}
+
+def variant_list(image_filename: str, encode_stats: Optional[Dict[str, Any]],
+                 existing_variants: Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Lists a photo's responsive variants (src, format, width, height, bytes) for srcset/<picture>.
+
+    Entries come from the encode stats of the derivatives written in this
+    run, then from the list already in the markdown; only derivatives in
+    neither (e.g. when upgrading from a version without the list) have
+    their dimensions read from the file header. Ordered by format, then
+    from the smallest size up; the blur placeholder is not a variant.
+    """
+    from PIL import Image
+
+    existing = {variant.get('src'): variant for variant in existing_variants or [] if isinstance(variant, dict)}
+    paths = derivative_paths(image_filename)
+    variants = []
+    for output_format in output_formats():
+        for size_name in VARIANT_SIZES:
+            key = f"{size_name}.{output_format['ext']}"
+            path = paths[key]
+            src = public_url(path)
+            fresh = (encode_stats or {}).get(key)
+            if fresh:
+                variant = {'width': fresh['width'], 'height': fresh['height'], 'bytes': fresh['bytes']}
+            elif src in existing:
+                variant = {name: existing[src].get(name) for name in ('width', 'height', 'bytes')}
+            else:
+                try:
+                    with Image.open(path) as img:
+                        variant = {'width': img.size[0], 'height': img.size[1], 'bytes': os.path.getsize(path)}
+                except Exception as e:
+                    logger.warning("Could not read variant %s: %s", path, e)
+                    continue
+            variants.append(dict({'src': src, 'format': output_format['name']}, **variant))
+    return variants
+
+def generate_markdown_file(image_filename: str, exif_data: Dict[str, Any], force_update: bool = False,
+                           stats: Optional[Dict[str, Any]] = None, rebuild: bool = False,
+                           optimized: Iterable[str] = ()) -> None:
+    """Generates a Markdown file with YAML frontmatter.
+
+    Stale derivatives are regenerated first (all of them with rebuild, see
+    stale_derivatives()), except those in optimized, which the caller has
+    just produced (an unchanged one keeps its old mtime and would look
+    stale), passing stats on to optimize_image(), and a
+    failure raises RuntimeError before any markdown is written; the
+    frontmatter is prepared while they are written in the background and the
+    markdown is written once they have landed, recorded as a stage in stats
+    too. The frontmatter carries the
+    thumb's placeholder data (see thumb_placeholder()) and the list of
+    responsive variants (see variant_list()).
+    """
     md_filename = os.path.splitext(image_filename)[0] + '.md'
     output_path = os.path.join(OUTPUT_DIR, md_filename)
     
-    # Get optimized image path
-    optimized_filename = os.path.splitext(image_filename)[0] + '.jpg'
+    # Get optimized image path, shared with the photo this one duplicates
+    canonical_filename = PIPELINE_OPTIONS['duplicates'].get(image_filename, image_filename)
+    optimized_filename = os.path.splitext(canonical_filename)[0] + '.jpg'
     optimized_path = os.path.join(OPTIMIZED_DIR, optimized_filename)
     image_path_for_md = f"/photographs/optimized/{optimized_filename}"
+    full_variant_path = derivative_paths(image_filename)['full.jpg']
 
     # Read existing markdown if it exists
     existing_data = read_existing_markdown(output_path) if not force_update else None
 
-    # Extract EXIF data from the optimized image if it exists, otherwise from original
-    if os.path.exists(optimized_path):
-        exif_data = extract_exif(optimized_path)
-        logger.debug(f"EXIF data from optimized image: {exif_data}")
+    # Optimize image if any derivative is missing or older than the source;
+    # first, so the frontmatter can carry the fresh thumb's placeholder
+    optimized = set(optimized)
+    stale = [variant for variant in stale_derivatives(image_filename, rebuild) if variant not in optimized]
+    if stale:
+        input_path = os.path.join(PHOTOGRAPHS_DIR, image_filename)
+        if not optimize_image(input_path, optimized_path, variants=stale, stats=stats):
+            # No markdown without derivatives; the photo fails and is retried next run
+            raise RuntimeError(f"Failed to optimize {input_path}")
+        logger.info("Optimized: %s (%s)", image_filename, ', '.join(stale))
+    placeholder = thumb_placeholder(image_filename, existing_data, stats)
+    if canonical_filename != image_filename:
+        # A duplicate lists the variants its canonical photo's markdown has
+        canonical_md = os.path.join(OUTPUT_DIR, os.path.splitext(canonical_filename)[0] + '.md')
+        variant_source = read_existing_markdown(canonical_md)
+    else:
+        variant_source = existing_data
+    variants = variant_list(
+        image_filename, (stats or {}).get('encode'), variant_source.get('variants') if variant_source else None
+    )
+
+    # Use the EXIF the caller already extracted; otherwise read it from the
+    # optimized image if it exists, falling back to the original. A
+    # duplicate's derivatives carry the EXIF of the photo it duplicates.
+    if exif_data:
+        logger.debug("EXIF data from caller: %s", exif_data)
+    elif canonical_filename == image_filename and os.path.exists(full_variant_path):
+        output_writer().flush()
+        exif_data = extract_exif(full_variant_path)
+        logger.debug("EXIF data from optimized image: %s", exif_data)
     else:
         original_image_path = os.path.join(PHOTOGRAPHS_DIR, image_filename)
         exif_data = extract_exif(original_image_path)
-        logger.debug(f"EXIF data from original image: {exif_data}")
+        logger.debug("EXIF data from original image: %s", exif_data)
 
     # Prepare frontmatter
     frontmatter = {
@@ -469,13 +1748,15 @@ def generate_markdown_file(image_filename: str, exif_data: Dict[str, Any], force
         'year': int(exif_data['dateTaken'][:4]) if 'dateTaken' in exif_data and exif_data['dateTaken'] else None,
         'dateTaken': exif_data.get('dateTaken'),
         'image': image_path_for_md,
-        'defaultBackgroundColor': 'black',
+        'defaultBackgroundColor': placeholder.get('averageColor', 'black'),
     }
     
     # Add extracted EXIF data, preserving manual edits
     for key, value in exif_data.items():
         if key not in ['title', 'description', 'image', 'defaultBackgroundColor', 'dateTaken']:
             frontmatter[key] = value
+    frontmatter.update(placeholder)
+    frontmatter['variants'] = variants
 
     # Sort keys for cleaner YAML
     frontmatter_sorted = {k: frontmatter[k] for k in sorted(frontmatter.keys(), 
@@ -486,22 +1767,17 @@ def generate_markdown_file(image_filename: str, exif_data: Dict[str, Any], force
     # Remove None values
     final_frontmatter = {k: v for k, v in frontmatter_sorted.items() if v is not None}
 
-    # Generate markdown content
-    yaml_content = yaml.dump(final_frontmatter, sort_keys=False, default_flow_style=False, allow_unicode=True)
-    markdown_content = f"---\n{yaml_content}---\n"
-
-    # Write markdown file
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(markdown_content)
-    logger.info(f"Generated: {output_path}")
-
-    # Optimize image if needed
-    if not os.path.exists(optimized_path):
-        input_path = os.path.join(PHOTOGRAPHS_DIR, image_filename)
-        if optimize_image(input_path, optimized_path):
-            logger.info(f"Optimized: {optimized_path}")
+    # The markdown lands only after the derivatives it lists, and not at all if they failed
+    output_writer().flush()
+    with measure_stage(stats, 'markdown') as stage:
+        # Skip the write when nothing changed so the mtime (and the site's build cache) survives
+        data = render_frontmatter(final_frontmatter).encode('utf-8')
+        if write_file_if_changed(output_path, data):
+            stage['bytesWritten'] = len(data)
+            logger.info("Generated: %s", output_path)
         else:
-            logger.error(f"Failed to optimize: {optimized_path}")
+            logger.debug("Unchanged: %s", output_path)
+
 
 def verify_exif_preservation(original_path: str, converted_path: str) -> bool:
     """Verifies that EXIF data was properly preserved during conversion."""
@@ -521,12 +1797,12 @@ def verify_exif_preservation(original_path: str, converted_path: str) -> bool:
                 continue
             
             if original_value is None and converted_value is not None:
-                logger.warning(f"EXIF field '{field}' present in converted but not original ({converted_path})")
+                logger.warning("EXIF field '%s' present in converted but not original (%s)", field, converted_path)
                 all_preserved = False
                 continue
 
             if original_value is not None and converted_value is None:
-                logger.warning(f"EXIF field '{field}' was not preserved for {converted_path}")
+                logger.warning("EXIF field '%s' was not preserved for %s", field, converted_path)
                 all_preserved = False
                 continue
 
@@ -546,80 +1822,1346 @@ def verify_exif_preservation(original_path: str, converted_path: str) -> bool:
             # Compare numerical values with tolerance
             if isinstance(original_comp_value, (int, float)) and isinstance(converted_comp_value, (int, float)):
                 if not math.isclose(original_comp_value, converted_comp_value, rel_tol=1e-3, abs_tol=1e-6):
-                    logger.warning(f"EXIF field '{field}' value changed during conversion for {converted_path}: Original '{original_comp_value}', Converted '{converted_comp_value}'")
+                    logger.warning(
+                        "EXIF field '%s' value changed during conversion for %s: Original '%s', Converted '%s'",
+                        field, converted_path, original_comp_value, converted_comp_value
+                    )
                     all_preserved = False
             elif original_comp_value != converted_comp_value:
-                logger.warning(f"EXIF field '{field}' value changed during conversion for {converted_path}: Original '{original_comp_value}', Converted '{converted_comp_value}'")
+                logger.warning(
+                    "EXIF field '%s' value changed during conversion for %s: Original '%s', Converted '%s'",
+                    field, converted_path, original_comp_value, converted_comp_value
+                )
                 all_preserved = False
         
         return all_preserved
     except Exception as e:
-        logger.error(f"Error verifying EXIF preservation for {converted_path}: {e}")
+        logger.error("Error verifying EXIF preservation for %s: %s", converted_path, e)
         return False
 
-def cleanup_temp_files(directory: str, pattern: str = "*.temp.jpg") -> None:
+def cleanup_temp_files(directory: str, pattern: str = TEMP_FILE_PATTERN) -> None:
     """Cleans up temporary files in the specified directory."""
     try:
         temp_files = list(Path(directory).glob(pattern))
         for temp_file in temp_files:
             try:
                 temp_file.unlink()
-                logger.debug(f"Cleaned up temporary file: {temp_file}")
+                logger.debug("Cleaned up temporary file: %s", temp_file)
+            except Exception as e:
+                logger.warning("Failed to remove temporary file %s: %s", temp_file, e)
+    except Exception as e:
+        logger.error("Error during cleanup: %s", e)
+
+def encoder_settings() -> Dict[str, Any]:
+    """Returns the settings that determine the bytes of every generated output."""
+    settings = {
+        'sizes': {name: list(size) for name, size in VARIANT_SIZES.items()},
+        'formats': {fmt['name']: fmt['options'] for fmt in output_formats()},
+        'blurSize': list(BLUR_SIZE),
+        'blurQuality': BLUR_QUALITY,
+        'passthrough': PASSTHROUGH_MAX_BYTES_PER_PIXEL if PIPELINE_OPTIONS['passthrough'] else None,
+        'previews': PIPELINE_OPTIONS['previews'],
+        'colorSpace': OUTPUT_COLOR_SPACE,
+        # Derivatives of EXIF-rotated JPEG/PNG sources are stored upright
+        'upright': True,
+    }
+    if PIPELINE_OPTIONS['quality_target']:
+        settings['qualityTarget'] = dict(PIPELINE_OPTIONS['quality_target'], range=list(QUALITY_SEARCH_RANGE))
+    return settings
+
+def settings_fingerprint(settings: Dict[str, Any]) -> str:
+    """Returns a short stable hash of the encoder settings."""
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def file_sha256(path: str) -> str:
+    """Returns the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def expected_outputs(image_filename: str) -> List[str]:
+    """Lists every file generated for a photo, relative to PROJECT_ROOT."""
+    stem = os.path.splitext(image_filename)[0]
+    paths = [os.path.join(OUTPUT_DIR, stem + '.md')]
+    paths.extend(derivative_paths(image_filename).values())
+    return [os.path.relpath(path, PROJECT_ROOT) for path in paths]
+
+def load_manifest(path: Optional[str] = None) -> Dict[str, Any]:
+    """Loads the incremental build manifest (MANIFEST_PATH by default), or returns an empty one."""
+    path = path or MANIFEST_PATH
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION and isinstance(manifest.get('photos'), dict):
+            return manifest
+        logger.warning("Ignoring manifest %s with unsupported version %s", path, manifest.get('version'))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("Could not read manifest %s: %s", path, e)
+    return {'version': MANIFEST_VERSION, 'photos': {}}
+
+def save_manifest(manifest: Dict[str, Any], path: Optional[str] = None) -> None:
+    """Writes the manifest atomically so an interrupted run never leaves it truncated.
+
+    path defaults to MANIFEST_PATH. An unchanged manifest is not rewritten.
+    """
+    write_file_if_changed(path or MANIFEST_PATH, (json.dumps(manifest, indent=2, sort_keys=True) + '\n').encode('utf-8'))
+
+def check_manifest_entry(filename: str, entry: Optional[Dict[str, Any]], fingerprint: str) -> Tuple[bool, Dict[str, Any]]:
+    """Decides whether a photo's outputs are up to date.
+
+    Returns (is_current, source_info). Size and mtime are compared first so an
+    untouched file is never read; the content hash is only computed when they
+    differ (e.g. after a fresh checkout) and then decides on its own. Every
+    file expected_outputs() lists must exist, not only those recorded.
+    """
+    image_path = os.path.join(PHOTOGRAPHS_DIR, filename)
+    stat = os.stat(image_path)
+    source = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    if not entry or entry.get('settings') != fingerprint:
+        source['sha256'] = file_sha256(image_path)
+        return False, source
+    outputs_present = all(os.path.exists(os.path.join(PROJECT_ROOT, output)) for output in expected_outputs(filename))
+    if entry.get('size') == source['size'] and entry.get('mtime') == source['mtime']:
+        source['sha256'] = entry.get('sha256')
+        return outputs_present, source
+
+    source['sha256'] = file_sha256(image_path)
+    return outputs_present and source['sha256'] == entry.get('sha256'), source
+
+def remove_outputs(outputs: List[str], keep: Optional[set] = None) -> None:
+    """Deletes generated files listed in a manifest entry, except those in keep."""
+    for output in outputs:
+        if keep and output in keep:
+            continue
+        path = os.path.join(PROJECT_ROOT, output)
+        try:
+            os.remove(path)
+            logger.info("Removed stale output: %s", path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning("Failed to remove stale output %s: %s", path, e)
+
+def remove_photo(manifest: Dict[str, Any], filename: str) -> None:
+    """Drops a deleted photo from the manifest and removes its outputs."""
+    manifest['photos'].pop(filename, None)
+    # Two sources with the same stem (IMG_1.heic, IMG_1.jpg) share outputs
+    still_claimed = {output for entry in manifest['photos'].values() for output in entry.get('outputs', [])}
+    logger.info("Photo removed from %s: %s", PHOTOGRAPHS_DIR, filename)
+    remove_outputs(expected_outputs(filename), keep=still_claimed)
+
+def prune_manifest(manifest: Dict[str, Any], image_files: List[str]) -> None:
+    """Drops manifest entries for deleted photos and removes their outputs."""
+    present = set(image_files)
+    for filename in [filename for filename in manifest['photos'] if filename not in present]:
+        remove_photo(manifest, filename)
+
+def plan_photo(manifest: Dict[str, Any], filename: str, fingerprint: str,
+               force: bool = False) -> Tuple[bool, bool, Dict[str, Any]]:
+    """Decides what a photo needs; returns (process, rebuild, source_info).
+
+    rebuild is set when changed content or settings invalidate the existing
+    derivatives whatever their mtimes. An up-to-date photo whose mtime moved
+    (e.g. a fresh checkout) only has its manifest entry refreshed.
+    """
+    entry = manifest['photos'].get(filename)
+    is_current, source = check_manifest_entry(filename, entry, fingerprint)
+    if force or not is_current:
+        rebuild = force or bool(entry and (entry.get('settings') != fingerprint
+                                           or entry.get('sha256') != source['sha256']))
+        return True, rebuild, source
+    if entry['mtime'] != source['mtime']:
+        entry.update(source)
+    return False, False, source
+
+def record_result(manifest: Dict[str, Any], filename: str, success: bool, source: Dict[str, Any],
+                  fingerprint: str) -> None:
+    """Updates a photo's manifest entry once it has been processed."""
+    if success:
+        outputs = [o for o in expected_outputs(filename) if os.path.exists(os.path.join(PROJECT_ROOT, o))]
+        # Drop derivatives of formats that are no longer selected
+        previous = manifest['photos'].get(filename, {}).get('outputs', [])
+        remove_outputs([o for o in previous if o not in outputs])
+        manifest['photos'][filename] = dict(source, settings=fingerprint, outputs=outputs)
+    else:
+        manifest['photos'].pop(filename, None)
+
+def shard_of(sha256: str, count: int) -> int:
+    """Returns the shard (1 to count) that owns a photo with the given content hash."""
+    return int(sha256[:16], 16) % count + 1
+
+def shard_manifest_path(index: int, count: int) -> str:
+    """Returns the path of the partial manifest written by shard index of count."""
+    return os.path.join(PROJECT_ROOT, SHARD_MANIFEST_PATTERN.format(index=index, count=count))
+
+def save_shard_manifest(manifest: Dict[str, Any], filenames: Iterable[str], shard: Tuple[int, int]) -> None:
+    """Writes the partial manifest of one shard, holding only the photos it owns."""
+    index, count = shard
+    partial = {
+        'version': MANIFEST_VERSION,
+        'settings': manifest.get('settings'),
+        'shard': {'index': index, 'count': count},
+        'photos': {filename: manifest['photos'][filename] for filename in filenames if filename in manifest['photos']},
+    }
+    save_manifest(partial, shard_manifest_path(index, count))
+
+def load_shard_manifests() -> List[Tuple[str, Dict[str, Any]]]:
+    """Loads every partial manifest in PROJECT_ROOT, checking that they form one complete set.
+
+    Raises ValueError when there are none, one is unreadable, or their shard
+    counts disagree or leave a shard missing.
+    """
+    pattern = SHARD_MANIFEST_PATTERN.format(index='*', count='*')
+    partials = []
+    for path in sorted(Path(PROJECT_ROOT).glob(pattern)):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                partial = json.load(f)
+        except Exception as e:
+            raise ValueError(f"Could not read shard manifest {path}: {e}") from e
+        if partial.get('version') != MANIFEST_VERSION or not isinstance(partial.get('photos'), dict):
+            raise ValueError(f"Shard manifest {path} has unsupported version {partial.get('version')}")
+        partials.append((str(path), partial))
+    if not partials:
+        raise ValueError(f"No shard manifests found in {PROJECT_ROOT}")
+    counts = {partial['shard']['count'] for _, partial in partials}
+    if len(counts) != 1:
+        raise ValueError(f"Shard manifests come from different shard counts: {sorted(counts)}")
+    count = counts.pop()
+    indexes = sorted(partial['shard']['index'] for _, partial in partials)
+    if indexes != list(range(1, count + 1)):
+        missing = sorted(set(range(1, count + 1)) - set(indexes))
+        raise ValueError(f"Missing shard manifests for shard(s) {', '.join(map(str, missing))} of {count}")
+    return partials
+
+def merge_shard_manifests(manifest: Dict[str, Any], image_files: List[str], fingerprint: str) -> List[str]:
+    """Replaces the manifest's photos with those of every shard; returns the merged manifest paths.
+
+    The shards' outputs must already be copied into this tree. Each entry is
+    checked like an incremental run would check it: sources whose mtime
+    differs on this machine are re-hashed, and entries whose source changed
+    or whose outputs are missing are dropped, so the next run redoes them.
+    Outputs of formats no longer produced are removed, as record_result does.
+    Raises ValueError when the shards do not form one complete set or were
+    built with other encoder settings.
+    """
+    partials = load_shard_manifests()
+    photos = {}
+    for path, partial in partials:
+        if settings_fingerprint(partial.get('settings') or {}) != fingerprint:
+            raise ValueError(f"Shard manifest {path} was built with different encoder settings; "
+                             "merge with the options the shards ran with")
+        for filename, entry in partial['photos'].items():
+            if filename in photos:
+                raise ValueError(f"{filename} appears in more than one shard manifest")
+            photos[filename] = entry
+
+    present = set(image_files)
+    merged = {}
+    for filename, entry in sorted(photos.items()):
+        if filename not in present:
+            continue
+        is_current, source = check_manifest_entry(filename, entry, fingerprint)
+        if not is_current:
+            logger.warning("Dropping shard output of %s: source changed or outputs missing", filename)
+            continue
+        entry.update(source)
+        merged[filename] = entry
+    claimed = {output for entry in merged.values() for output in entry.get('outputs', [])}
+    for filename in merged:
+        remove_outputs(manifest['photos'].get(filename, {}).get('outputs', []), keep=claimed)
+    unbuilt = len(present) - len(merged)
+    if unbuilt:
+        logger.warning("%s photos were not built by any shard; the next run will process them", unbuilt)
+    manifest['photos'] = merged
+    logger.info("Merged %s shard manifests with %s photos", len(partials), len(merged))
+    return [path for path, _ in partials]
+
+def public_url(path: str) -> str:
+    """Returns the site URL of a file under public/."""
+    return '/' + os.path.relpath(path, os.path.dirname(PHOTOGRAPHS_DIR)).replace(os.sep, '/')
+
+def index_record(filename: str) -> Optional[Dict[str, Any]]:
+    """Builds a photo's index record from its markdown and derivatives on disk.
+
+    Variants are grouped by size, each with its pixel dimensions and the URL
+    of every format written for it. Dimensions come from the markdown's
+    variant list; only derivatives missing from it (the blur) have their
+    file header read. The list itself is left out of the record's
+    frontmatter, the grouped form replaces it.
+    """
+    from PIL import Image
+
+    stem = os.path.splitext(filename)[0]
+    frontmatter = read_existing_markdown(os.path.join(OUTPUT_DIR, stem + '.md'))
+    if frontmatter is None:
+        return None
+    listed = {variant.get('src'): variant for variant in frontmatter.get('variants') or [] if isinstance(variant, dict)}
+    variants = {}
+    for key, path in derivative_paths(filename).items():
+        if not os.path.exists(path):
+            continue
+        size_name, ext = key.split('.', 1)
+        url = public_url(path)
+        if url in listed:
+            width, height = listed[url]['width'], listed[url]['height']
+        else:
+            try:
+                with Image.open(path) as img:
+                    width, height = img.size
             except Exception as e:
-                logger.warning(f"Failed to remove temporary file {temp_file}: {e}")
+                logger.warning("Could not read dimensions of %s: %s", path, e)
+                continue
+        variant = variants.setdefault(size_name, {'width': width, 'height': height})
+        variant[ext] = url
+    frontmatter = {key: value for key, value in frontmatter.items() if key != 'variants'}
+    record = {'id': stem, 'source': filename, 'frontmatter': frontmatter, 'variants': variants}
+    if filename in PIPELINE_OPTIONS['duplicates']:
+        record['duplicateOf'] = PIPELINE_OPTIONS['duplicates'][filename]
+    # Normalize through JSON so a fresh record and one cached in the manifest serialize identically
+    return json.loads(json.dumps(record, default=str))
+
+def cached_index_record(filename: str, entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Returns a photo's index record, rebuilding it only when its inputs changed.
+
+    The record is cached in the photo's manifest entry, keyed by the
+    markdown's size and mtime (catching manual edits) plus the source hash,
+    settings fingerprint and duplicated photo (catching regenerated or
+    shared derivatives) and INDEX_VERSION.
+    """
+    try:
+        stat = os.stat(os.path.join(OUTPUT_DIR, os.path.splitext(filename)[0] + '.md'))
+    except FileNotFoundError:
+        return None
+    key = [stat.st_size, stat.st_mtime_ns, entry.get('sha256'), entry.get('settings'), entry.get('duplicateOf'),
+           INDEX_VERSION]
+    cached = entry.get('index')
+    if cached and cached.get('key') == key:
+        return cached['record']
+    record = index_record(filename)
+    entry['index'] = {'key': key, 'record': record}
+    return record
+
+def write_photo_index(manifest: Dict[str, Any], gzip_copy: bool = False) -> None:
+    """Writes the consolidated photography index from the manifest's photos.
+
+    The JSON is compact with sorted keys and records sorted by id, so an
+    unchanged photo set produces byte-identical output and the file is left
+    untouched. The gzip copy uses a fixed header mtime for the same reason;
+    without gzip_copy an existing copy is removed so it can never go stale.
+    """
+    records = []
+    for filename in sorted(manifest['photos']):
+        record = cached_index_record(filename, manifest['photos'][filename])
+        if record is not None:
+            records.append(record)
+    records.sort(key=lambda record: (record['id'], record['source']))
+    index = {'version': INDEX_VERSION, 'photos': records}
+    data = json.dumps(index, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8') + b'\n'
+
+    path = os.path.join(OUTPUT_DIR, INDEX_FILENAME)
+    if write_file_if_changed(path, data):
+        logger.info("Wrote photography index with %s photos: %s", len(records), path)
+    if gzip_copy:
+        write_file_if_changed(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+    elif os.path.exists(path + '.gz'):
+        os.remove(path + '.gz')
+
+def reduced_decode(input_path: str, box: Tuple[int, int]) -> Tuple[Image.Image, Tuple[int, int]]:
+    """Decodes a source cheaply at no less than box where possible; returns the upright image and the full size.
+
+    JPEG and MPO sources decode at a reduced DCT scale and are rotated by
+    their EXIF Orientation, HEIC/HEIF sources use their embedded thumbnail
+    when they have one; anything else is decoded fully.
+    """
+    from PIL import Image, ImageOps
+
+    if input_path.lower().endswith(('.heic', '.heif')):
+        import pillow_heif
+
+        heif_file = pillow_heif.open_heif(input_path)
+        primary = heif_file[heif_file.primary_index]
+        if primary.info.get('thumbnails'):
+            return primary.get_thumbnail(0).to_pillow(), heif_file.size
+        return heif_file.to_pillow(), heif_file.size
+    with Image.open(input_path) as image:
+        full_size = image.size
+        if image.format in ('JPEG', 'MPO'):
+            image.draft('RGB', box)
+        image.load()
+        # Decoded before the file is closed; exif_transpose() returns a new image
+        return ImageOps.exif_transpose(image), full_size
+
+def perceptual_hash(image: Image.Image) -> int:
+    """Returns the 64-bit DCT perceptual hash (pHash) of an image.
+
+    The image is reduced to 32x32 grey, and each bit records whether one of
+    the 8x8 lowest-frequency DCT coefficients lies above their median.
+    """
+    from PIL import Image
+    import numpy as np
+
+    grey = np.asarray(image.convert('L').resize((32, 32), Image.Resampling.BOX), dtype=np.float64)
+    frequencies = np.arange(32)[:, None]
+    dct = np.cos(np.pi * (2 * np.arange(32)[None, :] + 1) * frequencies / 64)
+    low = (dct @ grey @ dct.T)[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+def hamming_distance(first: int, second: int) -> int:
+    """Returns the number of bits two hashes differ in."""
+    return bin(first ^ second).count('1')
+
+def load_hash_index(path: Optional[str] = None) -> Dict[str, Any]:
+    """Loads the perceptual hash index (HASH_INDEX_PATH by default), or returns an empty one."""
+    path = path or HASH_INDEX_PATH
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') == HASH_INDEX_VERSION and isinstance(index.get('photos'), dict):
+            return index
+        logger.warning("Ignoring hash index %s with unsupported version %s", path, index.get('version'))
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        logger.error(f"Error during cleanup: {e}")
+        logger.warning("Could not read hash index %s: %s", path, e)
+    return {'version': HASH_INDEX_VERSION, 'photos': {}}
+
+def save_hash_index(index: Dict[str, Any], path: Optional[str] = None) -> None:
+    """Writes the perceptual hash index (HASH_INDEX_PATH by default) atomically, unless it is unchanged."""
+    write_file_if_changed(path or HASH_INDEX_PATH, (json.dumps(index, indent=2, sort_keys=True) + '\n').encode('utf-8'))
+
+def update_hash_index(index: Dict[str, Any], image_files: List[str]) -> Dict[str, Any]:
+    """Brings the hash index in line with image_files and returns it.
+
+    Entries are keyed by the source's size and mtime, so only new or changed
+    photos are decoded; entries of deleted photos are dropped. A photo that
+    cannot be decoded is left out and never counts as a duplicate.
+    """
+    photos = index['photos']
+    for filename in [filename for filename in photos if filename not in set(image_files)]:
+        del photos[filename]
+    for filename in image_files:
+        path = os.path.join(PHOTOGRAPHS_DIR, filename)
+        stat = os.stat(path)
+        entry = photos.get(filename)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            continue
+        try:
+            image, full_size = reduced_decode(path, PHASH_DECODE_SIZE)
+            photos[filename] = {
+                'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                'phash': f"{perceptual_hash(image):016x}", 'width': full_size[0], 'height': full_size[1],
+            }
+        except Exception as e:
+            logger.warning("Could not hash %s for duplicate detection: %s", filename, e)
+            photos.pop(filename, None)
+    return index
+
+def find_duplicates(index: Dict[str, Any], max_distance: int = DEDUPE_MAX_DISTANCE) -> Dict[str, str]:
+    """Maps each photo that duplicates another to the photo whose derivatives it should share.
+
+    Photos are taken largest first (by pixel count, then by name), and each
+    becomes a duplicate of the first kept photo within max_distance bits of
+    its hash, so every group is represented by its highest-resolution copy.
+    """
+    photos = index['photos']
+    order = sorted(photos, key=lambda name: (-photos[name]['width'] * photos[name]['height'], name))
+    kept = []
+    duplicates = {}
+    for filename in order:
+        phash = int(photos[filename]['phash'], 16)
+        for canonical, canonical_hash in kept:
+            if hamming_distance(phash, canonical_hash) <= max_distance:
+                duplicates[filename] = canonical
+                break
+        else:
+            kept.append((filename, phash))
+    return duplicates
+
+def report_duplicates(duplicates: Dict[str, str], index: Dict[str, Any], shared: bool = True) -> None:
+    """Logs every group of duplicate photos with the hash distances.
+
+    shared says whether the groups share derivatives (--dedupe) or were only found.
+    """
+    if not duplicates:
+        logger.info("No duplicate photos found among %s", len(index['photos']))
+        return
+    groups = {}
+    for duplicate, canonical in duplicates.items():
+        groups.setdefault(canonical, []).append(duplicate)
+    for canonical, members in sorted(groups.items()):
+        canonical_hash = int(index['photos'][canonical]['phash'], 16)
+        logger.info(
+            "%s is duplicated by: %s", canonical, ', '.join(
+                "%s (distance %s)" % (member, hamming_distance(int(index['photos'][member]['phash'], 16), canonical_hash))
+                for member in sorted(members)
+            )
+        )
+    if shared:
+        logger.info("%s duplicate photos in %s groups; they share their group's derivatives",
+                    len(duplicates), len(groups))
+    else:
+        logger.info("%s near-duplicate photos in %s groups; each keeps its own derivatives (--dedupe shares them)",
+                    len(duplicates), len(groups))
+
+def check_derivative_exif(filename: str) -> bool:
+    """Verifies that a HEIC photo's EXIF survived into its _full.jpg derivative.
+
+    Duplicates are skipped, their derivatives come from another source.
+    """
+    if not filename.lower().endswith(('.heic', '.heif')) or filename in PIPELINE_OPTIONS['duplicates']:
+        return True
+    image_path = os.path.join(PHOTOGRAPHS_DIR, filename)
+    if not verify_exif_preservation(image_path, derivative_paths(filename)['full.jpg']):
+        logger.warning("EXIF verification failed for %s", filename)
+        return False
+    return True
 
-def process_image(filename: str, force_update: bool = False) -> Tuple[bool, str]:
-    """Process a single image file."""
+def process_image(filename: str, force_update: bool = False, rebuild: bool = False) -> Tuple[bool, str, Dict[str, Any]]:
+    """Process a single image file.
+
+    Returns (success, message, stats); stats carries this image's EXIF cache
+    hits and misses, the resize/encode stats of any regenerated derivatives
+    and its per-stage records, so the parent process can total them across
+    workers.
+    """
+    cache_before = dict(EXIF_CACHE_STATS)
+    stats = {}
     try:
         image_path = os.path.join(PHOTOGRAPHS_DIR, filename)
-        logger.info(f"Processing: {filename}")
+        logger.info("Processing: %s", filename)
         
         # Extract EXIF data
-        exif_data = extract_exif(image_path)
+        with measure_stage(stats, 'metadata'):
+            exif_data = extract_exif(image_path)
         
         # Generate markdown file
-        generate_markdown_file(filename, exif_data, force_update)
-        
-        # Get optimized image path
-        optimized_filename = os.path.splitext(filename)[0] + '.jpg'
-        optimized_path = os.path.join(OPTIMIZED_DIR, optimized_filename)
+        generate_markdown_file(filename, exif_data, force_update, stats, rebuild)
         
         # Verify EXIF preservation if it's a HEIC file
-        if filename.lower().endswith(('.heic', '.heif')):
-            if not verify_exif_preservation(image_path, optimized_path):
-                logger.warning(f"EXIF verification failed for {filename}")
-                return False, f"EXIF verification failed for {filename}"
+        if not check_derivative_exif(filename):
+            return False, f"EXIF verification failed for {filename}", stats
         
-        return True, f"Successfully processed {filename}"
+        return True, f"Successfully processed {filename}", stats
     except Exception as e:
         error_msg = f"Error processing {filename}: {e}"
         logger.error(error_msg)
-        return False, error_msg
+        return False, error_msg, stats
+    finally:
+        stats['exifCache'] = {key: EXIF_CACHE_STATS[key] - cache_before[key] for key in EXIF_CACHE_STATS}
+
+def iter_image_files(directory: Optional[str] = None) -> Iterator[str]:
+    """Yields the names of the image files in directory (PHOTOGRAPHS_DIR by default)."""
+    with os.scandir(directory or PHOTOGRAPHS_DIR) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield entry.name
+
+class MemoryBudget:
+    """Blocks decoding while the estimated memory of the photos in flight is over a limit.
+
+    A photo larger than the whole budget is still admitted once nothing else
+    is in flight, so an oversized file slows the pipeline down instead of
+    deadlocking it.
+    """
+
+    def __init__(self, limit_bytes: int):
+        self.limit = limit_bytes
+        self.in_use = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, amount: int) -> None:
+        with self._condition:
+            while self.in_use and self.in_use + amount > self.limit:
+                self._condition.wait()
+            self.in_use += amount
+            self.peak = max(self.peak, self.in_use)
+
+    def release(self, amount: int) -> None:
+        with self._condition:
+            self.in_use -= amount
+            self._condition.notify_all()
+
+def estimate_decoded_bytes(input_path: str) -> int:
+    """Estimates the memory a photo needs while in flight, from its header only."""
+    from PIL import Image
+    import pillow_heif
+
+    if input_path.lower().endswith(('.heic', '.heif')):
+        width, height = pillow_heif.open_heif(input_path).size
+    else:
+        with Image.open(input_path) as img:
+            width, height = img.size
+    return int(width * height * 4 * STREAM_MEMORY_OVERHEAD)
+
+_END_OF_STREAM = object()
+
+def buffered(items: Iterable, maxsize: int = STREAM_QUEUE_SIZE, name: str = 'stage') -> Iterator:
+    """Runs a stage generator on its own thread behind a bounded queue.
+
+    The producer blocks as soon as maxsize items are waiting, so a fast stage
+    can never run ahead of a slow one by more than that. Pillow releases the
+    GIL while decoding, resizing and encoding, so the stages overlap.
+    """
+    channel = queue.Queue(maxsize=maxsize)
+
+    def produce():
+        try:
+            for item in items:
+                channel.put((None, item))
+        except BaseException as e:
+            channel.put((e, None))
+        channel.put((_END_OF_STREAM, None))
+
+    threading.Thread(target=produce, name=name, daemon=True).start()
+    while True:
+        error, item = channel.get()
+        if error is _END_OF_STREAM:
+            return
+        if error is not None:
+            raise error
+        yield item
+
+def metadata_stage(filenames: Iterable[str], rebuild: frozenset) -> Iterator[Dict[str, Any]]:
+    """Reads EXIF, works out which derivatives each photo needs and passes through those it can."""
+    for filename in filenames:
+        item = {'filename': filename, 'path': os.path.join(PHOTOGRAPHS_DIR, filename),
+                'stats': {}, 'error': None, 'reserved': 0, 'variants': []}
+        try:
+            logger.info("Processing: %s", filename)
+            with measure_stage(item['stats'], 'metadata'):
+                item['exif'] = extract_exif(item['path'])
+            item['variants'] = stale_derivatives(filename, filename in rebuild)
+            if item['variants']:
+                base_path = os.path.join(OPTIMIZED_DIR, os.path.splitext(filename)[0])
+                item['encoded'], item['stats']['encode'] = passthrough_variants(
+                    item['path'], base_path, VARIANT_SIZES, item['variants'], item['stats']
+                )
+                remaining = [variant for variant in item['variants'] if variant not in item['stats']['encode']]
+                previewed, preview_stats = preview_variants(
+                    item['path'], base_path, VARIANT_SIZES, remaining, item['stats']
+                )
+                item['encoded'].extend(previewed)
+                item['stats']['encode'].update(preview_stats)
+                item['decode_variants'] = [variant for variant in remaining if variant not in preview_stats]
+            if item.get('decode_variants'):
+                item['sizes'] = requested_sizes(VARIANT_SIZES, item['decode_variants'])
+                item['reserved'] = estimate_decoded_bytes(item['path'])
+        except Exception as e:
+            item['error'] = f"Error processing {filename}: {e}"
+        yield item
+
+def decode_stage(items: Iterable[Dict[str, Any]], budget: MemoryBudget) -> Iterator[Dict[str, Any]]:
+    """Decodes photos, waiting for room in the memory budget first."""
+    for item in items:
+        if not item['error'] and 'sizes' in item:
+            budget.acquire(item['reserved'])
+            item['acquired'] = True
+            try:
+                image, item['exif_bytes'] = decode_source(item['path'], item['sizes'], item['stats'])
+                if image is None:
+                    raise ValueError("could not decode image")
+                item['image'] = image
+            except Exception as e:
+                item['error'] = f"Failed to optimize {item['filename']}: {e}"
+        yield item
+
+def resize_stage(items: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """Builds the size ladder and drops the full-resolution image."""
+    for item in items:
+        if not item['error'] and 'image' in item:
+            try:
+                item['resized'], item['stats']['resize'] = resize_ladder(
+                    item.pop('image'), item['sizes'], verify=PIPELINE_OPTIONS['verify_resize'], stats=item['stats']
+                )
+                if 'thumb' in item['resized'] and 'placeholder' not in item['stats']:
+                    with measure_stage(item['stats'], 'placeholder'):
+                        item['stats']['placeholder'] = placeholder_stats(item['resized']['thumb'])
+            except Exception as e:
+                item['error'] = f"Failed to optimize {item['filename']}: {e}"
+        yield item
+
+def encode_stage(items: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """Encodes the resized ladder into in-memory files and drops the pixels."""
+    for item in items:
+        if not item['error'] and 'resized' in item:
+            try:
+                base_path = os.path.join(OPTIMIZED_DIR, os.path.splitext(item['filename'])[0])
+                encoded, encode_stats = encode_variants(
+                    item.pop('resized'), item.get('exif_bytes'), base_path, item['decode_variants'], item['stats']
+                )
+                item['encoded'].extend(encoded)
+                item['stats']['encode'].update(encode_stats)
+            except Exception as e:
+                item['error'] = f"Failed to optimize {item['filename']}: {e}"
+        yield item
+
+def write_stage(items: Iterable[Dict[str, Any]], budget: MemoryBudget,
+                force_update: bool = False) -> Iterator[Tuple[str, bool, str, Dict[str, Any]]]:
+    """Writes derivatives and markdown; yields process_image-style results."""
+    for item in items:
+        filename = item['filename']
+        try:
+            if item['error']:
+                raise RuntimeError(item['error'])
+            if 'encoded' in item:
+                write_variants(item.pop('encoded'), item['stats'])
+                if 'resize' in item['stats']:
+                    log_resize_stats(item['path'], item['stats']['resize'])
+                logger.info("Optimized: %s (%s)", filename, ', '.join(item['variants']))
+                output_writer().flush()
+            # The derivatives are fresh now, so this only writes the markdown
+            generate_markdown_file(filename, item['exif'], force_update, item['stats'], optimized=item['variants'])
+            if check_derivative_exif(filename):
+                yield filename, True, f"Successfully processed {filename}", item['stats']
+            else:
+                yield filename, False, f"EXIF verification failed for {filename}", item['stats']
+        except Exception as e:
+            message = str(e) if item['error'] else f"Error processing {filename}: {e}"
+            logger.error(message)
+            yield filename, False, message, item['stats']
+        finally:
+            if item.get('acquired'):
+                budget.release(item['reserved'])
+
+def run_streaming(image_files: Iterable[str], on_result, rebuild: frozenset = frozenset(),
+                  memory_budget_mb: int = DEFAULT_MEMORY_BUDGET_MB, force_update: bool = False) -> None:
+    """Processes images as a pipeline of threaded stages with bounded memory.
+
+    metadata -> decode -> resize -> encode -> write, with a bounded queue
+    between each pair of stages. Decoding waits until the estimated memory
+    of the photos in flight fits in memory_budget_mb, so peak memory stays
+    flat however many photos there are. force_update is passed on to
+    generate_markdown_file() as process_image() does.
+    """
+    budget = MemoryBudget(memory_budget_mb * 1024 * 1024)
+    items = buffered(metadata_stage(image_files, rebuild), name='metadata')
+    items = buffered(decode_stage(items, budget), name='decode')
+    items = buffered(resize_stage(items), name='resize')
+    items = buffered(encode_stage(items), name='encode')
+    for result in write_stage(items, budget, force_update):
+        on_result(*result)
+    logger.info(
+        "Streaming pipeline peak reserved memory: %.0f MB of %s MB",
+        budget.peak / 1024 / 1024, memory_budget_mb
+    )
+
+def summarize_stages(records: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Totals stage records (see measure_stage()) by stage name; peak RSS is the maximum."""
+    summary = {}
+    for record in records:
+        totals = summary.setdefault(record['stage'], {
+            'count': 0, 'wallSeconds': 0.0, 'cpuSeconds': 0.0, 'bytesRead': 0, 'bytesWritten': 0, 'peakRssMb': 0.0,
+        })
+        totals['count'] += 1
+        for key in ('wallSeconds', 'cpuSeconds', 'bytesRead', 'bytesWritten'):
+            totals[key] += record[key]
+        totals['peakRssMb'] = max(totals['peakRssMb'], record['peakRssMb'])
+    return summary
+
+def format_stage_table(summary: Dict[str, Dict[str, Any]]) -> str:
+    """Formats summarize_stages() output as a text table, slowest stages first."""
+    header = f"{'stage':<22} {'count':>6} {'wall s':>9} {'cpu s':>9} {'read MB':>9} {'written MB':>10} {'peak MB':>8}"
+    lines = [header, '-' * len(header)]
+    for name, totals in sorted(summary.items(), key=lambda item: item[1]['wallSeconds'], reverse=True):
+        lines.append(
+            f"{name:<22} {totals['count']:>6} {totals['wallSeconds']:>9.3f} {totals['cpuSeconds']:>9.3f} "
+            f"{totals['bytesRead'] / 1024 / 1024:>9.1f} {totals['bytesWritten'] / 1024 / 1024:>10.1f} "
+            f"{totals['peakRssMb']:>8.0f}"
+        )
+    return '\n'.join(lines)
+
+def write_run_report(path: str, records: List[Dict[str, Any]]) -> None:
+    """Writes one JSON record per processed photo to path (JSON lines)."""
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    logger.info("Wrote run report for %s photos to %s", len(records), path)
+
+def default_jobs() -> int:
+    """Returns the number of CPU cores available to this process."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parses command line options."""
+    parser = argparse.ArgumentParser(description="Generate photography markdown and optimized images.")
+    parser.add_argument(
+        '-f', '--force', action='store_true',
+        help="Reprocess every photo, even those the manifest records as up to date"
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=default_jobs(),
+        help="Number of worker processes (default: number of CPU cores, 1 = run in-process)"
+    )
+    parser.add_argument(
+        '--verify-resize', action='store_true',
+        help="Check every cascaded resize against a direct LANCZOS resize (SSIM) and report the time saved"
+    )
+    parser.add_argument(
+        '--formats', default=','.join(DEFAULT_OUTPUT_FORMATS),
+        help=f"Comma-separated output formats from {', '.join(OUTPUT_FORMAT_SETTINGS)} (default: %(default)s, jpeg is required)"
+    )
+    parser.add_argument(
+        '--draft', action='store_true',
+        help="Use faster, lower-effort encoder settings (e.g. WebP method 4) for quick previews"
+    )
+    quality_target = parser.add_mutually_exclusive_group()
+    quality_target.add_argument(
+        '--target-ssim', type=float, metavar='SSIM',
+        help="Encode each variant at the lowest quality whose SSIM against the resized image reaches SSIM "
+             "(e.g. 0.98) instead of the fixed qualities, found by bisection"
+    )
+    quality_target.add_argument(
+        '--target-bytes-per-pixel', type=float, metavar='BYTES',
+        help="Encode each variant at the highest quality that fits in BYTES per pixel (e.g. 0.2), "
+             "bounding every file's size, found by bisection"
+    )
+    parser.add_argument(
+        '--no-passthrough', dest='passthrough', action='store_false',
+        help="Always decode and re-encode, even JPEG sources that already fit a variant's box"
+    )
+    parser.add_argument(
+        '--no-embedded-previews', dest='previews', action='store_false',
+        help="Always resize the thumb, blur and placeholder from the full decode, "
+             "never from a HEIF or EXIF thumbnail embedded in the source"
+    )
+    parser.add_argument(
+        '--stream', action='store_true',
+        help="Process photos in one process as a pipeline of threaded stages with bounded memory"
+    )
+    parser.add_argument(
+        '--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET_MB, metavar='MB',
+        help="Estimated memory the --stream pipeline may hold in decoded photos (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--report', metavar='PATH',
+        help="Write a JSON-lines report with each processed photo's stats and per-stage timings to PATH"
+    )
+    parser.add_argument(
+        '--profile', metavar='PATH',
+        help="Run the photos serially in this process under cProfile and write the stats to PATH "
+             "(inspect with python -m pstats; concurrent encodes show up as waits on the encoder pool)"
+    )
+    parser.add_argument(
+        '--gzip-index', action='store_true',
+        help=f"Also write a gzip copy of the photography index ({INDEX_FILENAME}.gz)"
+    )
+    parser.add_argument(
+        '--log-level', default='INFO', type=str.upper, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help="Logging verbosity (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--dedupe', action=argparse.BooleanOptionalAction, default=False,
+        help="Give each group of near-identical photos (by perceptual hash) one shared set of derivatives; "
+             "by default the groups are only reported and every photo keeps its own"
+    )
+    parser.add_argument(
+        '--shard', metavar='I/N',
+        help="Process only the photos of shard I of N (partitioned by content hash) and write their outputs "
+             "plus a partial manifest, so N machines can split a run"
+    )
+    parser.add_argument(
+        '--merge-shards', action='store_true',
+        help="Combine the partial manifests of a complete set of --shard runs, whose outputs have been copied "
+             "into this tree, into the manifest and photography index, then remove them"
+    )
+    parser.add_argument(
+        '--watch', action='store_true',
+        help="After the initial pass keep running, processing photos as they are added or changed "
+             "and removing the outputs of deleted ones (stop with Ctrl-C)"
+    )
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    args.formats = [name.strip().lower() for name in args.formats.split(',') if name.strip()]
+    unknown = [name for name in args.formats if name not in OUTPUT_FORMAT_SETTINGS]
+    if unknown:
+        parser.error(f"Unknown output format(s): {', '.join(unknown)}")
+    if 'jpeg' not in args.formats:
+        parser.error("--formats must include jpeg")
+    if args.target_ssim is not None and not 0 < args.target_ssim < 1:
+        parser.error("--target-ssim must be between 0 and 1")
+    if args.target_bytes_per_pixel is not None and args.target_bytes_per_pixel <= 0:
+        parser.error("--target-bytes-per-pixel must be positive")
+    if args.shard is not None:
+        try:
+            index, count = (int(part) for part in args.shard.split('/'))
+        except ValueError:
+            parser.error("--shard must look like I/N, e.g. 2/4")
+        if not 1 <= index <= count:
+            parser.error("--shard I/N needs 1 <= I <= N")
+        args.shard = (index, count)
+        if args.merge_shards or args.watch:
+            parser.error("--shard cannot be combined with --merge-shards or --watch")
+    if args.merge_shards and args.watch:
+        parser.error("--merge-shards cannot be combined with --watch")
+    if 'avif' in args.formats:
+        from PIL import features
+        if not features.check('avif'):
+            parser.error("AVIF output needs a Pillow build with AVIF support")
+    return args
+
+def run_serial(image_files: List[str], on_result, rebuild: frozenset = frozenset()) -> None:
+    """Processes images one at a time in the current process.
+
+    Images named in rebuild have all their derivatives regenerated.
+    """
+    for filename in image_files:
+        on_result(filename, *process_image(filename, rebuild=filename in rebuild))
+
+def run_isolated(filename: str, rebuild: bool = False) -> Tuple[bool, str, Dict[str, Any]]:
+    """Processes a single image in its own worker process."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    try:
+        with ProcessPoolExecutor(max_workers=1, initializer=init_worker,
+                                 initargs=worker_initargs()) as executor:
+            return executor.submit(process_image, filename, False, rebuild).result()
+    except Exception as e:
+        message = f"Worker failed while processing {filename}: {e!r}"
+        logger.error(message)
+        return False, message, {}
 
-def main():
+def run_parallel(image_files: List[str], jobs: int, on_result, rebuild: frozenset = frozenset()) -> None:
+    """Processes images in a pool of worker processes.
+
+    process_image already turns per-image exceptions into an error result. If a
+    worker dies outright (segfault in a decoder, OOM kill) the pool is broken and
+    every in-flight image fails with it, so those images are retried one by one in
+    isolated workers; only the image that actually kills its worker is reported.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from concurrent.futures.process import BrokenProcessPool
+
+    retry = []
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=worker_initargs()) as executor:
+        futures = {
+            executor.submit(process_image, filename, False, filename in rebuild): filename
+            for filename in image_files
+        }
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                success, message, stats = future.result()
+            except BrokenProcessPool:
+                retry.append(filename)
+                continue
+            except Exception as e:
+                success, message, stats = False, f"Worker failed while processing {filename}: {e!r}", {}
+                logger.error(message)
+            on_result(filename, success, message, stats)
+
+    if retry:
+        logger.warning("Worker pool crashed, retrying %s images in isolated workers", len(retry))
+        for filename in retry:
+            on_result(filename, *run_isolated(filename, filename in rebuild))
+
+class InotifyWatcher:
+    """Reports changes to the photos in a directory through Linux inotify."""
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, directory: str):
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify is not available on this platform")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM
+                | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"inotify_add_watch failed for {directory}")
+
+    def poll(self, timeout: float) -> List[Tuple[str, str]]:
+        """Waits up to timeout seconds; returns ('changed' | 'deleted' | 'rescan', filename) events."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            _, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                # The kernel dropped events, the caller has to look at the directory itself
+                events.append(('rescan', ''))
+            elif name.lower().endswith(IMAGE_EXTENSIONS):
+                events.append(('deleted' if mask & (self.IN_DELETE | self.IN_MOVED_FROM) else 'changed', name))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+class PollingWatcher:
+    """Reports changes to the photos in a directory by comparing stat snapshots.
+
+    The fallback where inotify is unavailable (macOS, some network or
+    container filesystems); every poll is a scandir of the directory.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.snapshot = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    stat = entry.stat()
+                    snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def poll(self, timeout: float) -> List[Tuple[str, str]]:
+        """Waits timeout seconds; returns ('changed' | 'deleted', filename) events."""
+        time.sleep(timeout)
+        current = self._scan()
+        events = [('deleted', name) for name in self.snapshot if name not in current]
+        events.extend(('changed', name) for name, signature in current.items() if self.snapshot.get(name) != signature)
+        self.snapshot = current
+        return events
+
+    def close(self) -> None:
+        pass
+
+def open_watcher(directory: str):
+    """Returns an InotifyWatcher for directory, or a PollingWatcher where inotify is unavailable."""
+    try:
+        watcher = InotifyWatcher(directory)
+        logger.info("Watching %s with inotify", directory)
+    except (OSError, AttributeError) as e:
+        watcher = PollingWatcher(directory)
+        logger.info("inotify unavailable (%s), polling %s every %ss", e, directory, WATCH_POLL_INTERVAL)
+    return watcher
+
+def init_watch_worker(options: Dict[str, Any], log_level: int) -> None:
+    """Worker initializer for --watch: Ctrl-C is handled by the parent, which shuts the pool down."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_worker(options, log_level)
+
+def watch_photographs(manifest: Dict[str, Any], fingerprint: str, jobs: int, gzip_index: bool = False,
+                      dedupe: bool = False) -> None:
+    """Processes photos as they land in PHOTOGRAPHS_DIR until interrupted.
+
+    Only the files named by watcher events are looked at, never the whole
+    folder (except after an inotify queue overflow). A changed file waits in
+    settling until its size and mtime have held still for
+    WATCH_SETTLE_SECONDS, then goes through plan_photo() and, if it needs it,
+    process_image() on a worker pool that stays warm between events. A file
+    that changes again while in flight is picked up once it is done. Deleted
+    photos have their derivatives and markdown removed. The photography
+    index and the manifest are saved after every change.
+
+    With dedupe every added, changed or deleted photo updates the hash index
+    and the duplicate groups like a full run does: photos whose group changed
+    are processed again, a duplicate waits for the photo it shares derivatives
+    with, and follows it whenever that photo is processed.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    watcher = open_watcher(PHOTOGRAPHS_DIR)
+    known = set(iter_image_files())
+    hash_index = load_hash_index() if dedupe else None
+    settling = {}
+    # Photo -> whether to rebuild, for photos waiting for a worker
+    queued = {}
+    in_flight = {}
+
+    def new_pool() -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=jobs, initializer=init_watch_worker,
+                                   initargs=worker_initargs())
+
+    def refresh_duplicates() -> None:
+        """Re-hashes new and changed photos and queues those whose duplicate group changed."""
+        nonlocal executor
+        if hash_index is None:
+            return
+        update_hash_index(hash_index, sorted(known))
+        save_hash_index(hash_index)
+        previous = PIPELINE_OPTIONS['duplicates']
+        duplicates = find_duplicates(hash_index)
+        if duplicates == previous:
+            return
+        set_pipeline_options({'duplicates': duplicates})
+        # Workers got the old groups from their initializer; in-flight photos finish on the old pool
+        executor.shutdown(wait=False)
+        executor = new_pool()
+        for filename in known:
+            if previous.get(filename) != duplicates.get(filename):
+                queued.setdefault(filename, False)
+
+    def deleted(filename: str) -> None:
+        settling.pop(filename, None)
+        queued.pop(filename, None)
+        known.discard(filename)
+        remove_photo(manifest, filename)
+        refresh_duplicates()
+        write_photo_index(manifest, gzip_index)
+        save_manifest(manifest)
+
+    executor = new_pool()
+    logger.info("Watching for new, changed and deleted photos (Ctrl-C to stop)")
+    try:
+        while True:
+            for event, filename in watcher.poll(WATCH_POLL_INTERVAL):
+                if event == 'rescan':
+                    present = set(iter_image_files())
+                    for name in known - present:
+                        deleted(name)
+                    settling.update({name: settling.get(name, (None, 0.0)) for name in present})
+                elif event == 'deleted' and not os.path.exists(os.path.join(PHOTOGRAPHS_DIR, filename)):
+                    deleted(filename)
+                elif event == 'changed':
+                    settling[filename] = settling.get(filename, (None, 0.0))
+
+            now = time.monotonic()
+            busy = {filename for filename, _, _, _ in in_flight.values()}
+            for filename, (signature, since) in list(settling.items()):
+                if filename in busy:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(PHOTOGRAPHS_DIR, filename))
+                except FileNotFoundError:
+                    settling.pop(filename)
+                    continue
+                current = (stat.st_size, stat.st_mtime_ns)
+                if current != signature:
+                    settling[filename] = (current, now)
+                    continue
+                if now - since < WATCH_SETTLE_SECONDS:
+                    continue
+                settling.pop(filename)
+                known.add(filename)
+                refresh_duplicates()
+                needs_processing, rebuild, _ = plan_photo(manifest, filename, fingerprint)
+                if needs_processing:
+                    queued[filename] = queued.get(filename, False) or rebuild
+                elif filename not in queued:
+                    logger.debug("Watch: %s is up to date", filename)
+
+            for filename in list(queued):
+                canonical = PIPELINE_OPTIONS['duplicates'].get(filename)
+                # A duplicate's markdown reads the derivatives of the photo it duplicates
+                if filename in busy or canonical in busy or canonical in settling or canonical in queued:
+                    continue
+                _, rebuild, source = plan_photo(manifest, filename, fingerprint)
+                rebuild = queued.pop(filename) or rebuild
+                if canonical:
+                    source['duplicateOf'] = canonical
+                logger.info("Watch: processing %s", filename)
+                future = executor.submit(process_image, filename, False, rebuild)
+                in_flight[future] = (filename, source, rebuild, time.monotonic())
+                busy.add(filename)
+
+            for future in [future for future in in_flight if future.done()]:
+                filename, source, rebuild, started = in_flight.pop(future)
+                try:
+                    success, message, _ = future.result()
+                except BrokenProcessPool:
+                    executor.shutdown(wait=False)
+                    executor = new_pool()
+                    success, message, _ = run_isolated(filename, rebuild)
+                except Exception as e:
+                    success, message = False, f"Worker failed while processing {filename}: {e!r}"
+                record_result(manifest, filename, success, source, fingerprint)
+                write_photo_index(manifest, gzip_index)
+                save_manifest(manifest)
+                if success:
+                    logger.info("Watch: processed %s in %.1fs", filename, time.monotonic() - started)
+                    for duplicate, canonical in PIPELINE_OPTIONS['duplicates'].items():
+                        if canonical == filename and duplicate in known:
+                            queued.setdefault(duplicate, False)
+                else:
+                    logger.error("Watch: %s", message)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        watcher.close()
+        save_manifest(manifest)
+
+class _NoProgress:
+    """Stands in for a tqdm bar when there is nothing to process."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def update(self, n: int = 1) -> None:
+        pass
+
+    def set_postfix(self, *args, **kwargs) -> None:
+        pass
+
+def progress_bar(total: int):
+    """Returns a tqdm bar over total photos, without importing tqdm when there are none."""
+    if not total:
+        return _NoProgress()
+    from tqdm import tqdm
+    return tqdm(total=total, desc="Processing images", unit="image")
+
+def main(argv: Optional[List[str]] = None):
     """Main function to process all images."""
-    logger.info(f"Scanning for photographs in: {PHOTOGRAPHS_DIR}")
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level, format=LOG_FORMAT)
+    # Ensure directories exist
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    os.makedirs(OPTIMIZED_DIR, exist_ok=True)
+    for directory in (OPTIMIZED_DIR, OUTPUT_DIR):
+        cleanup_temp_files(directory)
+    cleanup_temp_files(OPTIMIZED_DIR, LEGACY_TEMP_FILE_PATTERN)
+    cleanup_temp_files(os.path.dirname(MANIFEST_PATH), PROJECT_TEMP_FILE_PATTERN)
+    set_pipeline_options({
+        'verify_resize': args.verify_resize,
+        'formats': args.formats,
+        'draft': args.draft,
+        'passthrough': args.passthrough,
+        'previews': args.previews,
+        'quality_target': ({'ssim': args.target_ssim} if args.target_ssim is not None
+                           else {'bytesPerPixel': args.target_bytes_per_pixel} if args.target_bytes_per_pixel is not None
+                           else None),
+    })
+    logger.info("Scanning for photographs in: %s", PHOTOGRAPHS_DIR)
     
     # Get list of image files
-    image_files = [
-        f for f in os.listdir(PHOTOGRAPHS_DIR)
-        if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp', '.heic', '.heif'))
-    ]
+    image_files = sorted(iter_image_files())
+
+    # Group near-identical photos; only with --dedupe does each group share one set of derivatives
+    hash_index = update_hash_index(load_hash_index(), image_files)
+    save_hash_index(hash_index)
+    duplicates = find_duplicates(hash_index)
+    report_duplicates(duplicates, hash_index, shared=args.dedupe)
+    if not args.dedupe:
+        duplicates = {}
+    set_pipeline_options({'duplicates': duplicates})
+    
+    manifest = load_manifest()
+    if args.shard:
+        # A retried shard picks up where its previous attempt stopped
+        manifest['photos'].update(load_manifest(shard_manifest_path(*args.shard))['photos'])
+    prune_manifest(manifest, image_files)
     
     if not image_files:
         logger.warning("No image files found in the photographs directory")
+        if not args.watch:
+            write_photo_index(manifest, args.gzip_index)
+            save_manifest(manifest)
+            return
+    
+    # Skip photos whose source, encoder settings and outputs are unchanged
+    manifest['settings'] = encoder_settings()
+    fingerprint = settings_fingerprint(manifest['settings'])
+    if args.merge_shards:
+        try:
+            merged_paths = merge_shard_manifests(manifest, image_files, fingerprint)
+        except ValueError as e:
+            logger.error("%s", e)
+            sys.exit(1)
+        write_photo_index(manifest, args.gzip_index)
+        save_manifest(manifest)
+        for path in merged_paths:
+            os.remove(path)
         return
+    sources = {}
+    pending = []
+    rebuild = set()
+    for filename in image_files:
+        needs_processing, needs_rebuild, sources[filename] = plan_photo(manifest, filename, fingerprint, args.force)
+        if needs_processing:
+            pending.append(filename)
+        if needs_rebuild:
+            rebuild.add(filename)
+    # A duplicate is refreshed along with the photo it shares derivatives with,
+    # and whenever what it duplicates changes
+    for filename in image_files:
+        canonical = duplicates.get(filename)
+        if canonical:
+            sources[filename]['duplicateOf'] = canonical
+        entry = manifest['photos'].get(filename, {})
+        if filename not in pending and (canonical in pending or entry.get('duplicateOf') != canonical):
+            pending.append(filename)
+    owned = image_files
+    if args.shard:
+        # Duplicates follow the photo they share derivatives with, so a group never spans shards
+        index, count = args.shard
+        owned = [f for f in image_files if shard_of(sources[duplicates.get(f, f)]['sha256'], count) == index]
+        pending = [f for f in pending if f in set(owned)]
+        logger.info("Shard %s/%s owns %s of %s photos", index, count, len(owned), len(image_files))
+    logger.info("%s photos up to date, %s to process", len(owned) - len(pending), len(pending))
+    if pending:
+        logger.debug("Preloaded frontmatter of %s markdown files", preload_frontmatter())
     
     # Process images with progress bar
     success_count = 0
     error_count = 0
     errors = []
+    exif_cache = {'hits': 0, 'misses': 0}
+    encode_totals = {}
+    search_totals = {'variants': 0, 'encodes': 0, 'seconds': 0.0}
+    resize_totals = {'photos': 0, 'cascadeSeconds': 0.0, 'verified': 0, 'directSeconds': 0.0, 'savedSeconds': 0.0}
+    photo_reports = []
+    jobs = min(args.jobs, len(pending)) if pending else 1
+    if args.profile and (jobs > 1 or args.stream):
+        # cProfile only sees the current thread of the current process
+        logger.warning("--profile runs photos serially in this process")
+        jobs, args.stream = 1, False
+    profiler = cProfile.Profile() if args.profile else None
     
-    with tqdm(total=len(image_files), desc="Processing images", unit="image") as pbar:
-        for filename in image_files:
-            success, message = process_image(filename)
+    with progress_bar(len(pending)) as pbar:
+        def on_result(filename: str, success: bool, message: str, stats: Dict[str, Any]) -> None:
+            nonlocal success_count, error_count
+            photo_reports.append({'photo': filename, 'success': success, 'message': message, **stats})
+            for key, value in stats.get('exifCache', {}).items():
+                exif_cache[key] += value
+            for variant in stats.get('encode', {}).values():
+                format_name = f"{variant['format']} (passthrough)" if variant.get('passthrough') else variant['format']
+                totals = encode_totals.setdefault(format_name, {'files': 0, 'bytes': 0, 'seconds': 0.0})
+                totals['files'] += 1
+                totals['bytes'] += variant['bytes']
+                totals['seconds'] += variant['seconds']
+                if 'searchEncodes' in variant:
+                    search_totals['variants'] += 1
+                    search_totals['encodes'] += variant['searchEncodes']
+                    search_totals['seconds'] += variant['seconds']
+            if 'resize' in stats:
+                resize_totals['photos'] += 1
+                resize_totals['cascadeSeconds'] += stats['resize']['cascadeSeconds']
+                if 'savedSeconds' in stats['resize']:
+                    resize_totals['verified'] += 1
+                    resize_totals['directSeconds'] += stats['resize']['directSeconds']
+                    resize_totals['savedSeconds'] += stats['resize']['savedSeconds']
+            record_result(manifest, filename, success, sources[filename], fingerprint)
             if success:
                 success_count += 1
             else:
@@ -627,21 +3169,81 @@ def main():
                 errors.append(message)
             pbar.update(1)
             pbar.set_postfix({"success": success_count, "errors": error_count})
+
+        try:
+            if profiler is not None:
+                profiler.enable()
+            # Duplicates go last, their markdown reads the shared derivatives
+            for batch in ([f for f in pending if f not in duplicates], [f for f in pending if f in duplicates]):
+                if not batch:
+                    continue
+                if args.stream:
+                    run_streaming(batch, on_result, frozenset(rebuild), args.memory_budget)
+                elif min(jobs, len(batch)) > 1:
+                    logger.info("Processing %s images with %s worker processes", len(batch), min(jobs, len(batch)))
+                    run_parallel(batch, min(jobs, len(batch)), on_result, frozenset(rebuild))
+                else:
+                    run_serial(batch, on_result, frozenset(rebuild))
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(args.profile)
+                logger.info("Wrote cProfile stats to %s", args.profile)
+            # Keep progress made so far even if the run is interrupted
+            if args.shard:
+                # The index needs every photo, --merge-shards writes it
+                save_shard_manifest(manifest, owned, args.shard)
+            else:
+                write_photo_index(manifest, args.gzip_index)
+                save_manifest(manifest)
+            if args.report:
+                write_run_report(args.report, photo_reports)
     
-    # Cleanup temporary files
-    cleanup_temp_files(OPTIMIZED_DIR)
+    # Cleanup temporary files, e.g. of a worker that died mid-write
+    for directory in (OPTIMIZED_DIR, OUTPUT_DIR):
+        cleanup_temp_files(directory)
     
     # Print summary
-    logger.info(f"\nProcessing complete!")
-    logger.info(f"Successfully processed: {success_count} images")
+    logger.info("\nProcessing complete!")
+    logger.info("Successfully processed: %s images", success_count)
+    if args.stream:
+        # Every stage ran in this process, so the global counters are the totals
+        exif_cache = dict(EXIF_CACHE_STATS)
+    logger.info("EXIF cache: %s hits, %s misses", exif_cache['hits'], exif_cache['misses'])
+    for format_name, totals in sorted(encode_totals.items()):
+        logger.info(
+            "Encoded %s: %s files, %.1f MB in %.2fs CPU",
+            format_name, totals['files'], totals['bytes'] / 1024 / 1024, totals['seconds']
+        )
+    if search_totals['variants']:
+        logger.info(
+            "Quality search: %s variants, %s trial encodes (%.1f per variant) in %.2fs CPU",
+            search_totals['variants'], search_totals['encodes'],
+            search_totals['encodes'] / search_totals['variants'], search_totals['seconds']
+        )
+    if resize_totals['verified']:
+        logger.info(
+            "Resize cascade: %s photos in %.2fs vs %.2fs direct, saved %.2fs",
+            resize_totals['photos'], resize_totals['cascadeSeconds'], resize_totals['directSeconds'],
+            resize_totals['savedSeconds']
+        )
+    elif resize_totals['photos']:
+        logger.info("Resize cascade: %s photos in %.2fs", resize_totals['photos'], resize_totals['cascadeSeconds'])
+    stage_summary = summarize_stages(stage for report in photo_reports for stage in report.get('stages', []))
+    if stage_summary:
+        logger.info("Stage timings:\n%s", format_stage_table(stage_summary))
     if error_count > 0:
-        logger.warning(f"Failed to process: {error_count} images")
+        logger.warning("Failed to process: %s images", error_count)
         logger.warning("Errors encountered:")
         for error in errors:
-            logger.warning(f"- {error}")
+            logger.warning("- %s", error)
+
+    if args.watch:
+        watch_photographs(manifest, fingerprint, args.jobs, args.gzip_index, args.dedupe)
+        return
     
     if error_count > 0:
         sys.exit(1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file
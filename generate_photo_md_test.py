@@ -0,0 +1,643 @@
+"""Tests for generate_photo_md that run the pipeline on small synthetic photos."""
+
+import io
+import json
+import os
+import random
+import struct
+
+import piexif
+import pytest
+from PIL import Image, ImageOps
+
+import generate_photo_md as photo_md
+
+# Landscape pixels stored sideways: Orientation 6 turns them into a portrait photo
+SOURCE_SIZE = (640, 480)
+
+def rotated_exif(with_thumbnail: bool) -> bytes:
+    """Returns EXIF telling viewers to rotate the pixels 90 degrees clockwise."""
+    exif_dict = {'0th': {piexif.ImageIFD.Orientation: 6}, 'Exif': {}, 'GPS': {}, '1st': {}}
+    if with_thumbnail:
+        thumbnail = io.BytesIO()
+        split_image((160, 120)).save(thumbnail, 'JPEG', quality=95)
+        exif_dict['1st'] = {piexif.ImageIFD.JPEGInterchangeFormat: 0,
+                            piexif.ImageIFD.JPEGInterchangeFormatLength: 0}
+        exif_dict['thumbnail'] = thumbnail.getvalue()
+    return piexif.dump(exif_dict)
+
+def split_image(size):
+    """Builds a red left half and a blue right half, i.e. red on top once upright."""
+    image = Image.new('RGB', size, (30, 60, 200))
+    image.paste((220, 40, 30), (0, 0, size[0] // 2, size[1]))
+    return image
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    """Points generate_photo_md at a temporary site, with the options of a fresh process."""
+    monkeypatch.setattr(photo_md, 'PROJECT_ROOT', str(tmp_path))
+    monkeypatch.setattr(photo_md, 'PHOTOGRAPHS_DIR', str(tmp_path / 'photographs'))
+    monkeypatch.setattr(photo_md, 'OPTIMIZED_DIR', str(tmp_path / 'photographs' / 'optimized'))
+    monkeypatch.setattr(photo_md, 'OUTPUT_DIR', str(tmp_path / 'markdown'))
+    monkeypatch.setattr(photo_md, 'MANIFEST_PATH', str(tmp_path / '.photo-manifest.json'))
+    monkeypatch.setattr(photo_md, 'HASH_INDEX_PATH', str(tmp_path / '.photo-hashes.json'))
+    monkeypatch.setattr(photo_md, 'PIPELINE_OPTIONS', dict(photo_md.PIPELINE_OPTIONS))
+    os.makedirs(photo_md.OPTIMIZED_DIR)
+    os.makedirs(photo_md.OUTPUT_DIR)
+    photo_md._EXIF_CACHE.clear()
+    return tmp_path
+
+def add_photo(filename: str, size=(900, 600), color=None, **options) -> str:
+    """Saves split_image(size), or a flat color, into PHOTOGRAPHS_DIR and returns its path."""
+    path = os.path.join(photo_md.PHOTOGRAPHS_DIR, filename)
+    image = split_image(size) if color is None else Image.new('RGB', size, color)
+    image.save(path, **options)
+    return path
+
+def run_main(*args: str) -> None:
+    """Runs the command line in this process, serially, and fails the test if it exits."""
+    try:
+        photo_md.main(['-j', '1', '--log-level', 'WARNING', *args])
+    except SystemExit as e:
+        pytest.fail(f"main() exited with {e.code}")
+
+def load_state() -> dict:
+    with open(photo_md.MANIFEST_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+@pytest.mark.parametrize('with_thumbnail', [False, True], ids=['decoded', 'exif-thumbnail'])
+def test_orientation_6_derivatives_are_upright(pipeline, with_thumbnail):
+    input_path = os.path.join(photo_md.PHOTOGRAPHS_DIR, 'rotated.jpg')
+    split_image(SOURCE_SIZE).save(input_path, 'JPEG', quality=95, exif=rotated_exif(with_thumbnail))
+
+    stats = {}
+    assert photo_md.optimize_image(input_path, os.path.join(photo_md.OPTIMIZED_DIR, 'rotated.jpg'), stats=stats)
+    photo_md.output_writer().flush()
+
+    upright = ImageOps.exif_transpose(Image.open(input_path))
+    assert upright.size == (480, 640)
+    for derivative, path in photo_md.derivative_paths('rotated.jpg').items():
+        if not derivative.endswith('.jpg'):
+            continue
+        with Image.open(path) as image:
+            width, height = image.size
+            # The blur is squashed to BLUR_SIZE, its colors still show which way is up
+            assert height > width or derivative == 'blur.jpg', derivative
+            assert image.getexif().get(0x0112, 1) == 1, derivative
+            top = image.convert('RGB').getpixel((width // 2, height // 8))
+            bottom = image.convert('RGB').getpixel((width // 2, height * 7 // 8))
+            assert top[0] > top[2] and bottom[2] > bottom[0], derivative
+
+    # The placeholder describes the photo as displayed, not the stored pixels
+    thumb = upright.resize(photo_md.fit_size(upright.size, photo_md.VARIANT_SIZES['thumb']), Image.Resampling.LANCZOS)
+    expected = photo_md.placeholder_stats(thumb)
+    sideways = photo_md.placeholder_stats(thumb.transpose(Image.Transpose.ROTATE_90))
+    assert stats['placeholder']['blurhash'][0] == expected['blurhash'][0] != sideways['blurhash'][0]
+    assert stats['placeholder']['dominantColor'] == expected['dominantColor']
+    assert stats['placeholder']['luminanceHistogram'] == pytest.approx(expected['luminanceHistogram'], abs=0.02)
+
+# rewrite_exif(): EXIF blocks are laid out by hand so byte order and offsets are known
+
+GPS_LATITUDE = ((13, 1), (4, 1), (5000, 100))
+MAKER_NOTE = b'Apple iOS\x00\x00\x01MM' + bytes(range(32))
+
+def tiff_exif(order, ifd0, exif=None, gps=None, thumbnail=None):
+    """Builds 'Exif\\0\\0' plus a TIFF block: IFD0, then the Exif IFD, GPS IFD and IFD1.
+
+    Each IFD is a list of (tag, type, value); the sub-IFD and thumbnail
+    pointers are added here. Values longer than 4 bytes follow their IFD.
+    """
+    def pack(field_type, value):
+        if field_type in (1, 2, 7):
+            return bytes(value)
+        values = [value] if isinstance(value, int) else [v for pair in value for v in pair] if field_type == 5 else value
+        return struct.pack(f"{order}{len(values)}{'H' if field_type == 3 else 'I'}", *values)
+
+    def ifd_size(entries):
+        return 2 + 12 * len(entries) + 4 + sum((len(pack(t, v)) + 1) & ~1 for _, t, v in entries if len(pack(t, v)) > 4)
+
+    ifd0 = list(ifd0) + [(tag, 4, 0) for tag, ifd in ((0x8769, exif), (0x8825, gps)) if ifd is not None]
+    ifd1 = [(0x0201, 4, 0), (0x0202, 4, len(thumbnail))] if thumbnail is not None else None
+    offsets, position = {}, 8
+    for name, entries in (('0th', ifd0), ('Exif', exif), ('GPS', gps), ('1st', ifd1)):
+        if entries is not None:
+            offsets[name], position = position, position + ifd_size(entries)
+    pointers = {0x8769: offsets.get('Exif'), 0x8825: offsets.get('GPS'), 0x0201: position}
+
+    def build(entries, offset, next_ifd=0):
+        entries = sorted((tag, t, pointers[tag] if tag in pointers else v) for tag, t, v in entries)
+        table, data = struct.pack(order + 'H', len(entries)), b''
+        data_offset = offset + 2 + 12 * len(entries) + 4
+        for tag, field_type, value in entries:
+            raw = pack(field_type, value)
+            count = len(raw) // photo_md.TIFF_TYPE_SIZES[field_type]
+            if len(raw) > 4:
+                table += struct.pack(order + 'HHII', tag, field_type, count, data_offset + len(data))
+                data += raw + b'\x00' * (len(raw) & 1)
+            else:
+                table += struct.pack(order + 'HHI', tag, field_type, count)[:8] + raw.ljust(4, b'\x00')
+        return table + struct.pack(order + 'I', next_ifd) + data
+
+    block = (b'II*\x00' if order == '<' else b'MM\x00*') + struct.pack(order + 'I', 8)
+    block += build(ifd0, 8, offsets.get('1st', 0))
+    for name, entries in (('Exif', exif), ('GPS', gps), ('1st', ifd1)):
+        if entries is not None:
+            block += build(entries, offsets[name])
+    return b'Exif\x00\x00' + block + (thumbnail or b'')
+
+def camera_exif(order, thumbnail=None, with_exif_ifd=True):
+    """Camera-like EXIF: Orientation 6, time offsets, a MakerNote and GPS data."""
+    exif = [
+        (0x9003, 2, b'2021:05:15 20:22:28\x00'),  # DateTimeOriginal
+        (0x9011, 2, b'+05:30\x00'),  # OffsetTimeOriginal
+        (0x9291, 2, b'42\x00'),  # SubSecTimeOriginal
+        (0x927C, 7, MAKER_NOTE),
+    ] if with_exif_ifd else None
+    return tiff_exif(
+        order, [(0x010F, 2, b'Apple\x00'), (0x0110, 2, b'iPhone XR\x00'), (photo_md.ORIENTATION_TAG, 3, 6)],
+        exif=exif, gps=[(0x0001, 2, b'N\x00'), (0x0002, 5, GPS_LATITUDE)], thumbnail=thumbnail,
+    )
+
+def jpeg_bytes(size=(16, 12), **options) -> bytes:
+    """Encodes split_image(size) as a JPEG."""
+    output = io.BytesIO()
+    split_image(size).save(output, 'JPEG', **options)
+    return output.getvalue()
+
+@pytest.mark.parametrize('order', ['<', '>'], ids=['II', 'MM'])
+def test_rewrite_exif_strips_gps_and_time_offsets(order):
+    thumbnail = jpeg_bytes()
+    original = camera_exif(order, thumbnail)
+    stripped = photo_md.rewrite_exif(original)
+
+    # Edited in place: same size, and nothing that was kept has moved
+    assert len(stripped) == len(original)
+    assert stripped.find(MAKER_NOTE) == original.find(MAKER_NOTE)
+    assert stripped.find(thumbnail) == original.find(thumbnail)
+    loaded = piexif.load(stripped)
+    assert loaded['0th'][piexif.ImageIFD.Make] == b'Apple'
+    assert loaded['0th'][piexif.ImageIFD.Orientation] == 6
+    assert piexif.ImageIFD.GPSTag not in loaded['0th'] and not loaded['GPS']
+    assert loaded['Exif'][piexif.ExifIFD.DateTimeOriginal] == b'2021:05:15 20:22:28'
+    assert loaded['Exif'][piexif.ExifIFD.MakerNote] == MAKER_NOTE
+    assert piexif.ExifIFD.OffsetTimeOriginal not in loaded['Exif']
+    assert piexif.ExifIFD.SubSecTimeOriginal not in loaded['Exif']
+    # The IFD1 pointer moved up with IFD0's entry table
+    assert loaded['thumbnail'] == thumbnail
+    # The GPS values themselves are gone, not just unreferenced
+    latitude = struct.pack(f'{order}6I', *(v for pair in GPS_LATITUDE for v in pair))
+    assert latitude in original and latitude not in stripped
+    assert b'+05:30' not in stripped
+
+@pytest.mark.parametrize('order', ['<', '>'], ids=['II', 'MM'])
+def test_rewrite_exif_without_exif_ifd(order):
+    stripped = photo_md.rewrite_exif(camera_exif(order, with_exif_ifd=False))
+    loaded = piexif.load(stripped)
+    assert loaded['0th'][piexif.ImageIFD.Model] == b'iPhone XR'
+    assert not loaded['GPS'] and not loaded['Exif']
+
+@pytest.mark.parametrize('reset_orientation, expected', [(False, 6), (True, 1)])
+def test_rewrite_exif_reset_orientation(reset_orientation, expected):
+    stripped = photo_md.rewrite_exif(camera_exif('<'), reset_orientation=reset_orientation)
+    assert piexif.load(stripped)['0th'][piexif.ImageIFD.Orientation] == expected
+
+@pytest.mark.parametrize('exif_bytes', [
+    b'Exif\x00\x00XX*\x00\x08\x00\x00\x00',
+    camera_exif('>')[:40],
+], ids=['bad-byte-order', 'truncated'])
+def test_rewrite_exif_rejects_malformed_input(exif_bytes):
+    with pytest.raises(ValueError):
+        photo_md.rewrite_exif(exif_bytes)
+
+def test_strip_gps_falls_back_to_piexif():
+    original = camera_exif('>')
+    # A stripped tag pointing past the end: the in-place rewrite refuses, piexif copes
+    entry = original.index(struct.pack('>HHI', 0x9011, 2, 7))
+    corrupt = original[:entry + 8] + struct.pack('>I', 100000) + original[entry + 12:]
+    with pytest.raises(ValueError):
+        photo_md.rewrite_exif(corrupt)
+    stripped = photo_md.strip_gps_from_exif_bytes(corrupt, reset_orientation=True)
+    assert stripped == photo_md._strip_gps_with_piexif(corrupt, True)
+    loaded = piexif.load(stripped)
+    assert loaded['0th'][piexif.ImageIFD.Orientation] == 1
+    assert not loaded['GPS'] and piexif.ExifIFD.OffsetTimeOriginal not in loaded['Exif']
+
+def test_strip_gps_returns_unparseable_input_unchanged():
+    assert photo_md.strip_gps_from_exif_bytes(b'Exif\x00\x00garbage') == b'Exif\x00\x00garbage'
+
+# rewrap_jpeg(): segments are spliced into Pillow-encoded JPEGs
+
+def segment(marker: int, payload: bytes) -> bytes:
+    return bytes([0xFF, marker]) + struct.pack('>H', len(payload) + 2) + payload
+
+def header_segments(data: bytes):
+    """Returns (marker, payload) of every segment before the first scan."""
+    segments, pos = [], 2
+    while data[pos + 1] != 0xDA:
+        length = struct.unpack_from('>H', data, pos + 2)[0]
+        segments.append((data[pos + 1], data[pos + 4:pos + 2 + length]))
+        pos += 2 + length
+    return segments
+
+def decoded(data: bytes) -> bytes:
+    with Image.open(io.BytesIO(data)) as image:
+        return image.tobytes()
+
+@pytest.mark.parametrize('options', [{}, {'progressive': True}, {'restart_marker_blocks': 1}],
+                         ids=['baseline', 'progressive', 'restart-markers'])
+def test_rewrap_jpeg_keeps_the_image_data(options):
+    source = jpeg_bytes((64, 48), quality=90, **options)
+    rewrapped = photo_md.rewrap_jpeg(source)
+    assert rewrapped.endswith(b'\xff\xd9')
+    assert decoded(rewrapped) == decoded(source)
+    if options.get('progressive'):
+        assert rewrapped.count(b'\xff\xda') > 1
+
+def test_rewrap_jpeg_skips_fill_bytes():
+    source = jpeg_bytes((64, 48), quality=90, restart_marker_blocks=1)
+    assert b'\xff\xd0' in source
+    # 0xFF fill bytes may precede any marker: a header segment, RSTn and EOI
+    padded = source[:2] + b'\xff\xff' + source[2:]
+    padded = padded.replace(b'\xff\xd0', b'\xff\xff\xff\xd0')[:-2] + b'\xff\xff\xd9'
+    assert decoded(padded) == decoded(source)
+    rewrapped = photo_md.rewrap_jpeg(padded)
+    assert rewrapped.endswith(b'\xff\xff\xd9')
+    assert decoded(rewrapped) == decoded(source)
+
+def test_rewrap_jpeg_replaces_exif_after_jfif():
+    old_exif = camera_exif('>')
+    new_exif = photo_md.rewrite_exif(old_exif, reset_orientation=True)
+    source = jpeg_bytes(quality=90, exif=old_exif)
+    assert [marker for marker, _ in header_segments(source)][:2] == [0xE0, 0xE1]
+
+    rewrapped = photo_md.rewrap_jpeg(source, new_exif)
+    segments = header_segments(rewrapped)
+    assert segments[0][0] == 0xE0 and segments[0][1].startswith(b'JFIF\x00')
+    assert segments[1] == (0xE1, new_exif)
+    assert [marker for marker, _ in segments].count(0xE1) == 1
+    assert photo_md.rewrap_jpeg(source).find(b'Exif\x00\x00') < 0
+
+def test_rewrap_jpeg_drops_metadata_and_trailing_images():
+    source = jpeg_bytes(quality=90)
+    extra = (
+        segment(0xE1, b'http://ns.adobe.com/xap/1.0/\x00<x:xmpmeta>GPS</x:xmpmeta>')
+        + segment(0xFE, b'taken at home')
+        + segment(0xE2, b'MPF\x00MM\x00*\x00\x00\x00\x08')
+    )
+    jfif_end = 4 + struct.unpack_from('>H', source, 4)[0]
+    # MPO: the secondary image is a whole JPEG stored after the primary's EOI
+    tagged = source[:jfif_end] + extra + source[jfif_end:] + jpeg_bytes((8, 8))
+
+    rewrapped = photo_md.rewrap_jpeg(tagged)
+    assert rewrapped == photo_md.rewrap_jpeg(source)
+    for payload in (b'xmpmeta', b'taken at home', b'MPF\x00'):
+        assert payload not in rewrapped
+    assert rewrapped.count(b'\xff\xd8') == 1 and rewrapped.endswith(b'\xff\xd9')
+    assert decoded(rewrapped) == decoded(source)
+
+def truncated_after_second_scan_marker() -> bytes:
+    source = jpeg_bytes((64, 48), progressive=True)
+    second_scan = source.index(b'\xff\xda', source.index(b'\xff\xda') + 2)
+    return source[:second_scan + 3]
+
+@pytest.mark.parametrize('data', [
+    b'\x89PNG\r\n\x1a\n',
+    jpeg_bytes()[:-2],
+    truncated_after_second_scan_marker(),
+    jpeg_bytes()[:2] + b'\x00\x00\x00\x00' + jpeg_bytes()[2:],
+], ids=['not-jpeg', 'no-eoi', 'truncated-scan-header', 'corrupt-marker'])
+def test_rewrap_jpeg_rejects_corrupt_input(data):
+    with pytest.raises(ValueError):
+        photo_md.rewrap_jpeg(data)
+
+def test_streaming_encodes_each_derivative_once(pipeline, monkeypatch):
+    input_path = os.path.join(photo_md.PHOTOGRAPHS_DIR, 'photo.jpg')
+    split_image((900, 600)).save(input_path, 'JPEG', quality=95)
+    results = []
+    on_result = lambda *result: results.append(result[:3])
+    photo_md.run_streaming(['photo.jpg'], on_result)
+
+    # A touched source with byte-identical derivatives: they are rebuilt but
+    # not rewritten, so their mtimes stay older than the source's
+    stat = os.stat(input_path)
+    os.utime(input_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 10))
+    monkeypatch.setattr(photo_md, 'optimize_image', lambda *args, **kwargs: pytest.fail("encoded twice"))
+    photo_md.run_streaming(['photo.jpg'], on_result, rebuild=frozenset({'photo.jpg'}))
+    assert results == [('photo.jpg', True, "Successfully processed photo.jpg")] * 2
+
+# Manifest: unchanged photos are skipped, deleted ones pruned
+
+def test_manifest_skips_up_to_date_photos(pipeline, monkeypatch):
+    add_photo('first.jpg', quality=90)
+    add_photo('second.png', color=(20, 120, 60))
+    run_main()
+    photos = load_state()['photos']
+    assert sorted(photos) == ['first.jpg', 'second.png']
+    for entry in photos.values():
+        assert all(os.path.exists(pipeline / output) for output in entry['outputs'])
+
+    # Nothing changed, or only an mtime (e.g. a fresh checkout): nothing is processed
+    monkeypatch.setattr(photo_md, 'process_image', lambda *args, **kwargs: pytest.fail("reprocessed"))
+    run_main()
+    path = os.path.join(photo_md.PHOTOGRAPHS_DIR, 'second.png')
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 10))
+    run_main()
+    assert load_state()['photos']['second.png']['mtime'] == os.stat(path).st_mtime_ns
+
+def test_manifest_reprocesses_changed_and_incomplete_photos(pipeline):
+    add_photo('first.jpg', quality=90)
+    add_photo('second.jpg', quality=90)
+    run_main()
+    before = load_state()['photos']
+
+    add_photo('first.jpg', color=(200, 200, 0), quality=90)
+    os.remove(photo_md.derivative_paths('second.jpg')['medium.webp'])
+    run_main()
+    after = load_state()['photos']
+    assert after['first.jpg']['sha256'] != before['first.jpg']['sha256']
+    assert os.path.exists(photo_md.derivative_paths('second.jpg')['medium.webp'])
+
+def test_manifest_prunes_deleted_photos(pipeline):
+    add_photo('kept.jpg', quality=90)
+    deleted = add_photo('deleted.jpg', color=(10, 10, 10), quality=90)
+    run_main()
+    outputs = load_state()['photos']['deleted.jpg']['outputs']
+    assert outputs and all(os.path.exists(pipeline / output) for output in outputs)
+
+    os.remove(deleted)
+    run_main()
+    state = load_state()
+    assert list(state['photos']) == ['kept.jpg']
+    assert not any(os.path.exists(pipeline / output) for output in outputs)
+    with open(os.path.join(photo_md.OUTPUT_DIR, photo_md.INDEX_FILENAME), encoding='utf-8') as f:
+        assert [record['source'] for record in json.load(f)['photos']] == ['kept.jpg']
+
+def test_failed_photo_is_not_recorded(pipeline):
+    add_photo('good.jpg', quality=90)
+    with open(os.path.join(photo_md.PHOTOGRAPHS_DIR, 'broken.jpg'), 'wb') as f:
+        f.write(b'\xff\xd8 not really a JPEG')
+    with pytest.raises(SystemExit):
+        photo_md.main(['-j', '1', '--log-level', 'ERROR'])
+    assert list(load_state()['photos']) == ['good.jpg']
+    assert not os.path.exists(os.path.join(photo_md.OUTPUT_DIR, 'broken.md'))
+
+# index.json: byte-identical for an unchanged photo set
+
+def index_path() -> str:
+    return os.path.join(photo_md.OUTPUT_DIR, photo_md.INDEX_FILENAME)
+
+def read_bytes(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_photo_index_is_deterministic(pipeline):
+    add_photo('b.jpg', quality=90)
+    add_photo('a.png', color=(20, 120, 60))
+    run_main('--gzip-index')
+    data = read_bytes(index_path())
+    index = json.loads(data)
+    assert index['version'] == photo_md.INDEX_VERSION
+    assert [record['id'] for record in index['photos']] == ['a', 'b']
+    # Compact with sorted keys, so the bytes follow from the content alone
+    assert data == json.dumps(index, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode() + b'\n'
+    for record in index['photos']:
+        assert 'variants' not in record['frontmatter']
+        assert set(record['variants']) == {*photo_md.VARIANT_SIZES, 'blur'}
+
+    # Unchanged photos leave both files untouched; records rebuilt from disk match the cached ones
+    mtimes = [os.stat(path).st_mtime_ns for path in (index_path(), index_path() + '.gz')]
+    gzipped = read_bytes(index_path() + '.gz')
+    run_main('--gzip-index')
+    assert [os.stat(path).st_mtime_ns for path in (index_path(), index_path() + '.gz')] == mtimes
+    manifest = load_state()
+    for entry in manifest['photos'].values():
+        del entry['index']
+    photo_md.write_photo_index(manifest, gzip_copy=True)
+    assert read_bytes(index_path()) == data
+    assert read_bytes(index_path() + '.gz') == gzipped
+
+    # Without --gzip-index a stale copy is removed
+    run_main()
+    assert not os.path.exists(index_path() + '.gz')
+
+# Duplicate detection: grouping by perceptual hash distance
+
+def hash_entry(phash: int, width: int, height: int = 100) -> dict:
+    return {'phash': f"{phash:016x}", 'width': width, 'height': height, 'size': 0, 'mtime': 0}
+
+def test_find_duplicates_groups_by_distance():
+    limit = photo_md.DEDUPE_MAX_DISTANCE
+    base = 0x0123456789ABCDEF
+    within = base ^ ((1 << limit) - 1)  # limit bits flipped
+    beyond = base ^ ((1 << (limit + 1)) - 1) << 20  # limit + 1 bits flipped
+    index = {'photos': {
+        'small.jpg': hash_entry(within, 100),
+        'large.jpg': hash_entry(base, 400),
+        'other.jpg': hash_entry(beyond, 300),
+        'copy.jpg': hash_entry(base, 100),
+    }}
+    assert photo_md.hamming_distance(base, within) == limit
+    assert photo_md.hamming_distance(base, beyond) == limit + 1
+    # The largest photo of a group represents it, ties go to the first name
+    assert photo_md.find_duplicates(index) == {'small.jpg': 'large.jpg', 'copy.jpg': 'large.jpg'}
+    assert photo_md.find_duplicates(index, max_distance=limit + 1) == {
+        'small.jpg': 'large.jpg', 'copy.jpg': 'large.jpg', 'other.jpg': 'large.jpg',
+    }
+    assert photo_md.find_duplicates(index, max_distance=0) == {'copy.jpg': 'large.jpg'}
+
+def test_resized_copies_are_near_duplicates(pipeline):
+    add_photo('original.jpg', size=(1200, 800), quality=95)
+    add_photo('resized.jpg', size=(600, 400), quality=70)
+    add_photo('different.png', color=(40, 200, 40))
+    index = photo_md.update_hash_index(photo_md.load_hash_index(), sorted(photo_md.iter_image_files()))
+    assert photo_md.find_duplicates(index) == {'resized.jpg': 'original.jpg'}
+
+def test_near_duplicates_share_derivatives_only_with_dedupe(pipeline):
+    add_photo('original.jpg', size=(1200, 800), quality=95)
+    add_photo('resized.jpg', size=(600, 400), quality=70)
+    run_main()
+    # Reported, but every photo keeps its own derivatives
+    assert os.path.exists(os.path.join(photo_md.OPTIMIZED_DIR, 'resized_thumb.jpg'))
+    assert 'duplicateOf' not in load_state()['photos']['resized.jpg']
+
+    run_main('--dedupe')
+    assert load_state()['photos']['resized.jpg']['duplicateOf'] == 'original.jpg'
+    assert not any(name.startswith('resized_') for name in os.listdir(photo_md.OPTIMIZED_DIR))
+    frontmatter = photo_md.read_existing_markdown(os.path.join(photo_md.OUTPUT_DIR, 'resized.md'))
+    assert frontmatter['image'] == '/photographs/optimized/original.jpg'
+
+    run_main()
+    assert 'duplicateOf' not in load_state()['photos']['resized.jpg']
+    assert os.path.exists(os.path.join(photo_md.OPTIMIZED_DIR, 'resized_thumb.jpg'))
+
+# search_quality(): bisection over QUALITY_SEARCH_RANGE
+
+def noisy_image(size=(240, 180)) -> Image.Image:
+    """A gradient with grain, so quality visibly moves both SSIM and file size."""
+    rng = random.Random(7)
+    gradient = Image.linear_gradient('L').resize(size).convert('RGB')
+    noise = Image.frombytes('RGB', size, rng.randbytes(size[0] * size[1] * 3))
+    return Image.blend(gradient, noise, 0.3)
+
+def encode_at(image: Image.Image, quality: int) -> bytes:
+    output = io.BytesIO()
+    image.save(output, 'JPEG', **dict(photo_md.OUTPUT_FORMAT_SETTINGS['jpeg']['options'], quality=quality))
+    return output.getvalue()
+
+def ssim_at(image: Image.Image, quality: int) -> float:
+    with Image.open(io.BytesIO(encode_at(image, quality))) as decoded:
+        return photo_md.ssim(image, decoded)
+
+@pytest.mark.parametrize('target', [0.9, 0.97])
+def test_search_quality_finds_lowest_quality_reaching_ssim(monkeypatch, target):
+    monkeypatch.setitem(photo_md.PIPELINE_OPTIONS, 'quality_target', {'ssim': target})
+    image = noisy_image()
+    data, search = photo_md.search_quality(image, photo_md.OUTPUT_FORMAT_SETTINGS['jpeg'])
+    low, high = photo_md.QUALITY_SEARCH_RANGE
+    quality = search['quality']
+    assert low < quality < high
+    assert data == encode_at(image, quality)
+    assert search['ssim'] == pytest.approx(ssim_at(image, quality), abs=1e-5) and search['ssim'] >= target
+    # Bisection tried the quality just below and it fell short
+    assert ssim_at(image, quality - 1) < target
+    assert search['encodes'] <= (high - low + 1).bit_length()
+
+@pytest.mark.parametrize('bytes_per_pixel', [0.15, 0.5])
+def test_search_quality_finds_highest_quality_within_budget(monkeypatch, bytes_per_pixel):
+    monkeypatch.setitem(photo_md.PIPELINE_OPTIONS, 'quality_target', {'bytesPerPixel': bytes_per_pixel})
+    image = noisy_image()
+    budget = bytes_per_pixel * image.size[0] * image.size[1]
+    data, search = photo_md.search_quality(image, photo_md.OUTPUT_FORMAT_SETTINGS['jpeg'])
+    low, high = photo_md.QUALITY_SEARCH_RANGE
+    quality = search['quality']
+    assert low < quality < high
+    assert data == encode_at(image, quality) and len(data) <= budget
+    assert len(encode_at(image, quality + 1)) > budget
+    assert search['encodes'] <= (high - low + 1).bit_length()
+
+@pytest.mark.parametrize('target, expected', [
+    ({'ssim': 0.999999}, photo_md.QUALITY_SEARCH_RANGE[1]),
+    ({'bytesPerPixel': 0.001}, photo_md.QUALITY_SEARCH_RANGE[0]),
+], ids=['ssim', 'bytes-per-pixel'])
+def test_search_quality_falls_back_to_the_nearest_end(monkeypatch, target, expected):
+    monkeypatch.setitem(photo_md.PIPELINE_OPTIONS, 'quality_target', target)
+    image = noisy_image()
+    data, search = photo_md.search_quality(image, photo_md.OUTPUT_FORMAT_SETTINGS['jpeg'])
+    assert search['quality'] == expected
+    assert data == encode_at(image, expected)
+
+# --shard / --merge-shards: the merged build equals a single-machine one
+
+def built_tree(root) -> dict:
+    """Maps every generated file under root (and the manifest's photos) to its content."""
+    tree = {}
+    for directory in (photo_md.OPTIMIZED_DIR, photo_md.OUTPUT_DIR):
+        for name in sorted(os.listdir(directory)):
+            tree[os.path.relpath(os.path.join(directory, name), root)] = read_bytes(os.path.join(directory, name))
+    # The cached index record is keyed on the rewritten markdown's mtime; compare the record only
+    tree['manifest'] = {filename: dict(entry, index=entry['index']['record'])
+                        for filename, entry in load_state()['photos'].items()}
+    return tree
+
+def clear_build(root) -> None:
+    for directory in (photo_md.OPTIMIZED_DIR, photo_md.OUTPUT_DIR):
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+    os.remove(photo_md.MANIFEST_PATH)
+
+def test_merged_shards_match_a_single_run(pipeline):
+    add_photo('a.jpg', quality=90)
+    add_photo('b.png', color=(20, 120, 60))
+    add_photo('c.jpg', size=(500, 700), color=(200, 30, 90), quality=80)
+    add_photo('d.jpg', size=(300, 300), color=(0, 0, 250), quality=85)
+    run_main()
+    single = built_tree(pipeline)
+
+    clear_build(pipeline)
+    owners = {}
+    for index in (1, 2, 3):
+        run_main('--shard', f'{index}/3')
+        partial = json.loads(read_bytes(photo_md.shard_manifest_path(index, 3)))
+        for filename in partial['photos']:
+            owners.setdefault(filename, []).append(index)
+        # Shards leave the shared manifest and index to the merge
+        assert not os.path.exists(photo_md.MANIFEST_PATH)
+        assert not os.path.exists(index_path())
+    assert owners == {filename: [photo_md.shard_of(entry['sha256'], 3)] for filename, entry in single['manifest'].items()}
+
+    run_main('--merge-shards')
+    assert built_tree(pipeline) == single
+    assert not any(os.path.exists(photo_md.shard_manifest_path(index, 3)) for index in (1, 2, 3))
+
+def test_merge_shards_needs_every_shard(pipeline):
+    add_photo('a.jpg', quality=90)
+    run_main('--shard', '1/2')
+    with pytest.raises(SystemExit):
+        photo_md.main(['--merge-shards', '--log-level', 'ERROR'])
+    assert os.path.exists(photo_md.shard_manifest_path(1, 2))
+    assert not os.path.exists(photo_md.MANIFEST_PATH)
+
+# OutputWriter: a group is written entirely or not at all
+
+def test_output_writer_failed_group_leaves_previous_files(tmp_path):
+    kept = tmp_path / 'photo_large.jpg'
+    kept.write_bytes(b'old')
+    writer = photo_md.OutputWriter()
+    failed = writer.submit([(str(kept), b'new'), (str(tmp_path / 'missing' / 'photo_large.webp'), b'new')])
+    # Queued behind the failure: refused rather than written next to a broken group
+    behind = writer.submit([(str(tmp_path / 'other.jpg'), b'other')])
+    with pytest.raises(FileNotFoundError):
+        failed.result()
+    with pytest.raises(FileNotFoundError):
+        behind.result()
+    with pytest.raises(FileNotFoundError):
+        writer.flush()
+    assert kept.read_bytes() == b'old'
+    assert sorted(os.listdir(tmp_path)) == ['photo_large.jpg']
+
+    # flush() reported the error, so the writer takes new groups again
+    stats = {}
+    assert writer.submit([(str(kept), b'new'), (str(tmp_path / 'other.jpg'), b'other')], stats).result() == 2
+    writer.flush()
+    assert kept.read_bytes() == b'new'
+    assert sorted(os.listdir(tmp_path)) == ['other.jpg', 'photo_large.jpg']
+    assert stats['stages'][0]['bytesWritten'] == len(b'new') + len(b'other')
+
+def test_write_files_atomically_keeps_unchanged_files(tmp_path):
+    same, changed = tmp_path / 'same.jpg', tmp_path / 'changed.jpg'
+    same.write_bytes(b'same')
+    changed.write_bytes(b'before')
+    os.utime(same, ns=(1, 1))
+    assert photo_md.write_files_atomically([(str(same), b'same'), (str(changed), b'after')]) == 1
+    assert os.stat(same).st_mtime_ns == 1
+    assert changed.read_bytes() == b'after'
+
+# Reduced JPEG decoding also applies to camera MPO files
+
+def test_mpo_sources_decode_at_reduced_scale(tmp_path):
+    path = str(tmp_path / 'camera.jpg')
+    primary, preview = split_image((1600, 1200)), Image.new('RGB', (640, 480), (90, 90, 90))
+    primary.save(path, 'MPO', save_all=True, append_images=[preview], quality=90)
+
+    with photo_md.open_for_resize(path, {'thumb': (200, 200)}) as image:
+        assert image.format == 'MPO'
+        assert image.size < (1600, 1200) and image.size[0] >= 200 * photo_md.RESIZE_REDUCING_GAP
+
+    image, full_size = photo_md.reduced_decode(path, (100, 100))
+    assert full_size == (1600, 1200)
+    assert image.size == (200, 150)
+
+# Resize cascade timings are reported on every run, the comparison only when verified
+
+@pytest.mark.parametrize('verify', [False, True])
+def test_run_report_records_resize_cascade(pipeline, verify):
+    add_photo('a.png', size=(2400, 1600), color=(20, 120, 60))
+    report = str(pipeline / 'report.jsonl')
+    run_main('--report', report, *(['--verify-resize'] if verify else []))
+
+    [record] = [json.loads(line) for line in read_bytes(report).splitlines()]
+    assert record['resize']['cascadeSeconds'] > 0
+    assert ('savedSeconds' in record['resize']) == verify
+    if verify:
+        assert set(record['resize']['ssim']) == {'full', 'large', 'medium', 'thumb'}
+        assert all(score >= photo_md.RESIZE_SSIM_THRESHOLD for score in record['resize']['ssim'].values())